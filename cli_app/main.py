@@ -1,8 +1,19 @@
 import os
-import cv2
-import numpy as np
+import sys
+import argparse
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 
+# フィルタ本体は flet_app と共通の postarization パッケージを使う
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flet_app", "src"))
+from postarization import __version__ as FILTER_VERSION, QUALITY_FACTORS, QUANTIZERS, postarization, render_presets  # noqa: E402
+from postarization.sources import open_tile_source  # noqa: E402
+from postarization.tiling import render_tiled_to_png  # noqa: E402
+from manifest import Manifest  # noqa: E402
+from video import DEFAULT_REUSE_THRESHOLD, DEFAULT_STABILIZE_THRESHOLD, is_video_input, run_video  # noqa: E402
+
 # パラメータのプリセット（テンプレート）
 PARAMETER_SETS = {
     # "default": {"saturation": 2, "level": 8, "smooth_strength": 50, "edge_strength": 0.4},
@@ -14,7 +25,7 @@ PARAMETER_SETS = {
 
 def convert_to_anime_style(image: Image.Image, saturation=2, level=8, smooth_strength=50, edge_strength=0.4) -> Image.Image:
     """
-    画像をアニメ風に変換する関数
+    画像をアニメ風に変換する関数（flet_app と共通の postarization パイプラインを使用）
     :param image: 入力画像（PIL Image）
     :param saturation: 彩度の倍率
     :param level: ポスタリゼーションの色レベル
@@ -22,71 +33,355 @@ def convert_to_anime_style(image: Image.Image, saturation=2, level=8, smooth_str
     :param edge_strength: エッジ保持の強さ（0.0-1.0）
     :return: 変換後のアニメ調画像（PIL Image）
     """
-    # PIL -> OpenCV (RGB->BGR)
-    cv_image = np.array(image)
-    cv_image = cv2.cvtColor(cv_image, cv2.COLOR_RGB2BGR)
+    return postarization(image, saturation, level, smooth_strength, edge_strength)
 
-    # 1) 彩度を上げる
-    hsv = cv2.cvtColor(cv_image, cv2.COLOR_BGR2HSV)
-    hsv[..., 1] = np.clip(hsv[..., 1] * saturation, 0, 255)
-    saturated = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+def load_image(input_path: str) -> Image.Image:
+    """
+    入力画像を一度だけデコードする関数
+    :param input_path: 入力画像のパス
+    :return: RGBに変換済みの画像（PIL Image）
+    """
+    with Image.open(input_path) as image:
+        image.load()
+        if image.mode != "RGB":
+            return image.convert("RGB")
+        return image.copy()
 
-    # 2) エッジを保ったまま平滑化（新しいパラメータ）
-    sigma_s = smooth_strength  # 50以上でのっぺり感が増す
-    sigma_r = max(0.01, edge_strength)  # 0.0にするとエラーになるので最小値を設定
-    smooth = cv2.edgePreservingFilter(saturated, flags=1, sigma_s=sigma_s, sigma_r=sigma_r)
+# 出力形式 -> (PIL の形式名, 拡張子（Noneなら入力のファイル名のまま）)
+OUTPUT_FORMATS = {
+    "png": ("PNG", None),
+    "jpeg": ("JPEG", ".jpg"),
+    "webp": ("WEBP", ".webp"),
+}
 
-    # 3) ポスタリゼーション（ビット落とし）
-    step = 256 // level  # 色レベルに応じた量子化ステップ
-    poster = (smooth // step) * step
-    poster = np.clip(poster, 0, 255).astype(np.uint8)
+# キューの終わりを表す印
+_DONE = None
 
-    # 4) 線画抽出 (Canny)
-    gray = cv2.cvtColor(poster, cv2.COLOR_BGR2GRAY)
-    edges = cv2.Canny(gray, 100, 200)
+def output_filename(filename: str, output_format: str = "png") -> str:
+    """
+    出力ファイル名を決める関数（PNGは従来どおり入力と同じファイル名。TIFF のみ .png にする）
+    :param filename: 入力のファイル名
+    :param output_format: 出力形式（png / jpeg / webp）
+    :return: 出力のファイル名
+    """
+    extension = OUTPUT_FORMATS[output_format][1]
+    if extension is None:
+        # TIFF の入力は拡張子を .png にする（PNG を .tif の名前で保存しないように）
+        if filename.lower().endswith((".tif", ".tiff")):
+            return os.path.splitext(filename)[0] + ".png"
+        return filename
+    return os.path.splitext(filename)[0] + extension
 
-    # 線画を反転しておく
-    edges_inv = cv2.bitwise_not(edges)
-    edges_inv_colored = cv2.cvtColor(edges_inv, cv2.COLOR_GRAY2BGR)
+def save_image(image: Image.Image, output_path: str, output_format: str = "png", png_compression: int = 6,
+               quality: int = 90):
+    """
+    変換後の画像を保存する関数
+    :param output_format: 出力形式（png / jpeg / webp）
+    :param png_compression: PNGの圧縮レベル（0-9、小さいほど速くファイルは大きい）
+    :param quality: JPEG / WebP の画質（1-100）
+    """
+    pil_format = OUTPUT_FORMATS[output_format][0]
+    if output_format == "png":
+        image.save(output_path, format=pil_format, compress_level=png_compression)
+    else:
+        image.save(output_path, format=pil_format, quality=quality)
 
-    # 5) 線画を重ねる
-    anime_image = cv2.bitwise_and(poster, edges_inv_colored)
+def render_job(image: Image.Image, presets: dict, smooth_quality: str = "exact", quantizer: str = "uniform") -> dict:
+    """
+    ワーカープロセスで1枚×全プリセットを変換する関数（保存は書き込みスレッドで行う）
+    プリセット間で入力が同じ段階（HSV変換、同じ強さの平滑化など）は1回だけ計算する
+    :param presets: {パターン名: パラメータ}
+    :param smooth_quality: 平滑化の精度（exact / balanced / preview）
+    :param quantizer: 色の量子化の方式（uniform / kmeans）
+    :return: {パターン名: 変換後の画像}
+    """
+    return render_presets(image, presets, quality=smooth_quality, quantizer=quantizer)
 
-    # OpenCV -> PIL (BGR->RGB)
-    return Image.fromarray(cv2.cvtColor(anime_image, cv2.COLOR_BGR2RGB))
+def render_tiled_job(input_path: str, params: dict, output_path: str, tile_size: int, png_compression: int = 6,
+                     quantizer: str = "uniform"):
+    """
+    ワーカープロセスで巨大な画像をタイルごとに変換し、PNGへストリーム保存する関数
+    画像全体をプロセス間で受け渡さないよう、入力はワーカー側で開く
+    無圧縮の TIFF / BMP / PPM はファイルをメモリマップし、PNG は上から順に展開するため、
+    画像全体をデコードしない（メモリはタイルの大きさと画像の幅で決まる）
+    :return: None（保存済み）
+    """
+    # 巨大なスキャン画像を読むため、Pillow の画素数の上限（解凍爆弾の検出）を外す
+    Image.MAX_IMAGE_PIXELS = None
+    with open_tile_source(input_path) as source:
+        render_tiled_to_png(source, output_path, tile_size=tile_size,
+                            compress_level=png_compression, quantizer=quantizer, **params)
+    return None
 
-if __name__ == "__main__":
-    input_dir = "./input"
-    output_dir = "./output"
+def run_batch(input_dir: str, output_dir: str, workers: int = None, tile_size: int = 0, force: bool = False,
+              readers: int = 2, writers: int = 2, output_format: str = "png", png_compression: int = 6,
+              quality: int = 90, smooth_quality: str = "exact", quantizer: str = "uniform") -> int:
+    """
+    入力フォルダの全画像 × 全プリセットを変換する関数
+
+    読み込み（スレッド）→ 変換（プロセスプール）→ 保存（スレッド）の3段に分け、
+    段の間を上限付きのキューでつなぐ。後ろの段が詰まると前の段が待つため、
+    デコード済みの画像や変換結果がメモリに溜まりすぎず、ディスクの読み書きと変換が重なって進む。
+
+    :param input_dir: 入力フォルダ
+    :param output_dir: 出力フォルダ
+    :param workers: 変換のワーカープロセス数（Noneの場合はCPUコア数）
+    :param tile_size: 0より大きい場合はこの大きさのタイルごとに処理する（巨大な画像向け、PNGのみ）
+    :param force: Trueの場合はマニフェストを無視してすべて変換し直す
+    :param readers: 画像を読み込むスレッド数
+    :param writers: 画像を保存するスレッド数
+    :param output_format: 出力形式（png / jpeg / webp）
+    :param png_compression: PNGの圧縮レベル（0-9）
+    :param quality: JPEG / WebP の画質（1-100）
+    :param smooth_quality: 平滑化の精度（exact / balanced / preview。exact 以外は縮小して処理する近似）
+    :param quantizer: 色の量子化の方式（uniform / kmeans）
+    :return: 保存した画像の枚数
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    if smooth_quality not in QUALITY_FACTORS:
+        raise ValueError(f"Unknown smooth quality: {smooth_quality}")
+    if quantizer not in QUANTIZERS:
+        raise ValueError(f"Unknown quantizer: {quantizer}")
+    if tile_size > 0 and output_format != "png":
+        raise ValueError("Tiled processing only supports PNG output")
+    if tile_size > 0 and smooth_quality != "exact":
+        raise ValueError("Tiled processing only supports exact smoothing")
+
+    workers = workers or os.cpu_count() or 1
+    readers = max(1, readers)
+    writers = max(1, writers)
 
     # 出力フォルダを作成（既にあればスキップ）
     os.makedirs(output_dir, exist_ok=True)
+    for pattern_name in PARAMETER_SETS:
+        os.makedirs(os.path.join(output_dir, pattern_name), exist_ok=True)
 
     # 画像ファイルの拡張子リスト
-    valid_extensions = (".jpg", ".jpeg", ".png", ".bmp")
+    valid_extensions = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+
+    # 前回の実行で変換済みの出力を記録したマニフェスト
+    manifest = Manifest(output_dir, FILTER_VERSION)
+    manifest_lock = threading.Lock()
+
+    # 読み込み待ちのファイル / デコード済みの画像 / 変換中・保存待ちのジョブ
+    read_queue = queue.Queue()
+    decoded_queue = queue.Queue(maxsize=readers)
+    write_queue = queue.Queue(maxsize=workers * 2)
+
+    counts = {"saved": 0, "skipped": 0, "failed": 0}
+    counts_lock = threading.Lock()
+
+    def count(name: str):
+        with counts_lock:
+            counts[name] += 1
 
-    # `./input/` 内のすべての画像を処理
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith(valid_extensions):
+    # 変換を投入できなくなった（ワーカープロセスが落ちてプロセスプールが壊れた場合など）
+    aborted = threading.Event()
+
+    def reader():
+        try:
+            while True:
+                task = read_queue.get()
+                if task is _DONE:
+                    return
+                input_path, input_hash, targets = task
+                if aborted.is_set():
+                    for _ in targets:
+                        count("failed")
+                    continue
+                try:
+                    # 画像の読み込みは1ファイルにつき1回だけ（タイル処理ではワーカー側で必要な部分だけ読む）
+                    image = None if tile_size > 0 else load_image(input_path)
+                except Exception as ex:
+                    print(f"[ERROR] Failed to read {input_path}: {ex}")
+                    for _ in targets:
+                        count("failed")
+                    continue
+                decoded_queue.put((input_path, input_hash, image, targets))
+        finally:
+            # dispatcher は全スレッドの終了の通知を待つため、例外で抜けた場合も必ず送る
+            decoded_queue.put(_DONE)
+
+    def dispatcher(executor):
+        finished_readers = 0
+        try:
+            # 投入に失敗した後も、読み込み側が止まらないよう終了の通知まで受け取り続ける
+            while finished_readers < readers:
+                item = decoded_queue.get()
+                if item is _DONE:
+                    finished_readers += 1
+                    continue
+                input_path, input_hash, image, targets = item
+                if aborted.is_set():
+                    for _ in targets:
+                        count("failed")
+                    continue
+                for pattern_name, _, _, output_path in targets:
+                    print(f"Processing: {input_path} -> {output_path} ({pattern_name})")
+                pending = list(targets)
+                try:
+                    if tile_size > 0:
+                        # タイル処理はプリセットごとにワーカー側で保存まで行う
+                        while pending:
+                            _, params, _, output_path = pending[0]
+                            future = executor.submit(render_tiled_job, input_path, params, output_path, tile_size,
+                                                     png_compression, quantizer)
+                            write_queue.put((future, input_path, input_hash, [pending.pop(0)]))
+                    else:
+                        presets = {pattern_name: params for pattern_name, params, _, _ in targets}
+                        future = executor.submit(render_job, image, presets, smooth_quality, quantizer)
+                        # 保存が追いつかないときはここで待つ
+                        write_queue.put((future, input_path, input_hash, pending))
+                        pending = []
+                except Exception as ex:
+                    # 以降の画像は変換せず、読み込み側にも止めるよう知らせる
+                    print(f"[ERROR] Failed to submit {input_path}: {ex}")
+                    aborted.set()
+                    for _ in pending:
+                        count("failed")
+        finally:
+            for _ in range(writers):
+                write_queue.put(_DONE)
+
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is _DONE:
+                return
+            future, input_path, input_hash, targets = item
+            try:
+                results = future.result()
+            except Exception as ex:
+                print(f"[ERROR] Failed to convert {input_path}: {ex}")
+                for _ in targets:
+                    count("failed")
+                continue
+            for pattern_name, _, record_params, output_path in targets:
+                try:
+                    if results is not None:
+                        save_image(results[pattern_name], output_path, output_format, png_compression, quality)
+                except Exception as ex:
+                    print(f"[ERROR] Failed to save {output_path} ({pattern_name}): {ex}")
+                    count("failed")
+                    continue
+                with manifest_lock:
+                    manifest.record(input_path, input_hash, record_params, output_path)
+                count("saved")
+                print(f"Saved: {output_path} ({pattern_name})")
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    threads = [threading.Thread(target=reader, name=f"reader-{i}", daemon=True) for i in range(readers)]
+    threads.append(threading.Thread(target=dispatcher, args=(executor,), name="dispatcher", daemon=True))
+    threads += [threading.Thread(target=writer, name=f"writer-{i}", daemon=True) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+
+    completed = False
+    try:
+        # `./input/` 内のすべての画像を処理
+        for filename in sorted(os.listdir(input_dir)):
+            if not filename.lower().endswith(valid_extensions):
+                continue
             input_path = os.path.join(input_dir, filename)
+            # 大きな入力のハッシュの計算中も、書き出し側が記録できるようロックは辞書の参照・更新の間だけ取る
+            input_hash = manifest.input_hash(input_path, lock=manifest_lock)
 
-            # すべてのパターンで変換
+            # 入力・パラメータ・フィルタのどれも変わっていない出力は作り直さない
+            targets = []
             for pattern_name, params in PARAMETER_SETS.items():
-                # 各パターンごとにサブフォルダ作成
-                pattern_output_dir = os.path.join(output_dir, pattern_name)
-                os.makedirs(pattern_output_dir, exist_ok=True)
+                output_path = os.path.join(output_dir, pattern_name, output_filename(filename, output_format))
+                # JPEG / WebP の画質・近似の平滑化・量子化の方式は結果が変わるためマニフェストにも記録する
+                record_params = params if output_format == "png" else dict(params, quality=quality)
+                if smooth_quality != "exact":
+                    record_params = dict(record_params, smooth_quality=smooth_quality)
+                if quantizer != "uniform":
+                    record_params = dict(record_params, quantizer=quantizer)
+                with manifest_lock:
+                    current = not force and manifest.is_current(input_hash, record_params, output_path)
+                if current:
+                    count("skipped")
+                    continue
+                targets.append((pattern_name, params, record_params, output_path))
+            if targets:
+                read_queue.put((input_path, input_hash, targets))
+
+        for _ in range(readers):
+            read_queue.put(_DONE)
+        for thread in threads:
+            thread.join()
+        completed = True
+    finally:
+        # 中断された場合は実行待ちのジョブを取り消す
+        executor.shutdown(wait=completed, cancel_futures=not completed)
+        # 中断された場合も、それまでに完了した分は記録しておく
+        with manifest_lock:
+            manifest.save()
 
-                output_path = os.path.join(pattern_output_dir, filename)
+    if counts["skipped"]:
+        print(f"Skipped {counts['skipped']} up-to-date output(s) (use --force to reprocess)")
+    if counts["failed"]:
+        print(f"[WARNING] {counts['failed']} output(s) failed")
+    return counts["saved"]
 
-                print(f"Processing: {input_path} -> {output_path} ({pattern_name})")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="画像をアニメ風に一括変換します")
+    parser.add_argument("--input", default="./input", help="入力フォルダ（デフォルト: ./input）")
+    parser.add_argument("--output", default="./output", help="出力フォルダ（デフォルト: ./output）")
+    parser.add_argument("--workers", type=int, default=None, help="ワーカープロセス数（デフォルト: CPUコア数）")
+    parser.add_argument("--tile-size", type=int, default=0,
+                        help="指定するとこの大きさのタイルごとに処理してメモリ使用量を抑える（例: 1024）")
+    parser.add_argument("--force", action="store_true", help="変換済みの出力もすべて作り直す")
+    parser.add_argument("--readers", type=int, default=2, help="画像を読み込むスレッド数（デフォルト: 2）")
+    parser.add_argument("--writers", type=int, default=2, help="画像を保存するスレッド数（デフォルト: 2）")
+    parser.add_argument("--format", choices=list(OUTPUT_FORMATS), default="png",
+                        help="出力形式（デフォルト: png）")
+    parser.add_argument("--png-compression", type=int, choices=range(10), default=6, metavar="0-9",
+                        help="PNGの圧縮レベル。小さいほど保存が速くファイルは大きい（デフォルト: 6）")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG / WebP の画質 1-100（デフォルト: 90）")
+    parser.add_argument("--smooth-quality", choices=list(QUALITY_FACTORS), default="exact",
+                        help="平滑化の精度。balanced / preview は縮小して処理する近似で速い（デフォルト: exact）")
+    parser.add_argument("--quantizer", choices=list(QUANTIZERS), default="uniform",
+                        help="色の量子化の方式。kmeans は画像ごとに Lab 色空間で求めたパレットを使う（デフォルト: uniform）")
+    parser.add_argument("--video", default=None,
+                        help="動画ファイル（.mp4 など）または連番画像のフォルダを変換する（--input の代わり）")
+    parser.add_argument("--fps", type=float, default=None,
+                        help="出力する動画のフレームレート（デフォルト: 入力と同じ）")
+    parser.add_argument("--reuse-threshold", type=float, default=DEFAULT_REUSE_THRESHOLD,
+                        help="前のフレームとの差（32px の升目ごとの平均、0-255）がこれ以下の部分は変換し直さない"
+                             f"（デフォルト: {DEFAULT_REUSE_THRESHOLD}）")
+    parser.add_argument("--stabilize", type=int, default=DEFAULT_STABILIZE_THRESHOLD,
+                        help="画素ごとの差がこれ以下なら前のフレームの出力を残してちらつきを抑える。0で無効"
+                             f"（デフォルト: {DEFAULT_STABILIZE_THRESHOLD}）")
+    args = parser.parse_args()
 
-                # 画像を読み込み
-                image = Image.open(input_path)
+    if args.video is not None:
+        if not is_video_input(args.video):
+            parser.error("--video には動画ファイルまたは連番画像のフォルダを指定してください")
+        if args.tile_size > 0:
+            parser.error("--tile-size は --video と併用できません")
+        if args.quantizer != "uniform":
+            # フレームごとにパレットが変わると色がちらつくため、動画は uniform のみ
+            parser.error("--quantizer kmeans は --video と併用できません")
+        stats = run_video(args.video, args.output, PARAMETER_SETS, workers=args.workers, fps=args.fps,
+                          reuse_threshold=args.reuse_threshold, stabilize_threshold=args.stabilize,
+                          smooth_quality=args.smooth_quality)
+        if stats["failed"]:
+            print(f"[ERROR] 動画の変換に失敗しました（{stats['failed']} フレーム）")
+            sys.exit(1)
+        print(f"✅ 変換した動画を {args.output} に保存しました！")
+        sys.exit(0)
 
-                # アニメ調に変換
-                anime_image = convert_to_anime_style(image, **params)
+    if args.tile_size > 0 and args.format != "png":
+        parser.error("--tile-size は PNG 出力のみ対応しています")
+    if args.tile_size > 0 and args.smooth_quality != "exact":
+        parser.error("--tile-size は --smooth-quality exact のみ対応しています")
+    if not 1 <= args.quality <= 100:
+        parser.error("--quality は 1-100 で指定してください")
 
-                # 保存
-                anime_image.save(output_path, format="PNG")
+    run_batch(args.input, args.output, workers=args.workers, tile_size=args.tile_size, force=args.force,
+              readers=args.readers, writers=args.writers, output_format=args.format,
+              png_compression=args.png_compression, quality=args.quality, smooth_quality=args.smooth_quality,
+              quantizer=args.quantizer)
 
-    print(f"✅ すべての画像を {output_dir} に保存しました！")
+    print(f"✅ すべての画像を {args.output} に保存しました！")
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+from contextlib import nullcontext
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def file_hash(path: str) -> str:
+    """ファイル内容のSHA-256"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    変換済みの出力を記録するマニフェスト（出力フォルダの manifest.json）
+
+    出力ごとに (入力の内容のハッシュ, パラメータ, フィルタのバージョン) を記録し、
+    次回の実行でこれらが一致して出力ファイルも残っていれば処理をスキップする。
+    入力のハッシュはサイズと更新時刻が変わっていなければ再計算しない。
+    """
+
+    VERSION = 1
+
+    def __init__(self, output_dir: str, filter_version: str):
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.filter_version = filter_version
+        self.entries = {}  # 出力パス（output_dir からの相対パス） -> 記録
+        self._inputs = {}  # 入力パス -> {"size", "mtime", "hash"}
+        self._output_dir = output_dir
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != self.VERSION:
+            return
+        self.entries = data.get("entries", {})
+        self._inputs = data.get("inputs", {})
+
+    def save(self):
+        """一時ファイルに書いてから置き換える（途中で中断しても壊れないように）"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": self.VERSION, "entries": self.entries, "inputs": self._inputs},
+                      f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def input_hash(self, input_path: str, lock=None) -> str:
+        """
+        入力のハッシュ（サイズと更新時刻が前回と同じなら記録済みの値を使う）
+        :param lock: 記録を他のスレッドと共有する場合のロック（ファイルの読み込みとハッシュの計算はロックの外で行う）
+        """
+        lock = lock if lock is not None else nullcontext()
+        stat = os.stat(input_path)
+        key = os.path.abspath(input_path)
+        with lock:
+            known = self._inputs.get(key)
+        if known and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime_ns:
+            return known["hash"]
+        digest = file_hash(input_path)
+        with lock:
+            self._inputs[key] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest}
+        return digest
+
+    def _key(self, output_path: str) -> str:
+        return os.path.relpath(output_path, self._output_dir).replace(os.sep, "/")
+
+    def is_current(self, input_hash: str, params: dict, output_path: str) -> bool:
+        """前回と同じ入力・パラメータ・フィルタで作った出力が残っていればTrue"""
+        entry = self.entries.get(self._key(output_path))
+        return (
+            entry is not None
+            and entry["input_hash"] == input_hash
+            and entry["params"] == params
+            and entry["filter_version"] == self.filter_version
+            and os.path.exists(output_path)
+        )
+
+    def record(self, input_path: str, input_hash: str, params: dict, output_path: str):
+        self.entries[self._key(output_path)] = {
+            "input": os.path.abspath(input_path),
+            "input_hash": input_hash,
+            "params": params,
+            "filter_version": self.filter_version,
+        }
@@ -0,0 +1,337 @@
+"""
+動画・連番画像の変換
+
+フレームを読み込む順にプロセスプールへ投入し、結果は投入した順に書き出す。
+連続するフレームはほとんど同じことが多いため、直前までの入力（参照フレーム）と比べて
+
+- 変化がない（升目ごとの平均の差がしきい値以下）: 前のフレームの出力をそのまま使う
+- 一部だけ変化した: 変化した範囲（+ のりしろ）だけを変換して、前の出力に書き込む
+- 広い範囲が変化した（カット切り替えなど）: フレーム全体を変換する
+
+さらに、画素ごとの入力の差が小さい画素は前の出力を残し、ポスタリゼーションの境目や線画の
+ちらつき（ノイズで色のレベルが行ったり来たりする）を抑える。
+"""
+import math
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from postarization import render_presets_array
+from postarization.tiling import tile_halo
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm")
+FRAME_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+# 連番画像の入力で、出力を動画にする場合のフレームレートの既定値
+DEFAULT_FPS = 24.0
+
+# 変化を調べる升目の大きさ（ピクセル）
+CELL_SIZE = 32
+# 升目の平均の色の差（0-255）がこれ以下なら変化していないとみなす
+DEFAULT_REUSE_THRESHOLD = 2.0
+# 画素ごとの差（チャンネルの最大値、0-255）がこれ以下なら前の出力を残す（0で無効）
+DEFAULT_STABILIZE_THRESHOLD = 8
+# 変化した範囲がフレームのこの割合より広ければ全体を変換する
+MAX_PARTIAL_FRACTION = 0.35
+
+# 進捗を表示する間隔（フレーム数）
+PROGRESS_INTERVAL = 50
+
+
+def is_video_input(input_path: str) -> bool:
+    """動画ファイルまたは連番画像のフォルダならTrue"""
+    return os.path.isdir(input_path) or input_path.lower().endswith(VIDEO_EXTENSIONS)
+
+
+def open_frames(input_path: str):
+    """
+    フレームを順に読み込む
+    :param input_path: 動画ファイル、または連番画像（ファイル名順）のフォルダ
+    :return: ((フレーム名, BGR配列) のジェネレータ, フレームレート（連番画像は None）, フレーム数（不明なら None）)
+    """
+    if os.path.isdir(input_path):
+        names = sorted(name for name in os.listdir(input_path) if name.lower().endswith(FRAME_EXTENSIONS))
+
+        def read_sequence():
+            for name in names:
+                frame = cv2.imread(os.path.join(input_path, name), cv2.IMREAD_COLOR)
+                if frame is None:
+                    raise OSError(f"Failed to read frame: {name}")
+                yield name, frame
+
+        return read_sequence(), None, len(names)
+
+    capture = cv2.VideoCapture(input_path)
+    if not capture.isOpened():
+        raise OSError(f"Failed to open video: {input_path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or None
+    count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) or None
+
+    def read_video():
+        index = 0
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield f"{index:06d}.png", frame
+                index += 1
+        finally:
+            capture.release()
+
+    return read_video(), fps, count
+
+
+def render_frame_job(frame: np.ndarray, presets: dict, smooth_quality: str = "exact") -> dict:
+    """
+    ワーカープロセスでフレーム全体を全プリセットで変換する関数
+    :return: {パターン名: 変換後のフレーム（BGR）}
+    """
+    return render_presets_array(frame, presets, quality=smooth_quality)
+
+
+def render_region_job(crop: np.ndarray, core: tuple, presets: dict, smooth_quality: str = "exact") -> dict:
+    """
+    ワーカープロセスでフレームの一部（のりしろ込み）を変換し、のりしろを除いた部分を返す関数
+    :param crop: のりしろ込みで切り出したフレーム（BGR）
+    :param core: crop の中の、出力に使う範囲 (x0, y0, x1, y1)
+    :return: {パターン名: core の範囲の変換結果（BGR）}
+    """
+    x0, y0, x1, y1 = core
+    results = render_presets_array(crop, presets, quality=smooth_quality)
+    return {name: np.ascontiguousarray(result[y0:y1, x0:x1]) for name, result in results.items()}
+
+
+class TemporalPlanner:
+    """
+    フレームごとに、全体を変換するか・一部だけ変換するか・前の出力を使うかを決める
+
+    参照フレームは「今の出力がどの入力から作られたか」を表す。出力を書き換えた画素だけ
+    参照フレームも更新するため、小さな変化が積み重なって出力が入力からずれ続けることはない。
+    """
+
+    def __init__(self, reuse_threshold: float = DEFAULT_REUSE_THRESHOLD,
+                 stabilize_threshold: int = DEFAULT_STABILIZE_THRESHOLD, halo: int = 0, allow_partial: bool = True):
+        """
+        :param reuse_threshold: 升目の平均の差がこれ以下なら変化なし（0-255）
+        :param stabilize_threshold: 画素ごとの差がこれ以下なら前の出力を残す（0で無効）
+        :param halo: 一部だけ変換する場合に周囲に付けるのりしろの幅
+        :param allow_partial: Falseの場合は一部だけの変換を行わない
+        """
+        self.reuse_threshold = reuse_threshold
+        self.stabilize_threshold = stabilize_threshold
+        self.halo = halo
+        self.allow_partial = allow_partial
+        self._reference = None
+
+    def plan(self, frame: np.ndarray):
+        """
+        :return: (種類 "full" / "partial" / "reuse", 範囲, 残す画素のマスク（なければNone）)
+                 範囲は partial の場合 (のりしろ込みの範囲, 出力する範囲)（どちらも (x0, y0, x1, y1)）
+        """
+        height, width = frame.shape[:2]
+        if self._reference is None or self._reference.shape != frame.shape:
+            self._reference = frame.copy()
+            return "full", None, None
+
+        # 升目ごとの平均の色で比べる（平均を取ってから比べるので、ノイズや圧縮の揺らぎは打ち消される）
+        grid = (math.ceil(width / CELL_SIZE), math.ceil(height / CELL_SIZE))
+        cells = cv2.absdiff(cv2.resize(frame, grid, interpolation=cv2.INTER_AREA),
+                            cv2.resize(self._reference, grid, interpolation=cv2.INTER_AREA))
+        changed = cells.max(axis=2) > self.reuse_threshold
+        if not changed.any():
+            return "reuse", None, None
+
+        kind, region = "full", None
+        x0, y0, x1, y1 = 0, 0, width, height
+        if self.allow_partial:
+            ys, xs = np.nonzero(changed)
+            core = (int(xs.min()) * CELL_SIZE, int(ys.min()) * CELL_SIZE,
+                    min(width, (int(xs.max()) + 1) * CELL_SIZE), min(height, (int(ys.max()) + 1) * CELL_SIZE))
+            if (core[2] - core[0]) * (core[3] - core[1]) <= MAX_PARTIAL_FRACTION * width * height:
+                x0, y0, x1, y1 = core
+                padded = (max(0, x0 - self.halo), max(0, y0 - self.halo),
+                          min(width, x1 + self.halo), min(height, y1 + self.halo))
+                kind, region = "partial", (padded, core)
+
+        # 差の小さい画素は前の出力を残す。参照フレームは書き換える画素だけ更新する
+        mask = None
+        if self.stabilize_threshold > 0:
+            mask = cv2.absdiff(frame, self._reference).max(axis=2) <= self.stabilize_threshold
+        reference = self._reference[y0:y1, x0:x1]
+        if mask is None:
+            reference[...] = frame[y0:y1, x0:x1]
+        else:
+            np.copyto(reference, frame[y0:y1, x0:x1], where=~mask[y0:y1, x0:x1, None])
+        return kind, region, mask
+
+
+class FrameSink:
+    """プリセットごとの出力（動画ファイル、または連番画像のフォルダ）"""
+
+    def __init__(self, output_dir: str, pattern_names, input_path: str, fps: float, as_video: bool):
+        self.as_video = as_video
+        self.fps = fps
+        self._writers = {}
+        self._paths = {}
+        stem = os.path.splitext(os.path.basename(os.path.normpath(input_path)))[0]
+        for pattern_name in pattern_names:
+            if as_video:
+                os.makedirs(os.path.join(output_dir, pattern_name), exist_ok=True)
+                self._paths[pattern_name] = os.path.join(output_dir, pattern_name, f"{stem}.mp4")
+            else:
+                path = os.path.join(output_dir, pattern_name, stem)
+                os.makedirs(path, exist_ok=True)
+                self._paths[pattern_name] = path
+
+    def write(self, pattern_name: str, frame_name: str, frame: np.ndarray):
+        if not self.as_video:
+            path = os.path.join(self._paths[pattern_name], os.path.splitext(frame_name)[0] + ".png")
+            if not cv2.imwrite(path, frame):
+                raise OSError(f"Failed to write {path}")
+            return
+        writer = self._writers.get(pattern_name)
+        if writer is None:
+            height, width = frame.shape[:2]
+            writer = cv2.VideoWriter(self._paths[pattern_name], cv2.VideoWriter_fourcc(*"mp4v"), self.fps,
+                                     (width, height))
+            if not writer.isOpened():
+                raise OSError(f"Failed to open video writer: {self._paths[pattern_name]}")
+            self._writers[pattern_name] = writer
+        writer.write(frame)
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.release()
+        self._writers = {}
+
+    def paths(self) -> dict:
+        return dict(self._paths)
+
+
+def run_video(input_path: str, output_dir: str, presets: dict, workers: int = None, fps: float = None,
+              reuse_threshold: float = DEFAULT_REUSE_THRESHOLD,
+              stabilize_threshold: int = DEFAULT_STABILIZE_THRESHOLD, smooth_quality: str = "exact",
+              as_video: bool = None) -> dict:
+    """
+    動画・連番画像を全プリセットで変換する関数
+    :param input_path: 動画ファイル、または連番画像のフォルダ
+    :param output_dir: 出力フォルダ（プリセットごとのフォルダに、動画なら <名前>.mp4、連番画像なら <名前>/ を作る）
+    :param presets: {パターン名: パラメータ}
+    :param workers: 変換のワーカープロセス数（Noneの場合はCPUコア数）
+    :param fps: 出力する動画のフレームレート（省略時は入力と同じ。連番画像は DEFAULT_FPS）
+    :param reuse_threshold: 升目の平均の差がこれ以下なら前のフレームの出力を使う（0-255）
+    :param stabilize_threshold: 画素ごとの差がこれ以下なら前の出力を残す（0で無効）
+    :param smooth_quality: 平滑化の精度（exact 以外では一部だけの変換は行わない）
+    :param as_video: 動画として書き出すか（省略時は入力が動画なら動画、連番画像なら連番画像）
+    :return: 統計情報 {"frames", "full", "partial", "reused", "seconds", "fps", "outputs"}
+    """
+    workers = workers or os.cpu_count() or 1
+    frames, source_fps, frame_count = open_frames(input_path)
+    if as_video is None:
+        as_video = not os.path.isdir(input_path)
+    sink = FrameSink(output_dir, list(presets), input_path, fps or source_fps or DEFAULT_FPS, as_video)
+
+    # のりしろは平滑化の半径が最も大きいプリセットに合わせる（タイル処理と同じ考え方）
+    halo = max(tile_halo(params["smooth_strength"]) for params in presets.values())
+    planner = TemporalPlanner(reuse_threshold, stabilize_threshold, halo,
+                              allow_partial=smooth_quality == "exact")
+
+    # 変換中・書き出し待ちのフレーム（投入した順に書き出す）
+    jobs = queue.Queue(maxsize=workers * 2)
+    stats = {"frames": 0, "full": 0, "partial": 0, "reused": 0}
+    errors = []
+    stopped = threading.Event()  # フレームの読み込みが例外で中断した（残りのフレームは書き出さない）
+    start = time.perf_counter()
+
+    def writer():
+        previous = None  # {パターン名: 直前に書き出したフレーム}
+        while True:
+            item = jobs.get()
+            if item is None:
+                return
+            frame_name, kind, region, mask, future = item
+            if errors or stopped.is_set():
+                continue
+            try:
+                if kind == "reuse":
+                    outputs = previous
+                elif kind == "full":
+                    results = future.result()
+                    if mask is None or previous is None:
+                        outputs = results
+                    else:
+                        outputs = {name: np.where(mask[..., None], previous[name], result)
+                                   for name, result in results.items()}
+                else:
+                    results = future.result()
+                    _, (x0, y0, x1, y1) = region
+                    outputs = {}
+                    for name, core in results.items():
+                        output = previous[name].copy()
+                        if mask is not None:
+                            core = np.where(mask[y0:y1, x0:x1, None], output[y0:y1, x0:x1], core)
+                        output[y0:y1, x0:x1] = core
+                        outputs[name] = output
+                for name, output in outputs.items():
+                    sink.write(name, frame_name, output)
+                previous = outputs
+            except Exception as ex:
+                print(f"[ERROR] Failed to convert frame {frame_name}: {ex}")
+                errors.append(ex)
+                continue
+
+            stats["frames"] += 1
+            stats["reused" if kind == "reuse" else kind] += 1
+            done = stats["frames"]
+            if done % PROGRESS_INTERVAL == 0:
+                elapsed = time.perf_counter() - start
+                total = f"/{frame_count}" if frame_count else ""
+                print(f"Frames: {done}{total} ({done / elapsed:.1f} fps)")
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    thread = threading.Thread(target=writer, name="video-writer", daemon=True)
+    thread.start()
+    completed = False
+    try:
+        for frame_name, frame in frames:
+            if errors:
+                break
+            kind, region, mask = planner.plan(frame)
+            future = None
+            if kind == "full":
+                future = executor.submit(render_frame_job, frame, presets, smooth_quality)
+            elif kind == "partial":
+                (px0, py0, px1, py1), (x0, y0, x1, y1) = region
+                crop = np.ascontiguousarray(frame[py0:py1, px0:px1])
+                future = executor.submit(render_region_job, crop, (x0 - px0, y0 - py0, x1 - px0, y1 - py0),
+                                         presets, smooth_quality)
+            # 書き出しが追いつかないときはここで待つ
+            jobs.put((frame_name, kind, region, mask, future))
+        completed = True
+    finally:
+        if not completed:
+            stopped.set()
+        # 出力を閉じる前に書き出しのスレッドを終わらせる（読み込みで例外が出た場合も）
+        jobs.put(None)
+        thread.join()
+        executor.shutdown(wait=completed, cancel_futures=not completed)
+        sink.close()
+
+    seconds = time.perf_counter() - start
+    stats.update(
+        seconds=seconds,
+        fps=stats["frames"] / seconds if seconds > 0 else 0.0,
+        outputs=sink.paths(),
+        failed=len(errors),
+    )
+    print(f"Processed {stats['frames']} frame(s) in {seconds:.1f}s ({stats['fps']:.1f} fps): "
+          f"full {stats['full']}, partial {stats['partial']}, reused {stats['reused']}")
+    if errors:
+        print("[WARNING] Stopped after a failed frame")
+    return stats
@@ -0,0 +1,194 @@
+"""
+アップロード用ディレクトリのバックグラウンドでの掃除（Web版）
+
+ページの読み込み時に同期的にディレクトリを走査する代わりに、1本のスレッドが定期的に
+
+- 最終更新から TTL を過ぎたファイルを削除する
+- 合計サイズが上限（quota）を超えていれば、古いものから削除する
+
+を行う。セッションが使っているファイルは track() で登録しておくと掃除の対象にならず、
+セッション終了時に release_session() でまとめて削除される。
+走査は各ディレクトリの直下のファイルだけ（result_cache/ や spill/ などのサブディレクトリは対象外）。
+
+環境変数:
+    POSTARIZATION_UPLOAD_TTL_SEC=3600         ファイルを残す時間
+    POSTARIZATION_UPLOAD_QUOTA_MB=1024        ディレクトリごとの合計サイズの上限
+    POSTARIZATION_JANITOR_INTERVAL_SEC=300    掃除の間隔
+"""
+import os
+import threading
+import time
+
+DEFAULT_TTL_SEC = 3600
+DEFAULT_QUOTA_MB = 1024
+DEFAULT_INTERVAL_SEC = 300
+
+
+class Janitor:
+    """ディレクトリを定期的に掃除するスレッド"""
+
+    def __init__(self, directories, ttl: float = DEFAULT_TTL_SEC, quota_bytes: int = DEFAULT_QUOTA_MB * 2**20,
+                 interval: float = DEFAULT_INTERVAL_SEC):
+        """
+        :param directories: 掃除するディレクトリのリスト
+        :param ttl: 最終更新からこの秒数を過ぎたファイルを削除する
+        :param quota_bytes: ディレクトリごとの合計サイズの上限
+        :param interval: 掃除の間隔（秒）
+        """
+        self.directories = list(directories)
+        self.ttl = ttl
+        self.quota_bytes = quota_bytes
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+        # セッションID -> そのセッションが使っているファイルのパス
+        self._tracked = {}
+
+        # 統計情報
+        self.runs = 0
+        self.files_reclaimed = 0
+        self.bytes_reclaimed = 0
+        self.last_run_seconds = 0.0
+
+    def start(self):
+        """掃除のスレッドを開始する（最初の掃除はすぐに行う）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="janitor", daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        self._closed = True
+        self._wake.set()
+
+    def track(self, session_id: str, path: str):
+        """セッションが使っているファイルを登録する（登録中は掃除の対象にならない）"""
+        with self._lock:
+            self._tracked.setdefault(session_id, set()).add(os.path.abspath(path))
+
+    def release_session(self, session_id: str):
+        """セッション終了時に、そのセッションのファイルを削除する"""
+        with self._lock:
+            paths = self._tracked.pop(session_id, set())
+            # 同じファイルを別のセッションが使っていれば残す
+            in_use = set().union(*self._tracked.values()) if self._tracked else set()
+        for path in paths - in_use:
+            self._remove(path)
+
+    def _protected(self) -> set:
+        with self._lock:
+            return set().union(*self._tracked.values()) if self._tracked else set()
+
+    def _remove(self, path: str, size: int = None) -> bool:
+        try:
+            if size is None:
+                size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return False
+        with self._lock:
+            self.files_reclaimed += 1
+            self.bytes_reclaimed += size
+        return True
+
+    def sweep(self, now: float = None):
+        """全ディレクトリを1回掃除する"""
+        start = time.perf_counter()
+        now = time.time() if now is None else now
+        protected = self._protected()
+        for directory in self.directories:
+            try:
+                self._sweep_directory(directory, now, protected)
+            except Exception as e:
+                print(f"[WARNING] Cleanup failed: {directory}: {e}")
+        with self._lock:
+            self.runs += 1
+            self.last_run_seconds = time.perf_counter() - start
+
+    def _sweep_directory(self, directory: str, now: float, protected: set):
+        if not os.path.isdir(directory):
+            return
+        files = []  # (mtime, size, path)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                path = os.path.abspath(entry.path)
+                if path in protected:
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        kept = []
+        for mtime, size, path in files:
+            if now - mtime > self.ttl:
+                if self._remove(path, size):
+                    print(f"[INFO] Cleaned up old file: {os.path.basename(path)}")
+            else:
+                kept.append((mtime, size, path))
+
+        # 上限を超えていれば古いものから削除
+        total = sum(size for _, size, _ in kept)
+        for mtime, size, path in sorted(kept):
+            if total <= self.quota_bytes:
+                break
+            if self._remove(path, size):
+                total -= size
+                print(f"[INFO] Cleaned up file over quota: {os.path.basename(path)}")
+
+    def _run(self):
+        while not self._closed:
+            self.sweep()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "files_reclaimed": self.files_reclaimed,
+                "bytes_reclaimed": self.bytes_reclaimed,
+                "last_run_seconds": self.last_run_seconds,
+                "tracked_sessions": len(self._tracked),
+            }
+
+    def prometheus_lines(self, prefix: str = "postarization") -> list:
+        """Prometheus のテキスト形式の行（HELP / TYPE を含む）"""
+        stats = self.stats()
+        return [
+            f"# HELP {prefix}_janitor_runs_total Cleanup passes over the upload directories",
+            f"# TYPE {prefix}_janitor_runs_total counter",
+            f"{prefix}_janitor_runs_total {stats['runs']}",
+            f"# HELP {prefix}_janitor_files_reclaimed_total Files deleted by the cleanup",
+            f"# TYPE {prefix}_janitor_files_reclaimed_total counter",
+            f"{prefix}_janitor_files_reclaimed_total {stats['files_reclaimed']}",
+            f"# HELP {prefix}_janitor_bytes_reclaimed_total Bytes freed by the cleanup",
+            f"# TYPE {prefix}_janitor_bytes_reclaimed_total counter",
+            f"{prefix}_janitor_bytes_reclaimed_total {stats['bytes_reclaimed']}",
+            f"# HELP {prefix}_janitor_last_run_seconds Duration of the last cleanup pass",
+            f"# TYPE {prefix}_janitor_last_run_seconds gauge",
+            f"{prefix}_janitor_last_run_seconds {stats['last_run_seconds']:.6f}",
+        ]
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_janitor(directories) -> Janitor:
+    """プロセス全体で共有する Janitor（最初の呼び出しで作成して開始）"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Janitor(
+                directories,
+                ttl=float(os.getenv("POSTARIZATION_UPLOAD_TTL_SEC", DEFAULT_TTL_SEC)),
+                quota_bytes=int(float(os.getenv("POSTARIZATION_UPLOAD_QUOTA_MB", DEFAULT_QUOTA_MB)) * 2**20),
+                interval=float(os.getenv("POSTARIZATION_JANITOR_INTERVAL_SEC", DEFAULT_INTERVAL_SEC)),
+            )
+            _shared.start()
+        return _shared
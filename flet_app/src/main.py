@@ -1,13 +1,28 @@
 import flet as ft
-from postarization import postarization
+from postarization import (
+    PARAMETER_SETS,
+    QUANTIZERS,
+    PostarizationPipeline,
+    RenderCancelled,
+    load_image,
+    profiling,
+    render_presets,
+)
+from postarization.quantize import DEFAULT_QUANTIZER
+from postarization.result_cache import image_digest, shared_cache
+from postarization.tiling import PILTileSource, render_tiled_rows, render_tiled_to_png
+from render_scheduler import RenderScheduler
+from preview_transport import PREVIEW_DIRNAME, PreviewTransport, assets_dir
+from session_memory import estimate_session_bytes, shared_manager
+from janitor import shared_janitor
 from PIL import Image, ImageFile
-import base64
-from io import BytesIO
 import threading
 import os
 import gc
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
 # 切り詰められた画像ファイルを読み込めるようにする
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -15,31 +30,61 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 # メモリ節約のための最大画像サイズ（幅または高さ）
 MAX_IMAGE_SIZE = 1280
 
-# 例として同ファイル内に定義しておきます
-PARAMETER_SETS = {
-    "default":    {"saturation": 2,   "level": 8,  "smooth_strength": 50, "edge_strength": 0.4},
-    "realistic":  {"saturation": 1.5, "level": 12, "smooth_strength": 70, "edge_strength": 0.3},
-    "anime_style":{"saturation": 2.5, "level": 6,  "smooth_strength": 40, "edge_strength": 0.5},
-    "monochrome": {"saturation": 0, "level": 4,  "smooth_strength": 80, "edge_strength": 0.2},
-    "novel_game": {"saturation": 1.6, "level": 8, "smooth_strength": 68, "edge_strength": 0.8},
-}
-
-def cleanup_old_files(directory: str, max_age_seconds: int = 3600):
-    """指定時間より古いファイルを削除"""
-    try:
-        if not os.path.exists(directory):
-            return
-        
-        current_time = time.time()
-        for filename in os.listdir(directory):
-            file_path = os.path.join(directory, filename)
-            if os.path.isfile(file_path):
-                file_age = current_time - os.path.getmtime(file_path)
-                if file_age > max_age_seconds:
-                    os.remove(file_path)
-                    print(f"[INFO] Cleaned up old file: {filename}")
-    except Exception as e:
-        print(f"[WARNING] Cleanup failed: {e}")
+# プログレッシブプレビューで最初に表示する縮小画像のサイズ（幅または高さ）
+PREVIEW_PROXY_SIZE = 320
+
+# テンプレート比較の一覧で使う画像のサイズ（幅または高さ）
+COMPARE_IMAGE_SIZE = 480
+
+# アップロード完了の通知（progress 1.0）のあと、ファイルが書き終わるのを待つ上限と確認の間隔（秒）
+# 通常は通知の時点で書き込みが終わっているため待たない
+UPLOAD_SETTLE_TIMEOUT = 5.0
+UPLOAD_POLL_INTERVAL = 0.05
+
+# エクスポート（元の解像度での変換）のタイルの大きさ
+# 平滑化の半径が元の解像度に合わせて大きくなり、のりしろも広がるため、プレビューより大きめにする
+EXPORT_TILE_SIZE = 2048
+
+# 縮小プレビューを表示してからフル解像度の描画を始めるまでの待ち時間（秒）
+# この間に次のスライダー変更が来たらフル解像度の描画は行わない
+FULL_RENDER_DELAY = 0.3
+
+# インポート直後に表示するテンプレートのサムネイルのサイズ（幅または高さ）
+THUMBNAIL_SIZE = 160
+
+# テンプレートの下ごしらえ（サムネイルとプレビュー解像度の変換）を行うスレッドの数（全セッションで共有）
+DEFAULT_PRESET_WORKERS = 2
+_preset_pool = None
+_preset_pool_lock = threading.Lock()
+
+
+def shared_preset_pool() -> ThreadPoolExecutor:
+    """プロセス全体で共有するテンプレートの下ごしらえ用のスレッドプール（POSTARIZATION_PRESET_WORKERS で本数を指定）"""
+    global _preset_pool
+    with _preset_pool_lock:
+        if _preset_pool is None:
+            workers = max(1, int(os.getenv("POSTARIZATION_PRESET_WORKERS", DEFAULT_PRESET_WORKERS)))
+            _preset_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="presets")
+        return _preset_pool
+
+
+def wait_for_upload(file_path: str, expected_size: int = None, timeout: float = UPLOAD_SETTLE_TIMEOUT) -> bool:
+    """
+    アップロードされたファイルが書き込み終わるのを待つ
+    期待するサイズが分かっていれば一致した時点で、分からなければサイズが変わらなくなった時点で完了とする
+    :return: 完了した場合はTrue
+    """
+    deadline = time.monotonic() + timeout
+    last_size = None
+    while True:
+        size = os.path.getsize(file_path) if os.path.exists(file_path) else None
+        if size is not None:
+            if size == expected_size or (expected_size is None and size == last_size and size > 0):
+                return True
+        if time.monotonic() >= deadline:
+            return False
+        last_size = size
+        time.sleep(UPLOAD_POLL_INTERVAL)
 
 def resize_image_if_needed(img: Image.Image, max_size: int = MAX_IMAGE_SIZE) -> Image.Image:
     """画像が大きすぎる場合はリサイズする"""
@@ -66,14 +111,32 @@ def main(page: ft.Page):
     page.scroll = ft.ScrollMode.AUTO
     page.padding = 10
 
-    # Web版の場合、起動時に古いファイルをクリーンアップ
-    if page.web:
-        upload_dir = os.getenv("FLET_UPLOAD_DIR", os.path.join(os.getcwd(), "storage", "temp"))
-        cleanup_old_files(upload_dir, max_age_seconds=3600)  # 1時間以上古いファイルを削除
+    # Web版の場合、古いアップロードとプレビューをバックグラウンドで定期的に削除（全セッションで1つ）
+    upload_dir = os.getenv("FLET_UPLOAD_DIR", os.path.join(os.getcwd(), "storage", "temp"))
+    janitor = shared_janitor([upload_dir, os.path.join(assets_dir(), PREVIEW_DIRNAME)]) if page.web else None
+    if janitor is not None:
+        profiling.register_collector(janitor.prometheus_lines)
+
+    # 変換結果のキャッシュ（全セッションで共有。Web版はセッション終了後も残るようディスクにも保存）
+    result_cache = shared_cache(os.path.join(upload_dir, "result_cache") if page.web else None)
+    source_digest = None  # 元画像の内容のハッシュ（キャッシュキー）
 
     original_image = None
     current_image = None
-    update_timer = None  # デバウンス用のタイマー
+    # 段階ごとの処理時間の計測（環境変数で有効にした場合のみ）
+    recorder = profiling.session_recorder(page.session_id) if profiling.enabled() else None
+
+    def measure(stage: str):
+        return recorder.measure(stage) if recorder is not None else nullcontext({})
+
+    # 段階ごとのキャッシュを持つフィルタ（スライダー操作時に上流の結果を再利用）
+    pipeline = PostarizationPipeline(recorder=recorder)
+    # 即時表示用の縮小画像のフィルタ
+    proxy_pipeline = PostarizationPipeline(recorder=recorder, name="proxy")
+    proxy_scale = 1.0  # 縮小画像 / 元画像 の倍率（1.0なら縮小版は使わない）
+    display_lock = threading.Lock()
+    # プレビューの送信（Web版は assets に書き出して URL だけを送る。デスクトップ版は base64）
+    transport = PreviewTransport(os.path.join(assets_dir(), PREVIEW_DIRNAME) if page.web else None)
 
     # ローディング（プログレスリング）
     loading_indicator = ft.ProgressRing(visible=False, width=50, height=50, color=ft.Colors.BLUE)
@@ -102,27 +165,127 @@ def main(page: ft.Page):
     smooth_value_field = ft.TextField(value=f"{slider_smooth.value:.0f}", width=80, height=40, text_align=ft.TextAlign.CENTER, disabled=True)
     edge_value_field = ft.TextField(value=f"{slider_edge.value:.2f}", width=80, height=40, text_align=ft.TextAlign.CENTER, disabled=True)
 
+    # 色の量子化の方式（uniform: チャンネルごとの等間隔 / kmeans: 画像に合わせたパレット）
+    quantizer_dropdown = ft.Dropdown(
+        value=DEFAULT_QUANTIZER,
+        options=[ft.dropdown.Option(name) for name in QUANTIZERS],
+        dense=True,
+        disabled=True,
+        expand=True,
+    )
+
     # 増減ボタン作成（step = (max - min) / divisions）
     satur_minus, satur_plus = None, None
     level_minus, level_plus = None, None
     smooth_minus, smooth_plus = None, None
     edge_minus, edge_plus = None, None
 
-    # スライダー値をBase64エンコード用に画像変換する関数
-    def pil_to_base64(img: Image.Image, fmt="JPEG") -> str:
-        buf = BytesIO()
-        img.save(buf, format=fmt)
-        return base64.b64encode(buf.getvalue()).decode("utf-8")
-
     # エクスポート用の処理
+    # プレビューは縮小した画像で行い、エクスポートは元のファイルを元の解像度でバックグラウンドで変換する
+    source_path = None  # 読み込んだ元のファイル（エクスポート時に元の解像度で読み直す）
+    export_generation = 0
+    export_progress = ft.ProgressBar(width=160, value=0, visible=False)
+    export_status = ft.Text("", size=12, visible=False)
+
+    def set_export_status(message: str, progress: float = None):
+        export_status.value = message
+        export_status.visible = bool(message)
+        export_progress.visible = progress is not None
+        export_progress.value = progress or 0
+        export_status.update()
+        export_progress.update()
+
+    def render_full_resolution(output_path: str, img_format: str, params: dict, path: str, preview_width: int,
+                               should_cancel):
+        """元のファイルを元の解像度でタイルごとに変換して書き出す（一時ファイルに書いてから置き換える）"""
+        with measure("export.load"):
+            full = load_image(path)
+        # 平滑化の半径はプレビュー（縮小画像）に対する値なので、元の解像度に合わせて拡大する
+        scale = full.width / preview_width
+        params = dict(params, smooth_strength=params["smooth_strength"] * scale)
+        source = PILTileSource(full)
+        print(f"[INFO] Exporting {full.width}x{full.height} (smooth_strength x{scale:.2f})")
+
+        def on_progress(done: int, total: int):
+            set_export_status(f"Exporting... {done}/{total}", done / total)
+
+        tmp_path = f"{output_path}.tmp"
+        try:
+            with measure("export.render"):
+                if img_format == "PNG":
+                    # 結果全体をメモリに持たず、行の順にPNGへ書き出す
+                    render_tiled_to_png(source, tmp_path, **params, tile_size=EXPORT_TILE_SIZE,
+                                        on_progress=on_progress, should_cancel=should_cancel)
+                else:
+                    result = Image.new("RGB", (full.width, full.height))
+                    y = 0
+                    for rows in render_tiled_rows(source, **params, tile_size=EXPORT_TILE_SIZE,
+                                                  on_progress=on_progress, should_cancel=should_cancel):
+                        result.paste(Image.fromarray(rows), (0, y))
+                        y += rows.shape[0]
+                    result.save(tmp_path, format=img_format)
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def start_export(output_path: str, img_format: str, export_url: str = None):
+        """エクスポートをバックグラウンドで開始する（Web版は完了後に export_url を開く）"""
+        nonlocal export_generation
+        ensure_resident()
+        if original_image is None:
+            print(f"[ERROR] No image to export")
+            return
+        export_generation += 1
+        generation = export_generation
+        params = current_params()
+        path = source_path
+        preview_width = original_image.width
+        fallback = current_image
+
+        def run():
+            try:
+                if path and os.path.exists(path):
+                    render_full_resolution(output_path, img_format, params, path, preview_width,
+                                           should_cancel=lambda: generation != export_generation)
+                elif fallback is not None:
+                    # 元のファイルが無い場合はプレビューの解像度で書き出す
+                    print(f"[WARNING] Source file not available, exporting preview resolution")
+                    fallback.save(output_path, format=img_format)
+                else:
+                    raise FileNotFoundError(path)
+            except RenderCancelled:
+                print(f"[DEBUG] Export cancelled")
+                return
+            except Exception as ex:
+                print(f"[ERROR] エクスポートに失敗しました: {ex}")
+                traceback.print_exc()
+                set_export_status("Export failed")
+                export_button.disabled = False
+                export_button.update()
+                return
+
+            print(f"[SUCCESS] Image exported to {output_path}")
+            if export_url is not None:
+                # Web版: 書き出したファイルを新しいタブで表示（右クリック保存用）
+                page.launch_url(export_url, web_window_name="_blank")
+                print(f"[INFO] Right-click on the image and select 'Save image as...' to download")
+                set_export_status("")
+            else:
+                set_export_status(f"Saved to {os.path.basename(output_path)}")
+            export_button.disabled = False
+            export_button.update()
+
+        export_button.disabled = True
+        export_button.update()
+        set_export_status("Exporting...", 0)
+        page.run_thread(run)
+
     def on_save_dialog_result(e: ft.FilePickerResultEvent):
         print(f"[DEBUG] on_save_dialog_result called")
         if not e.path:
             print(f"[DEBUG] Save dialog cancelled")
             return
-        if not current_image:
-            print(f"[ERROR] No image to save")
-            return
         try:
             save_path = e.path
             print(f"[DEBUG] Original path: {save_path}")
@@ -135,22 +298,22 @@ def main(page: ft.Page):
             print(f"[DEBUG] Final save path: {save_path}")
             
             # 拡張子から形式を判定
-            if save_path.lower().endswith('.png'):
-                img_format = 'PNG'
-            elif save_path.lower().endswith(('.jpg', '.jpeg')):
+            if save_path.lower().endswith(('.jpg', '.jpeg')):
                 img_format = 'JPEG'
+            elif save_path.lower().endswith('.webp'):
+                img_format = 'WEBP'
             else:
                 img_format = 'PNG'
             
             print(f"[DEBUG] Saving as format: {img_format}")
-            current_image.save(save_path, format=img_format)
-            print(f"[SUCCESS] Image saved successfully to {save_path}")
+            start_export(save_path, img_format)
         except Exception as ex:
             print(f"[ERROR] 画像の保存に失敗しました: {ex}")
             traceback.print_exc()
 
     def on_export_click(e):
         print(f"[DEBUG] on_export_click called")
+        ensure_resident()
         if not current_image:
             print(f"[ERROR] No image to export")
             return
@@ -175,21 +338,10 @@ def main(page: ft.Page):
                     allowed_extensions=["png", "jpg", "jpeg", ".webp"]
                 )
             else:
-                # Web版: 画像をbase64エンコードして新しいタブで表示（右クリック保存用）
-                print(f"[DEBUG] Creating image for web export")
-                
-                # 画像をbase64エンコード
-                buf = BytesIO()
-                current_image.save(buf, format="PNG")
-                buf.seek(0)
-                b64_data = base64.b64encode(buf.getvalue()).decode()
-                
-                # data URLとして画像を直接開く
-                data_url = f"data:image/png;base64,{b64_data}"
-                page.launch_url(data_url, web_window_name="_blank")
-                print(f"[DEBUG] Image opened in new tab")
-                print(f"[INFO] Right-click on the image and select 'Save image as...' to download")
-
+                # Web版: assets に元の解像度で書き出し、完了したらそのURLを新しいタブで表示
+                print(f"[DEBUG] Starting full-resolution export for web")
+                export_path, export_url = transport.reserve_export(default_filename)
+                start_export(export_path, "PNG", export_url)
 
         except Exception as ex:
             print(f"[ERROR] エクスポートに失敗しました: {ex}")
@@ -202,9 +354,206 @@ def main(page: ft.Page):
         disabled=True
     )
 
-    # デバウンス付きのプレビュー更新処理
-    def update_image_preview():
+    def set_original_image(img: Image.Image):
+        """元画像と、プログレッシブプレビュー用の縮小画像を設定"""
+        nonlocal original_image, proxy_scale, source_digest
+        original_image = img
+        source_digest = image_digest(img)
+        pipeline.set_image(img)
+
+        proxy = resize_image_if_needed(img, PREVIEW_PROXY_SIZE)
+        if proxy is img:
+            proxy_scale = 1.0
+            proxy_pipeline.clear()
+        else:
+            proxy_scale = proxy.width / img.width
+            proxy_pipeline.set_image(proxy)
+
+    # ---- セッションのメモリ管理（Web版: 全セッションの合計を予算内に収め、使われていないセッションはディスクへ退避） ----
+    memory_manager = shared_manager(os.path.join(upload_dir, "spill")) if page.web else None
+
+    def resident_bytes() -> int:
+        """このセッションが保持している画像のバイト数"""
+        total = pipeline.resident_bytes() + proxy_pipeline.resident_bytes()
+        for img in (original_image, current_image):
+            if img is not None:
+                total += img.width * img.height * len(img.getbands())
+        return total
+
+    def spill_paths() -> tuple:
+        return (
+            memory_manager.spill_path(page.session_id, "original"),
+            memory_manager.spill_path(page.session_id, "current"),
+        )
+
+    def remove_spill_files():
+        for path in spill_paths():
+            if os.path.exists(path):
+                os.remove(path)
+
+    def spill_images() -> int:
+        """元画像と変換結果をディスクへ退避してメモリを解放する（他のセッションのスレッドから呼ばれる）"""
+        nonlocal original_image, current_image
+        if original_image is None:
+            return 0
+        freed = resident_bytes()
+        original_path, current_path = spill_paths()
+        # 可逆・低圧縮（書き出しの速さを優先）
+        original_image.save(original_path, "PNG", compress_level=1)
+        if current_image is not None:
+            current_image.save(current_path, "PNG", compress_level=1)
+        original_image = None
+        current_image = None
+        pipeline.clear()
+        proxy_pipeline.clear()
+        return freed
+
+    session_memory = None
+    if memory_manager is not None:
+        session_memory = memory_manager.register(page.session_id, resident_bytes, spill_images)
+        profiling.register_collector(memory_manager.prometheus_lines)
+
+    def session_lock():
+        """描画・読み込みの間はこのセッションを退避させない"""
+        return session_memory.lock if session_memory is not None else nullcontext()
+
+    def ensure_resident():
+        """退避されていれば元画像と変換結果をディスクから読み戻す"""
         nonlocal current_image
+        if session_memory is None:
+            return
+        with session_memory.lock:
+            session_memory.touch()
+            if not session_memory.spilled:
+                return
+            original_path, current_path = spill_paths()
+            try:
+                with Image.open(original_path) as img:
+                    set_original_image(img.convert("RGB"))
+                if os.path.exists(current_path):
+                    with Image.open(current_path) as img:
+                        current_image = img.convert("RGB")
+            except Exception as ex:
+                print(f"[ERROR] 退避した画像の読み戻しに失敗しました: {ex}")
+                traceback.print_exc()
+                return
+            session_memory.mark_restored()
+            remove_spill_files()
+            print(f"[INFO] Restored session images from disk")
+        memory_manager.rebalance(active=session_memory)
+
+    def admit_image(width: int, height: int) -> bool:
+        """読み込む画像がメモリの予算に収まるか確認する（収まらなければ通知して断る）"""
+        if session_memory is None:
+            return True
+        session_memory.touch()
+        if memory_manager.admit(session_memory, estimate_session_bytes(width, height)):
+            return True
+        print(f"[WARNING] Image {width}x{height} rejected: memory budget exceeded")
+        page.open(ft.SnackBar(ft.Text("The server is busy. Please try again later or use a smaller image.")))
+        return False
+
+    def show_preview(img: Image.Image, stage_prefix: str = ""):
+        # 縮小プレビューとフル解像度は送る頻度が違うので、画質は別々に調整する
+        channel = "proxy" if stage_prefix else "full"
+        with measure(f"{stage_prefix}encode") as m:
+            data = transport.encode(img, channel)
+            m["bytes"] = len(data)
+        print(f"[DEBUG] Preview encoded, {len(data)} bytes (quality {transport.encoder(channel).quality})")
+        with measure(f"{stage_prefix}transport") as m:
+            payload = transport.publish(data, channel)
+            if transport.uses_files:
+                image_control.src = payload
+                image_control.src_base64 = None
+            else:
+                image_control.src_base64 = payload
+            image_control.update()
+            m["bytes"] = len(payload)
+        print(f"[DEBUG] Image control updated")
+
+    def render_job(params: dict, generation: int, should_cancel):
+        """
+        スケジューラのワーカースレッドで実行される描画処理
+        縮小画像で即時表示してから、フル解像度の結果を返す
+        """
+        with session_lock():
+            # 同じ画像・同じパラメータの結果があればそのまま返す
+            digest = source_digest
+            cached = result_cache.get(digest, params)
+            if cached is not None:
+                print(f"[DEBUG] Result cache hit (generation {generation})")
+                return cached
+
+            # 1) 縮小画像で即時プレビュー（平滑化の半径も縮小率に合わせる）
+            if proxy_scale < 1.0:
+                print(f"[DEBUG] Starting proxy postarization (generation {generation})...")
+                proxy_params = dict(params, smooth_strength=params["smooth_strength"] * proxy_scale)
+                proxy_image = proxy_pipeline.render(**proxy_params, should_cancel=should_cancel)
+                with display_lock:
+                    if not should_cancel():
+                        show_preview(proxy_image, stage_prefix="proxy.")
+
+                # スライダー操作が続いている間はフル解像度の描画を始めない
+                if scheduler.wait_superseded(generation, FULL_RENDER_DELAY):
+                    raise RenderCancelled("proxy")
+
+            # 2) フル解像度で描画（より新しい変更が来れば段階の間で打ち切られる）
+            print(f"[DEBUG] Starting full postarization (generation {generation})...")
+            result = pipeline.render(**params, should_cancel=should_cancel)
+            result_cache.put(digest, params, result)
+            return result
+
+    def on_render_result(generation: int, result: Image.Image):
+        """最新の世代のフル解像度の結果を表示"""
+        nonlocal current_image
+        with session_lock(), display_lock:
+            if scheduler.is_stale(generation):
+                return
+            current_image = result
+            print(f"[DEBUG] Postarization complete, image size: {current_image.size}")
+            show_preview(current_image)
+
+            # ローディング非表示
+            loading_indicator.visible = False
+            page.update()
+        print(f"[DEBUG] Render stats: {scheduler.stats()}")
+
+        # メモリ解放
+        gc.collect()
+        # 予算を超えていれば、使われていない他のセッションを退避
+        if memory_manager is not None:
+            memory_manager.rebalance(active=session_memory)
+
+    def on_render_failure(generation: int, error: Exception):
+        """最新の世代が結果を出せなかった場合はローディングを消す（表示中の画像はそのまま）"""
+        with display_lock:
+            if scheduler.is_stale(generation):
+                return
+            loading_indicator.visible = False
+            if not isinstance(error, RenderCancelled):
+                page.open(ft.SnackBar(ft.Text("Rendering failed. Please try different parameters.")))
+            page.update()
+
+    # セッションごとに1本のワーカーで描画する（古いパラメータの描画は破棄）
+    scheduler = RenderScheduler(render_job, on_render_result, debounce=0.05, recorder=recorder,
+                                on_failure=on_render_failure)
+
+    def slider_params(saturation, level, smooth_strength, edge_strength) -> dict:
+        """スライダーの値からフィルタのパラメータを作る"""
+        return {
+            "saturation": int(saturation),
+            "level": int(level),
+            "smooth_strength": int(smooth_strength),
+            "edge_strength": edge_strength,
+            "quantizer": quantizer_dropdown.value,
+        }
+
+    def current_params() -> dict:
+        return slider_params(slider_satur.value, slider_level.value, slider_smooth.value, slider_edge.value)
+
+    # プレビュー更新処理（描画はスケジューラに投入する）
+    def update_image_preview(immediate: bool = True):
+        ensure_resident()
         print(f"[DEBUG] update_image_preview called, original_image={original_image}")
         if original_image is None:
             print(f"[DEBUG] original_image is None, returning")
@@ -232,36 +581,15 @@ def main(page: ft.Page):
         smooth_value_field.update()
         edge_value_field.update()
 
-        # 画像処理
-        print(f"[DEBUG] Starting postarization...")
-        current_image = postarization(
-            original_image,
-            saturation=int(sat_val),
-            level=lev_val,
-            smooth_strength=int(smt_val),
-            edge_strength=edg_val
-        )
-        print(f"[DEBUG] Postarization complete, image size: {current_image.size}")
-        
-        # メモリ解放
-        gc.collect()
-        
-        base64_str = pil_to_base64(current_image, "JPEG")
-        print(f"[DEBUG] Base64 encoded, length: {len(base64_str)}")
-        image_control.src_base64 = base64_str
-        image_control.update()
-        print(f"[DEBUG] Image control updated")
-
-        # ローディング非表示
-        loading_indicator.visible = False
-        page.update()
+        scheduler.submit(current_params(), immediate=immediate)
 
     def on_slider_change(e):
-        nonlocal update_timer
-        if update_timer:
-            update_timer.cancel()
-        update_timer = threading.Timer(0.3, update_image_preview)
-        update_timer.start()
+        update_image_preview(immediate=False)
+
+    def on_quantizer_change(e):
+        update_image_preview()
+        # サムネイルとキャッシュは量子化の方式ごとに作り直す
+        start_preset_preparation()
 
     # TextFieldから値を設定する関数
     def on_value_field_submit(slider, field, min_val, max_val, is_int=False):
@@ -334,9 +662,13 @@ def main(page: ft.Page):
     # 画像インポート用ファイルピッカー
     upload_folder = "storage/temp"
     os.makedirs(upload_folder, exist_ok=True)
+    # アップロード中のファイル名 -> 期待するサイズ（バイト）と、選択ごとに増える番号
+    # 編集する画像は1枚なので、入るのは最後に選択した1ファイルだけ（前の選択のアップロードの通知は無視する）
+    pending_uploads = {}
+    import_generation = 0
     
     def on_file_pick_result(e: ft.FilePickerResultEvent):
-        nonlocal original_image, current_image
+        nonlocal original_image, current_image, import_generation, source_path
         print(f"[DEBUG] on_file_pick_result called: e.files={e.files}")
         if e.files and len(e.files) > 0:
             file_info = e.files[0]
@@ -345,13 +677,11 @@ def main(page: ft.Page):
             if file_info.path:
                 print(f"[DEBUG] Desktop mode: path={file_info.path}")
                 try:
-                    img = Image.open(file_info.path)
-                    print(f"[DEBUG] Image opened: size={img.size}, mode={img.mode}")
-                    
-                    if img.mode != "RGB":
-                        img = img.convert("RGB")
-                        print(f"[DEBUG] Converted to RGB")
-                    original_image = img
+                    # 大きな画像はデコード時に縮小して読み込む（EXIF の向きも反映）
+                    img = load_image(file_info.path, MAX_IMAGE_SIZE)
+                    print(f"[DEBUG] Image loaded: size={img.size}, mode={img.mode}")
+                    set_original_image(img)
+                    source_path = file_info.path
                     print(f"[DEBUG] original_image set successfully")
                     
                     # スライダー & Export ボタンを有効化
@@ -359,7 +689,9 @@ def main(page: ft.Page):
                     slider_level.disabled = False
                     slider_smooth.disabled = False
                     slider_edge.disabled = False
+                    quantizer_dropdown.disabled = False
                     export_button.disabled = False
+                    compare_button.disabled = False
 
                     # TextFieldも有効化
                     satur_value_field.disabled = False
@@ -386,9 +718,11 @@ def main(page: ft.Page):
                     slider_level.on_change = on_slider_change
                     slider_smooth.on_change = on_slider_change
                     slider_edge.on_change = on_slider_change
+                    quantizer_dropdown.on_change = on_quantizer_change
 
                     print(f"[DEBUG] Calling update_image_preview()")
                     update_image_preview()
+                    start_preset_preparation()
                     page.update()
                 except Exception as ex:
                     print(f"[ERROR] 画像の読み込みに失敗しました: {ex}")
@@ -396,68 +730,67 @@ def main(page: ft.Page):
             else:
                 # Web版: アップロードを開始
                 print(f"[DEBUG] Web mode: starting upload for {file_info.name}")
-                upload_list = []
-                for f in e.files:
-                    upload_list.append(
-                        ft.FilePickerUploadFile(
-                            f.name,
-                            upload_url=page.get_upload_url(f.name, 600),
-                        )
+                import_generation += 1
+                pending_uploads.clear()
+                pending_uploads[file_info.name] = (getattr(file_info, "size", None), import_generation)
+                file_picker_open.upload([
+                    ft.FilePickerUploadFile(
+                        file_info.name,
+                        upload_url=page.get_upload_url(file_info.name, 600),
                     )
-                file_picker_open.upload(upload_list)
+                ])
 
     def on_upload_complete(e: ft.FilePickerUploadEvent):
-        nonlocal original_image, current_image
-        print(f"[DEBUG] on_upload_complete called, e={e}")
-        
-        # アップロード完了後、ファイルが保存されるまで少し待つ
-        time.sleep(0.5)
-        
-        # アップロードされたファイルを読み込む
-        upload_list = file_picker_open.result.files if file_picker_open.result else None
-        if not upload_list or len(upload_list) == 0:
-            print(f"[ERROR] No files uploaded")
+        """アップロードの進捗の通知（progress が 1.0 になったファイルから読み込む）"""
+        if e.error:
+            print(f"[ERROR] Upload failed: {e.file_name}: {e.error}")
+            pending_uploads.pop(e.file_name, None)
             return
-            
-        file_name = upload_list[0].name
-        file_path = os.path.join(upload_folder, file_name)
-        print(f"[DEBUG] Looking for uploaded file at: {file_path}")
-        
-        # ファイルが完全にアップロードされるまで待つ
-        max_wait = 10
-        waited = 0
-        while not os.path.exists(file_path) and waited < max_wait:
-            time.sleep(0.1)
-            waited += 0.1
-        
-        if not os.path.exists(file_path):
-            print(f"[ERROR] Upload timeout - file not found: {file_path}")
+        if e.progress is None or e.progress < 1.0:
             return
-        
-        # ファイルが完全に書き込まれるまで追加で待つ
-        time.sleep(0.5)
-        
+        if e.file_name not in pending_uploads:
+            print(f"[WARNING] Unexpected upload completion: {e.file_name}")
+            return
+        expected_size, generation = pending_uploads.pop(e.file_name)
+        # セッションが終わるまで掃除の対象から外す（終了時に削除）
+        janitor.track(page.session_id, os.path.join(upload_folder, e.file_name))
+        # 通知のスレッドを塞がないよう、別のスレッドで読み込む
+        page.run_thread(load_uploaded_file, e.file_name, expected_size, generation)
+
+    def load_uploaded_file(file_name: str, expected_size, generation: int):
+        nonlocal original_image, current_image, source_path
+        print(f"[DEBUG] load_uploaded_file called: {file_name}")
+        file_path = os.path.join(upload_folder, file_name)
+
         # ファイルタイプの検証
         allowed_extensions = {'.jpg', '.jpeg', '.png', '.webp'}
         file_ext = os.path.splitext(file_name)[1].lower()
         if file_ext not in allowed_extensions:
             print(f"[ERROR] Invalid file type: {file_ext}")
             return
+
+        if not wait_for_upload(file_path, expected_size):
+            print(f"[ERROR] Upload incomplete - file not ready: {file_path}")
+            return
         
         try:
             print(f"[DEBUG] File found, opening: {file_path}")
             img = Image.open(file_path)
-            # 画像を完全に読み込む
-            img.load()
-            print(f"[DEBUG] Image loaded completely: size={img.size}, mode={img.mode}")
-            
-            # メモリ節約のためにリサイズ
-            img = resize_image_if_needed(img)
-                
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-                print(f"[DEBUG] Converted to RGB")
-            original_image = img
+            # デコードする前にヘッダーの大きさでメモリの予算を確認（リサイズ後の大きさで見積もる）
+            width, height = img.size
+            scale = min(1.0, MAX_IMAGE_SIZE / max(width, height))
+            if not admit_image(int(width * scale), int(height * scale)):
+                img.close()
+                return
+            # メモリ節約のため、デコード時に縮小して読み込む（EXIF の向きも反映）
+            img = load_image(img, MAX_IMAGE_SIZE)
+            print(f"[DEBUG] Image loaded: size={img.size}, mode={img.mode}")
+            # 読み込んでいる間に別の画像が選択されていれば捨てる
+            if generation != import_generation:
+                print(f"[DEBUG] Discarding {file_name}: a newer import was started")
+                return
+            set_original_image(img)
+            source_path = file_path
             print(f"[DEBUG] original_image set successfully")
             
             # スライダー & Export ボタンを有効化
@@ -465,7 +798,9 @@ def main(page: ft.Page):
             slider_level.disabled = False
             slider_smooth.disabled = False
             slider_edge.disabled = False
+            quantizer_dropdown.disabled = False
             export_button.disabled = False
+            compare_button.disabled = False
 
             # TextFieldも有効化
             satur_value_field.disabled = False
@@ -492,10 +827,12 @@ def main(page: ft.Page):
             slider_level.on_change = on_slider_change
             slider_smooth.on_change = on_slider_change
             slider_edge.on_change = on_slider_change
+            quantizer_dropdown.on_change = on_quantizer_change
 
             print(f"[DEBUG] Calling update_image_preview()")
             # 初回表示
             update_image_preview()
+            start_preset_preparation()
             page.update()
         except Exception as ex:
             print(f"[ERROR] 画像の読み込みに失敗しました: {ex}")
@@ -535,6 +872,167 @@ def main(page: ft.Page):
         # スライダー値を変更したので、すぐに更新処理を走らせる
         update_image_preview()
 
+    # ---- テンプレートの下ごしらえ ----
+    # インポート直後に全テンプレートをバックグラウンドで変換し、
+    # 1) 縮小画像のサムネイルを一覧に表示（クリックでそのテンプレートを適用）
+    # 2) プレビュー解像度の結果を result_cache に入れておく（テンプレートの切り替えはキャッシュから即時に表示）
+    thumbnail_strip = ft.Row(spacing=6, scroll=ft.ScrollMode.AUTO, visible=False)
+    preset_generation = 0
+
+    def template_params(preset_name: str) -> dict:
+        """apply_template したあとの current_params() と同じパラメータ（キャッシュキーを揃える）"""
+        params = PARAMETER_SETS[preset_name]
+        return slider_params(params["saturation"], params["level"], params["smooth_strength"], params["edge_strength"])
+
+    def show_thumbnails(results: dict):
+        tiles = []
+        for name, result in results.items():
+            payload = transport.publish(transport.encode(result, "thumbnail"), "thumbnail", keep=len(results))
+            image = ft.Image(width=THUMBNAIL_SIZE, height=THUMBNAIL_SIZE, fit=ft.ImageFit.CONTAIN)
+            if transport.uses_files:
+                image.src = payload
+            else:
+                image.src_base64 = payload
+            tiles.append(ft.Container(
+                content=ft.Column(
+                    controls=[image, ft.Text(name, size=12, text_align=ft.TextAlign.CENTER)],
+                    horizontal_alignment=ft.CrossAxisAlignment.CENTER,
+                    spacing=4,
+                ),
+                on_click=lambda e, name=name: apply_template(name),
+                tooltip=name,
+                ink=True,
+                padding=4,
+            ))
+        thumbnail_strip.controls = tiles
+        thumbnail_strip.visible = True
+        thumbnail_strip.update()
+
+    def prepare_presets(generation: int):
+        """全テンプレートのサムネイルとプレビュー解像度の結果を作る（共有のスレッドプールで実行）"""
+        def should_cancel():
+            return generation != preset_generation
+
+        if should_cancel():
+            return
+        with session_lock():
+            source, digest = original_image, source_digest
+        if source is None:
+            return
+        presets = {name: template_params(name) for name in PARAMETER_SETS}
+        quantizer = next(iter(presets.values()))["quantizer"]
+        try:
+            # 1) サムネイル（平滑化の半径も縮小率に合わせる）
+            small = resize_image_if_needed(source, THUMBNAIL_SIZE)
+            scale = small.width / source.width
+            scaled = {
+                name: dict(params, smooth_strength=params["smooth_strength"] * scale)
+                for name, params in presets.items()
+            }
+            with measure("thumbnails"):
+                thumbnails = render_presets(small, scaled, should_cancel=should_cancel, quantizer=quantizer)
+            with display_lock:
+                if should_cancel():
+                    return
+                show_thumbnails(thumbnails)
+
+            # 2) まだキャッシュにないテンプレートをプレビュー解像度で変換してキャッシュに入れる
+            missing = {name: params for name, params in presets.items() if result_cache.get(digest, params) is None}
+            if not missing:
+                return
+            with measure("presets"):
+                results = render_presets(source, missing, should_cancel=should_cancel, quantizer=quantizer)
+            for name, result in results.items():
+                result_cache.put(digest, missing[name], result)
+            print(f"[DEBUG] Prepared {len(results)} templates (generation {generation})")
+        except RenderCancelled:
+            return
+        except Exception as ex:
+            print(f"[ERROR] テンプレートの下ごしらえに失敗しました: {ex}")
+            traceback.print_exc()
+
+    def start_preset_preparation():
+        """読み込んだ画像のテンプレートの下ごしらえを始める（前の画像の分は打ち切る）"""
+        nonlocal preset_generation
+        preset_generation += 1
+        shared_preset_pool().submit(prepare_presets, preset_generation)
+
+    # ---- テンプレートの比較 ----
+    compare_grid = ft.GridView(max_extent=260, child_aspect_ratio=0.85, spacing=8, run_spacing=8, expand=True)
+    compare_dialog = ft.AlertDialog(
+        title=ft.Text("Compare templates"),
+        content=ft.Container(content=compare_grid, width=820, height=600),
+        actions=[ft.TextButton("Close", on_click=lambda e: page.close(compare_dialog))],
+    )
+    compare_generation = 0
+
+    def on_compare_select(preset_name: str):
+        page.close(compare_dialog)
+        apply_template(preset_name)
+
+    def render_comparison(generation: int):
+        """全テンプレートを縮小画像でまとめて変換し、一覧に表示する（共通の段階は1回だけ計算）"""
+        source = original_image
+        if source is None:
+            return
+        small = resize_image_if_needed(source, COMPARE_IMAGE_SIZE)
+        # 平滑化の半径も縮小率に合わせる
+        scale = small.width / source.width
+        presets = {
+            name: dict(params, smooth_strength=params["smooth_strength"] * scale)
+            for name, params in PARAMETER_SETS.items()
+        }
+        try:
+            with measure("compare"):
+                results = render_presets(small, presets, should_cancel=lambda: generation != compare_generation,
+                                         quantizer=quantizer_dropdown.value)
+        except RenderCancelled:
+            return
+        except Exception as ex:
+            print(f"[ERROR] テンプレートの比較に失敗しました: {ex}")
+            traceback.print_exc()
+            return
+
+        tiles = []
+        for name, result in results.items():
+            payload = transport.publish(transport.encode(result, "compare"), "compare", keep=len(results))
+            image = ft.Image(fit=ft.ImageFit.CONTAIN, expand=True)
+            if transport.uses_files:
+                image.src = payload
+            else:
+                image.src_base64 = payload
+            tiles.append(ft.Container(
+                content=ft.Column(
+                    controls=[image, ft.Text(name, size=12, text_align=ft.TextAlign.CENTER)],
+                    horizontal_alignment=ft.CrossAxisAlignment.CENTER,
+                    spacing=4,
+                ),
+                on_click=lambda e, name=name: on_compare_select(name),
+                ink=True,
+                padding=4,
+            ))
+        if generation != compare_generation:
+            return
+        compare_grid.controls = tiles
+        compare_grid.update()
+
+    def on_compare_click(e):
+        nonlocal compare_generation
+        ensure_resident()
+        if original_image is None:
+            return
+        compare_generation += 1
+        compare_grid.controls = [ft.ProgressRing(width=40, height=40)]
+        page.open(compare_dialog)
+        page.run_thread(render_comparison, compare_generation)
+
+    compare_button = ft.OutlinedButton(
+        text="Compare all",
+        icon=ft.Icons.GRID_VIEW,
+        on_click=on_compare_click,
+        disabled=True,
+    )
+
     # ---- レイアウト構築 ----
     # 増減ボタンの作成
     satur_minus, satur_plus = create_slider_controls(slider_satur, 0.0, 3.0, 30, 0.1)
@@ -571,6 +1069,8 @@ def main(page: ft.Page):
                     ft.Row([smooth_minus, slider_smooth, smooth_plus, smooth_value_field], expand=True),
                     ft.Text("edge_strength: エッジ保持の強さ (0.0-10.0)", size=12),
                     ft.Row([edge_minus, slider_edge, edge_plus, edge_value_field], expand=True),
+                    ft.Text("quantizer: 色の量子化の方式 (uniform / kmeans)", size=12),
+                    ft.Row([quantizer_dropdown], expand=True),
                 ],
             ),
             # テンプレートセクション（折りたたみ可能）
@@ -579,7 +1079,9 @@ def main(page: ft.Page):
                 initially_expanded=True,
                 controls_padding=ft.padding.only(left=10, right=10, bottom=10),
                 controls=[
+                    thumbnail_strip,
                     template_buttons,
+                    compare_button,
                 ],
             ),
             # アクションセクション（折りたたみ可能）
@@ -596,6 +1098,11 @@ def main(page: ft.Page):
                         spacing=5,
                         alignment=ft.MainAxisAlignment.CENTER,
                     ),
+                    ft.Row(
+                        controls=[export_progress, export_status],
+                        spacing=5,
+                        alignment=ft.MainAxisAlignment.CENTER,
+                    ),
                 ],
             ),
         ],
@@ -622,6 +1129,23 @@ def main(page: ft.Page):
         vertical_alignment=ft.CrossAxisAlignment.START,
     )
 
+    # セッション終了時に描画ワーカーを停止
+    def on_session_close(e):
+        nonlocal export_generation, preset_generation
+        export_generation += 1  # 実行中のエクスポートを打ち切る
+        preset_generation += 1  # テンプレートの下ごしらえを打ち切る
+        scheduler.shutdown()
+        transport.close()
+        if session_memory is not None:
+            memory_manager.unregister(page.session_id)
+            remove_spill_files()
+        if janitor is not None:
+            janitor.release_session(page.session_id)
+        if recorder is not None:
+            profiling.release_session(page.session_id)
+
+    page.on_close = on_session_close
+
     page.overlay.append(file_picker_open)
     page.overlay.append(file_picker_save)
 
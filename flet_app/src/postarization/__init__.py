@@ -0,0 +1,53 @@
+__version__ = "1.1.2"
+
+from .pipeline import (
+    CHANNEL_ORDERS,
+    PostarizationPipeline,
+    RenderCancelled,
+    extract_edges,
+    overlay,
+    postarization,
+    postarization_array,
+    posterize,
+    posterize_lut,
+    quantize,
+    render_presets,
+    render_presets_array,
+    render_stages,
+    saturate,
+    saturate_hsv,
+    saturation_lut,
+    smooth,
+)
+from .loader import load_image
+from .presets import PARAMETER_RANGES, PARAMETER_SETS
+from .quantize import QUANTIZERS, Palette
+from .smoothing import QUALITY_FACTORS
+from . import profiling
+
+__all__ = [
+    "CHANNEL_ORDERS",
+    "PARAMETER_RANGES",
+    "PARAMETER_SETS",
+    "Palette",
+    "PostarizationPipeline",
+    "QUALITY_FACTORS",
+    "QUANTIZERS",
+    "RenderCancelled",
+    "extract_edges",
+    "load_image",
+    "overlay",
+    "postarization",
+    "postarization_array",
+    "posterize",
+    "posterize_lut",
+    "profiling",
+    "quantize",
+    "render_presets",
+    "render_presets_array",
+    "render_stages",
+    "saturate",
+    "saturate_hsv",
+    "saturation_lut",
+    "smooth",
+]
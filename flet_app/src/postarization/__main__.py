@@ -0,0 +1,27 @@
+"""
+コマンドラインの入り口（flet_app/src で実行）
+
+    python -m postarization serve [...]   HTTP サーバーを起動する（server.py）
+    python -m postarization bench [...]   ベンチマークを実行する（bench.py）
+"""
+import sys
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    commands = ("serve", "bench")
+    if not argv or argv[0] not in commands:
+        print(f"usage: python -m postarization {{{','.join(commands)}}} [...]", file=sys.stderr)
+        sys.exit(2)
+
+    command, rest = argv[0], argv[1:]
+    if command == "serve":
+        from .server import main as serve_main
+        serve_main(rest)
+    else:
+        from .bench import main as bench_main
+        bench_main(rest)
+
+
+if __name__ == "__main__":
+    main()
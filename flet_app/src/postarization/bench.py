@@ -0,0 +1,457 @@
+"""
+postarization のベンチマーク
+
+使い方（flet_app/src で実行）:
+    python -m postarization.bench suite --json bench.json
+    python -m postarization.bench compare old.json new.json
+    python -m postarization.bench lut
+    python -m postarization.bench tiling --size 4 --tile-size 512
+    python -m postarization.bench quality --size 1.2
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from . import __version__
+from .pipeline import extract_edges, overlay, posterize, render_stages, saturate, smooth
+from .presets import PARAMETER_RANGES, PARAMETER_SETS
+from .smoothing import QUALITY_FACTORS
+from .tiling import verify_tiling
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_SIZES = [0.3, 1.0, 4.0, 12.0, 24.0]
+
+
+# ---- 比較用: LUT 化する前の実装 ----
+
+def legacy_saturate(cv_image: np.ndarray, saturation) -> np.ndarray:
+    # 整数倍率だと uint8 のまま桁あふれしていたため、比較は float で行う
+    hsv = cv2.cvtColor(cv_image, cv2.COLOR_BGR2HSV)
+    hsv[..., 1] = np.clip(hsv[..., 1] * float(saturation), 0, 255)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+
+
+def legacy_posterize(smoothed: np.ndarray, level) -> np.ndarray:
+    step = 256 // level
+    poster = (smoothed // step) * step
+    return np.clip(poster, 0, 255).astype(np.uint8)
+
+
+# ---- 計測 ----
+
+def random_image(megapixels: float, seed: int = 0) -> np.ndarray:
+    """指定した画素数（4:3）のランダムなBGR画像を作る"""
+    height = max(1, int(round((megapixels * 1e6 * 3 / 4) ** 0.5)))
+    width = max(1, int(round(height * 4 / 3)))
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+
+def measure(fn, *args, repeat: int = 5) -> dict:
+    """
+    関数の実行時間とピークの追加メモリを計測する
+    :return: {"ms": 最速の実行時間, "peak_alloc_bytes": 実行中に増えたメモリのピーク}
+    """
+    fn(*args)  # ウォームアップ（LUT のキャッシュなど）
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"ms": best * 1000, "peak_alloc_bytes": max(0, peak - base)}
+
+
+def bench_lut(sizes, saturation=1.6, level=8, repeat: int = 5) -> list:
+    """LUT 版と旧実装の 彩度・ポスタリゼーション 段階を比較する"""
+    results = []
+    for megapixels in sizes:
+        image = random_image(megapixels)
+        frame_bytes = image.nbytes
+        cases = [
+            ("saturate", "legacy", legacy_saturate, saturation),
+            ("saturate", "lut", saturate, saturation),
+            ("posterize", "legacy", legacy_posterize, level),
+            ("posterize", "lut", posterize, level),
+        ]
+        for stage, impl, fn, value in cases:
+            m = measure(fn, image, value, repeat=repeat)
+            results.append({
+                "stage": stage,
+                "impl": impl,
+                "megapixels": megapixels,
+                "ms": m["ms"],
+                "ms_per_mp": m["ms"] / megapixels,
+                "peak_alloc_bytes": m["peak_alloc_bytes"],
+                # 画像何枚分のメモリを一時的に確保したか
+                "peak_alloc_frames": m["peak_alloc_bytes"] / frame_bytes,
+            })
+    return results
+
+
+def natural_image(megapixels: float, seed: int = 0) -> np.ndarray:
+    """ランダムノイズをぼかした、なだらかな色の変化を持つRGB画像を作る"""
+    image = cv2.GaussianBlur(random_image(megapixels, seed), (0, 0), 8)
+    return cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX)
+
+
+def scene_image(megapixels: float, seed: int = 0) -> np.ndarray:
+    """グラデーションの背景に図形を重ねてノイズを加えた、輪郭のはっきりしたRGB画像を作る"""
+    height = max(1, int(round((megapixels * 1e6 * 3 / 4) ** 0.5)))
+    width = max(1, int(round(height * 4 / 3)))
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    image = np.empty((height, width, 3), dtype=np.float32)
+    image[..., 0] = xx / width * 200
+    image[..., 1] = yy / height * 180
+    image[..., 2] = 100
+    scale = min(height, width) / 960
+    for _ in range(60):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        if rng.random() < 0.5:
+            cv2.circle(image, (x, y), int(rng.integers(10, 150) * scale) + 1, color, -1)
+        else:
+            size = (int(rng.integers(10, 300) * scale) + 1, int(rng.integers(10, 200) * scale) + 1)
+            cv2.rectangle(image, (x, y), (x + size[0], y + size[1]), color, -1)
+    image = cv2.GaussianBlur(image, (0, 0), 1.2) + rng.normal(0, 6, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def bench_quality(image: np.ndarray, cases: dict = None, repeat: int = 5) -> list:
+    """
+    平滑化の quality ごとの速度と、exact に対する誤差を計測する
+    :param image: 入力画像（RGB）
+    :param cases: {名前: パラメータ}（省略時はプリセットとスライダーの端の値）
+    :return: [{"case", "quality", "smooth_ms", "render_ms", "mae", "max_abs_diff", "psnr", "output_mismatch"}, ...]
+    """
+    bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    results = []
+    for case, params in (cases or parameter_cases()).items():
+        saturated = saturate(bgr, params["saturation"])
+        exact_smoothed = smooth(saturated, params["smooth_strength"], params["edge_strength"])
+        exact_output = render_stages(bgr, **params)
+        for quality in QUALITY_FACTORS:
+            smoothed = smooth(saturated, params["smooth_strength"], params["edge_strength"], quality)
+            output = render_stages(bgr, **params, quality=quality)
+            diff = np.abs(smoothed.astype(np.int16) - exact_smoothed)
+            mse = float(np.mean(diff.astype(np.float64) ** 2))
+            results.append({
+                "case": case,
+                "quality": quality,
+                "smooth_ms": measure(smooth, saturated, params["smooth_strength"], params["edge_strength"],
+                                     quality, repeat=repeat)["ms"],
+                "render_ms": measure(lambda: render_stages(bgr, **params, quality=quality), repeat=repeat)["ms"],
+                # 平滑化の出力の誤差
+                "mae": float(diff.mean()),
+                "max_abs_diff": int(diff.max()),
+                "psnr": float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse),
+                # 最終出力で値が変わった画素の割合（ポスタリゼーションの段の境目をまたぐと大きく変わる）
+                "output_mismatch": float(np.any(output != exact_output, axis=2).mean()),
+            })
+    return results
+
+
+def print_quality_table(results: list):
+    print(f"{'case':<22} {'quality':<9} {'smooth ms':>10} {'render ms':>10} {'MAE':>6} {'max':>4} "
+          f"{'PSNR':>6} {'changed':>8}")
+    for r in results:
+        print(
+            f"{r['case']:<22} {r['quality']:<9} {r['smooth_ms']:>10.1f} {r['render_ms']:>10.1f} {r['mae']:>6.2f} "
+            f"{r['max_abs_diff']:>4} {r['psnr']:>6.1f} {r['output_mismatch']:>7.1%}"
+        )
+
+
+# ---- ベンチマークスイート ----
+
+def parameter_cases(preset_names=None, extremes: bool = True) -> dict:
+    """
+    計測するパラメータの組み合わせ
+    全プリセットに加え、default プリセットの各パラメータをGUIで入力できる最小値・最大値にしたものを含める
+    """
+    names = preset_names or list(PARAMETER_SETS)
+    cases = {name: dict(PARAMETER_SETS[name]) for name in names}
+    if extremes:
+        for param, (low, high) in PARAMETER_RANGES.items():
+            cases[f"{param}_min"] = dict(PARAMETER_SETS["default"], **{param: low})
+            cases[f"{param}_max"] = dict(PARAMETER_SETS["default"], **{param: high})
+    return cases
+
+
+def _reset_peak_rss() -> bool:
+    """Linux ではプロセスのピークRSS (VmHWM) をリセットできる"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes() -> int:
+    """プロセスのピークRSS（バイト）"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS はバイト、Linux は KB
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _stage_functions(image: Image.Image, params: dict):
+    """postarization の各段階を (名前, 関数) の順に返す。各関数は前段の出力を受け取る"""
+    return [
+        # postarization() と同じく RGB のまま処理する（BGR との入れ替えはしない）
+        ("to_array", lambda _: np.asarray(image)),
+        ("saturate", lambda x: saturate(x, params["saturation"], "RGB")),
+        ("smooth", lambda x: smooth(x, params["smooth_strength"], params["edge_strength"])),
+        ("posterize", lambda x: posterize(x, params["level"])),
+        ("edges", lambda x: (x, extract_edges(x, "RGB"))),
+        ("overlay", lambda x: overlay(*x)),
+        ("to_pil", lambda x: Image.fromarray(x)),
+    ]
+
+
+def bench_case(image: Image.Image, params: dict, repeat: int = 1) -> dict:
+    """
+    1つの画像・パラメータについて各段階の時間とメモリを計測する
+    :return: {"stages": {段階名: {"ms", "peak_alloc_bytes"}}, "total_ms", "peak_alloc_bytes", "peak_rss_bytes"}
+    """
+    stages = _stage_functions(image, params)
+    best = {name: float("inf") for name, _ in stages}
+    rss_reset = _reset_peak_rss()
+    for _ in range(repeat):
+        value = None
+        for name, fn in stages:
+            start = time.perf_counter()
+            value = fn(value)
+            best[name] = min(best[name], time.perf_counter() - start)
+    peak_rss = peak_rss_bytes() if rss_reset or resource is not None else 0
+
+    # メモリは別に1回だけ計測する（tracemalloc は時間計測に影響するため）
+    alloc = {}
+    tracemalloc.start()
+    try:
+        value = None
+        for name, fn in stages:
+            base, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            value = fn(value)
+            _, peak = tracemalloc.get_traced_memory()
+            alloc[name] = max(0, peak - base)
+        _, total_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "stages": {name: {"ms": best[name] * 1000, "peak_alloc_bytes": alloc[name]} for name, _ in stages},
+        "total_ms": sum(best.values()) * 1000,
+        "peak_alloc_bytes": total_peak,
+        "peak_rss_bytes": peak_rss,
+    }
+
+
+def run_suite(sizes=None, preset_names=None, extremes: bool = True, repeat: int = 1, progress=print) -> dict:
+    """
+    画像サイズ × パラメータの組み合わせ ごとに各段階を計測する
+    :return: 実行環境の情報と計測結果（JSONに書き出せる辞書）
+    """
+    sizes = sizes or DEFAULT_SIZES
+    cases = parameter_cases(preset_names, extremes)
+    results = []
+    for megapixels in sizes:
+        image = Image.fromarray(natural_image(megapixels))
+        for case_name, params in cases.items():
+            measured = bench_case(image, params, repeat=repeat)
+            results.append(dict(
+                {"megapixels": megapixels, "width": image.width, "height": image.height,
+                 "case": case_name, "params": params},
+                **measured,
+            ))
+            if progress:
+                progress(f"{megapixels:>6.1f} MP  {case_name:<22} {measured['total_ms']:>10.1f} ms")
+        del image
+
+    return {
+        "version": __version__,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "opencv_threads": cv2.getNumThreads(),
+        },
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare_reports(old: dict, new: dict, threshold: float = 0.10) -> list:
+    """
+    2つのスイート結果を比較して、threshold（割合）以上遅くなった段階を返す
+    :return: [{"megapixels", "case", "stage", "old_ms", "new_ms", "change"}]
+    """
+    old_index = {(r["megapixels"], r["case"]): r for r in old["results"]}
+    regressions = []
+    for r in new["results"]:
+        before = old_index.get((r["megapixels"], r["case"]))
+        if before is None:
+            continue
+        for stage, timing in r["stages"].items():
+            old_ms = before["stages"].get(stage, {}).get("ms")
+            if not old_ms:
+                continue
+            change = timing["ms"] / old_ms - 1
+            if change >= threshold:
+                regressions.append({
+                    "megapixels": r["megapixels"], "case": r["case"], "stage": stage,
+                    "old_ms": old_ms, "new_ms": timing["ms"], "change": change,
+                })
+    return regressions
+
+
+def print_suite(report: dict):
+    stage_names = list(report["results"][0]["stages"]) if report["results"] else []
+    header = f"{'MP':>6} {'case':<22}" + "".join(f"{name:>10}" for name in stage_names) + f"{'total':>10}{'RSS MB':>9}"
+    print(header)
+    for r in report["results"]:
+        row = f"{r['megapixels']:>6.1f} {r['case']:<22}"
+        row += "".join(f"{r['stages'][name]['ms']:>10.1f}" for name in stage_names)
+        row += f"{r['total_ms']:>10.1f}{r['peak_rss_bytes'] / 2**20:>9.0f}"
+        print(row)
+
+
+def print_table(results: list):
+    print(f"{'stage':<10} {'impl':<7} {'MP':>6} {'ms':>9} {'ms/MP':>8} {'peak alloc':>12}")
+    for r in results:
+        print(
+            f"{r['stage']:<10} {r['impl']:<7} {r['megapixels']:>6.1f} {r['ms']:>9.2f} "
+            f"{r['ms_per_mp']:>8.2f} {r['peak_alloc_frames']:>10.2f}x"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m postarization.bench", description="postarization のベンチマーク")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    suite = sub.add_parser("suite", help="画像サイズ × プリセット・スライダーの端の値 で各段階を計測（デフォルト）")
+    suite.add_argument("--sizes", type=float, nargs="+", default=DEFAULT_SIZES, help="画像サイズ（メガピクセル）")
+    suite.add_argument("--presets", nargs="+", default=None, choices=list(PARAMETER_SETS), help="計測するプリセット")
+    suite.add_argument("--no-extremes", action="store_true", help="スライダーの端の値を計測しない")
+    suite.add_argument("--repeat", type=int, default=1, help="計測の繰り返し回数（最速の値を採用）")
+    suite.add_argument("--json", dest="json_path", default=None, help="結果をJSONで書き出すパス（- で標準出力）")
+
+    compare = sub.add_parser("compare", help="2つのスイート結果（JSON）を比較して遅くなった段階を表示")
+    compare.add_argument("old", help="基準の結果")
+    compare.add_argument("new", help="比較する結果")
+    compare.add_argument("--threshold", type=float, default=0.10, help="この割合以上遅くなったら報告（デフォルト: 0.10）")
+
+    lut = sub.add_parser("lut", help="LUT 版と旧実装の 彩度・ポスタリゼーション を比較")
+    lut.add_argument("--sizes", type=float, nargs="+", default=[1.0, 4.0, 12.0], help="画像サイズ（メガピクセル）")
+    lut.add_argument("--repeat", type=int, default=5, help="計測の繰り返し回数")
+    lut.add_argument("--json", dest="json_path", default=None, help="結果をJSONで書き出すパス（- で標準出力）")
+
+    tiling = sub.add_parser("tiling", help="タイル処理の結果をタイルなしの結果と比較")
+    tiling.add_argument("--size", type=float, default=4.0, help="画像サイズ（メガピクセル）")
+    tiling.add_argument("--tile-size", type=int, default=512, help="タイルの大きさ（ピクセル）")
+    tiling.add_argument("--smooth-strength", type=float, default=50, help="平滑化の強さ")
+
+    quality = sub.add_parser("quality", help="平滑化の quality ごとの速度と exact に対する誤差を計測")
+    quality.add_argument("--size", type=float, default=1.2, help="画像サイズ（メガピクセル）")
+    quality.add_argument("--image", default=None, help="計測に使う画像ファイル（省略時は図形を描いた合成画像）")
+    quality.add_argument("--presets", nargs="+", default=None, choices=list(PARAMETER_SETS), help="計測するプリセット")
+    quality.add_argument("--no-extremes", action="store_true", help="スライダーの端の値を計測しない")
+    quality.add_argument("--repeat", type=int, default=5, help="計測の繰り返し回数")
+    quality.add_argument("--json", dest="json_path", default=None, help="結果をJSONで書き出すパス（- で標準出力）")
+
+    # サブコマンドを省略した場合は suite として扱う
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or (argv[0] not in sub.choices and argv[0] not in ("-h", "--help")):
+        argv.insert(0, "suite")
+    args = parser.parse_args(argv)
+
+    if args.command == "suite":
+        to_stdout = args.json_path == "-"
+        report = run_suite(
+            args.sizes, args.presets, extremes=not args.no_extremes, repeat=args.repeat,
+            progress=None if to_stdout else print,
+        )
+        if to_stdout:
+            print(json.dumps(report, indent=2))
+            return
+        print_suite(report)
+        if args.json_path:
+            with open(args.json_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+    elif args.command == "compare":
+        with open(args.old, encoding="utf-8") as f:
+            old = json.load(f)
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+        regressions = compare_reports(old, new, args.threshold)
+        for r in regressions:
+            print(f"{r['megapixels']:>6.1f} MP  {r['case']:<22} {r['stage']:<10} "
+                  f"{r['old_ms']:>9.1f} -> {r['new_ms']:>9.1f} ms ({r['change']:+.0%})")
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
+    elif args.command == "lut":
+        results = bench_lut(args.sizes, repeat=args.repeat)
+        if args.json_path == "-":
+            print(json.dumps(results, indent=2))
+            return
+        print_table(results)
+        if args.json_path:
+            with open(args.json_path, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+    elif args.command == "tiling":
+        image = natural_image(args.size)
+        result = verify_tiling(image, smooth_strength=args.smooth_strength, tile_size=args.tile_size)
+        print(json.dumps(result, indent=2))
+    elif args.command == "quality":
+        if args.image:
+            with Image.open(args.image) as image:
+                image = np.asarray(image.convert("RGB"))
+        else:
+            image = scene_image(args.size)
+        cases = parameter_cases(args.presets, extremes=not args.no_extremes)
+        results = bench_quality(image, cases, repeat=args.repeat)
+        if args.json_path == "-":
+            print(json.dumps(results, indent=2))
+            return
+        print_quality_table(results)
+        if args.json_path:
+            with open(args.json_path, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,490 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from .quantize import DEFAULT_QUANTIZER, Palette, check_quantizer
+from .smoothing import DEFAULT_QUALITY, smooth_image
+
+
+# パイプラインごとに保持する kmeans のパレットの数
+PALETTE_CACHE_SIZE = 16
+
+# 配列のチャンネルの並び
+# 平滑化・ポスタリゼーション・重ね合わせはチャンネルごと（または3チャンネルで対称）の処理なので並びに依存せず、
+# 色空間の変換（HSV, グレースケール, Lab）だけを並びに合わせて選ぶ。
+# 配列を受け取る関数の既定は従来どおり "BGR"。PIL の画像は "RGB" のまま処理して入れ替えのコピーを省く
+CHANNEL_ORDERS = ("BGR", "RGB")
+DEFAULT_CHANNEL_ORDER = "BGR"
+
+_TO_HSV = {"BGR": cv2.COLOR_BGR2HSV, "RGB": cv2.COLOR_RGB2HSV}
+_FROM_HSV = {"BGR": cv2.COLOR_HSV2BGR, "RGB": cv2.COLOR_HSV2RGB}
+_TO_GRAY = {"BGR": cv2.COLOR_BGR2GRAY, "RGB": cv2.COLOR_RGB2GRAY}
+
+
+def check_channel_order(channel_order: str):
+    if channel_order not in CHANNEL_ORDERS:
+        raise ValueError(f"Unknown channel order: {channel_order!r} (expected one of {', '.join(CHANNEL_ORDERS)})")
+
+
+def check_image_array(array: np.ndarray):
+    """入力の配列が uint8 の3チャンネル画像（shape=(高さ, 幅, 3)）であることを確かめる"""
+    if not isinstance(array, np.ndarray) or array.dtype != np.uint8 or array.ndim != 3 or array.shape[2] != 3:
+        shape = getattr(array, "shape", None)
+        dtype = getattr(array, "dtype", type(array).__name__)
+        raise ValueError(f"Expected a uint8 array of shape (height, width, 3), got {dtype} {shape}")
+
+
+def check_output(out: np.ndarray, shape: tuple):
+    """呼び出し側が渡した出力先の配列を確かめる（OpenCV が黙って別の配列を確保しないように）"""
+    if not isinstance(out, np.ndarray) or out.dtype != np.uint8 or out.shape != shape:
+        raise ValueError(f"out must be a uint8 array of shape {shape}, "
+                         f"got {getattr(out, 'dtype', None)} {getattr(out, 'shape', None)}")
+    if not out.flags.c_contiguous or not out.flags.writeable:
+        raise ValueError("out must be a writeable C-contiguous array")
+
+
+# ---- ルックアップテーブル ----
+
+@lru_cache(maxsize=64)
+def saturation_lut(saturation) -> np.ndarray:
+    """
+    HSV画像の S チャンネルだけに倍率をかける 256 エントリのLUT（H, V はそのまま）
+    :param saturation: 彩度の倍率
+    :return: cv2.LUT 用のテーブル（shape=(1, 256, 3), uint8）
+    """
+    identity = np.arange(256, dtype=np.float64)
+    lut = np.empty((1, 256, 3), dtype=np.uint8)
+    lut[0, :, 0] = identity
+    lut[0, :, 1] = np.clip(identity * saturation, 0, 255)
+    lut[0, :, 2] = identity
+    lut.flags.writeable = False
+    return lut
+
+
+@lru_cache(maxsize=64)
+def posterize_lut(level) -> np.ndarray:
+    """
+    色レベルに応じて量子化する 256 エントリのLUT
+    :param level: ポスタリゼーションの色レベル
+    :return: cv2.LUT 用のテーブル（shape=(256,), uint8）
+    """
+    step = 256 // level  # 色レベルに応じた量子化ステップ
+    lut = ((np.arange(256) // step) * step).clip(0, 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+# ---- 各段階の処理 ----
+
+def saturate(cv_image: np.ndarray, saturation, channel_order: str = DEFAULT_CHANNEL_ORDER) -> np.ndarray:
+    """
+    1) 彩度を上げる
+    :param cv_image: 入力画像
+    :param saturation: 彩度の倍率
+    :param channel_order: 入出力のチャンネルの並び（"BGR" / "RGB"）
+    :return: 彩度調整後の画像（入力と同じ並び）
+    """
+    # HSV への変換で確保した配列だけを使い回す（LUT と逆変換はインプレース）
+    return saturate_hsv(cv2.cvtColor(cv_image, _TO_HSV[channel_order]), saturation, inplace=True,
+                        channel_order=channel_order)
+
+
+def saturate_hsv(hsv: np.ndarray, saturation, inplace: bool = False,
+                 channel_order: str = DEFAULT_CHANNEL_ORDER) -> np.ndarray:
+    """
+    HSVに変換済みの画像の彩度を上げて元の色空間に戻す（複数の倍率で HSV 変換を共有するため）
+    :param hsv: 入力画像（HSV）
+    :param saturation: 彩度の倍率
+    :param inplace: Trueなら hsv を書き換えて出力に使う
+    :param channel_order: 出力のチャンネルの並び（"BGR" / "RGB"）
+    :return: 彩度調整後の画像
+    """
+    out = hsv if inplace else np.empty_like(hsv)
+    cv2.LUT(hsv, saturation_lut(saturation), dst=out)
+    return cv2.cvtColor(out, _FROM_HSV[channel_order], dst=out)
+
+
+def smooth(saturated: np.ndarray, smooth_strength, edge_strength, quality: str = DEFAULT_QUALITY) -> np.ndarray:
+    """
+    2) エッジを保ったまま平滑化
+    :param saturated: 彩度調整後の画像（BGR）
+    :param smooth_strength: 平滑化の強さ
+    :param edge_strength: エッジ保持の強さ
+    :param quality: "exact"（従来どおり）/ "balanced" / "preview"（縮小して処理する近似。smoothing.py 参照）
+    :return: 平滑化後の画像（BGR）
+    """
+    sigma_s = smooth_strength  # 50以上でのっぺり感が増す
+    sigma_r = max(0.01, edge_strength)  # 0.0にするとエラーになるので最小値を設定
+    return smooth_image(saturated, sigma_s, sigma_r, quality)
+
+
+def posterize(smoothed: np.ndarray, level) -> np.ndarray:
+    """
+    3) ポスタリゼーション（ビット落とし）
+    :param smoothed: 平滑化後の画像（BGR）
+    :param level: ポスタリゼーションの色レベル
+    :return: ポスタリゼーション後の画像（BGR）
+    """
+    return cv2.LUT(smoothed, posterize_lut(level))
+
+
+def quantize(smoothed: np.ndarray, level, quantizer: str = DEFAULT_QUANTIZER, palette: Palette = None,
+             channel_order: str = DEFAULT_CHANNEL_ORDER) -> np.ndarray:
+    """
+    3) 色の量子化（quantizer に応じてビット落としか、パレットの色への置き換え）
+    :param smoothed: 平滑化後の画像
+    :param level: ポスタリゼーションの色レベル
+    :param quantizer: "uniform" / "kmeans"
+    :param palette: kmeans で使うパレット（省略時は smoothed から作る。smoothed と同じ並びで作ったもの）
+    :param channel_order: 入出力のチャンネルの並び（"BGR" / "RGB"）
+    :return: 量子化後の画像
+    """
+    check_quantizer(quantizer)
+    if quantizer == "uniform":
+        return posterize(smoothed, level)
+    if palette is None:
+        palette = Palette.from_image(smoothed, level, channel_order)
+    return palette.apply(smoothed)
+
+
+def extract_edges(poster: np.ndarray, channel_order: str = DEFAULT_CHANNEL_ORDER) -> np.ndarray:
+    """
+    4) 線画抽出 (Canny)
+    :param poster: ポスタリゼーション後の画像
+    :param channel_order: poster のチャンネルの並び（"BGR" / "RGB"）
+    :return: 反転済みの線画（グレースケール、線が0）
+    """
+    gray = cv2.cvtColor(poster, _TO_GRAY[channel_order])
+    edges = cv2.Canny(gray, 100, 200)
+
+    # 線画を反転しておく
+    return cv2.bitwise_not(edges)
+
+
+def overlay(poster: np.ndarray, edges_inv: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """
+    5) 線画を重ねる
+    :param poster: ポスタリゼーション後の画像（チャンネルの並びはそのまま）
+    :param edges_inv: 反転済みの線画
+    :param out: 結果を書き込む配列（poster と同じ shape の uint8。省略時は新しく確保する）
+    :return: 変換後の画像
+    """
+    edges_inv_colored = cv2.cvtColor(edges_inv, cv2.COLOR_GRAY2BGR)  # 3チャンネルに複製するだけ
+    if out is None:
+        return cv2.bitwise_and(poster, edges_inv_colored)
+    check_output(out, poster.shape)
+    cv2.bitwise_and(poster, edges_inv_colored, dst=out)
+    return out
+
+
+def render_stages(cv_image: np.ndarray, saturation=2, level=8, smooth_strength=50, edge_strength=0.4,
+                  quality: str = DEFAULT_QUALITY, quantizer: str = DEFAULT_QUANTIZER,
+                  palette: Palette = None, channel_order: str = DEFAULT_CHANNEL_ORDER,
+                  out: np.ndarray = None) -> np.ndarray:
+    """
+    キャッシュを使わずに全段階を実行する
+    :param cv_image: 入力画像（uint8）
+    :param quality: 平滑化の精度（"exact" / "balanced" / "preview"）
+    :param quantizer: 色の量子化の方式（"uniform" / "kmeans"）
+    :param palette: kmeans で使うパレット（タイル処理などで画像全体のパレットを共有する場合。省略時はこの画像から作る）
+    :param channel_order: 入出力のチャンネルの並び（"BGR" / "RGB"）
+    :param out: 結果を書き込む配列（入力と同じ shape。省略時は新しく確保する）
+    :return: 変換後の画像（入力と同じ並び。out を渡した場合は out）
+    """
+    check_channel_order(channel_order)
+    saturated = saturate(cv_image, saturation, channel_order)
+    if quantizer == "kmeans" and palette is None:
+        palette = Palette.from_image(saturated, level, channel_order)
+    smoothed = smooth(saturated, smooth_strength, edge_strength, quality)
+    del saturated
+    poster = quantize(smoothed, level, quantizer, palette, channel_order)
+    del smoothed
+    return overlay(poster, extract_edges(poster, channel_order), out)
+
+
+def postarization_array(array: np.ndarray, saturation=2, level=8, smooth_strength=50, edge_strength=0.4,
+                        channel_order: str = "RGB", out: np.ndarray = None, quality: str = DEFAULT_QUALITY,
+                        quantizer: str = DEFAULT_QUANTIZER) -> np.ndarray:
+    """
+    画像をアニメ風に変換する関数（numpy 配列版。PIL を経由せず、チャンネルの入れ替えもしない）
+    :param array: 入力画像（uint8, shape=(高さ, 幅, 3)）。書き換えない
+    :param channel_order: array のチャンネルの並び（"RGB" / "BGR"）。出力も同じ並びになる
+    :param out: 結果を書き込む配列（array と同じ shape の uint8。繰り返し変換するときに確保を省ける）
+    :param quality: 平滑化の精度（"exact" / "balanced" / "preview"）
+    :param quantizer: 色の量子化の方式（"uniform" / "kmeans"）
+    :return: 変換後の画像（out を渡した場合は out）
+    """
+    check_image_array(array)
+    check_quantizer(quantizer)
+    return render_stages(array, saturation, level, smooth_strength, edge_strength, quality=quality,
+                         quantizer=quantizer, channel_order=channel_order, out=out)
+
+
+def render_presets_array(cv_image: np.ndarray, presets: dict, should_cancel=None,
+                         quality: str = DEFAULT_QUALITY, quantizer: str = DEFAULT_QUANTIZER,
+                         channel_order: str = DEFAULT_CHANNEL_ORDER) -> dict:
+    """
+    複数のプリセットをまとめて変換する（入力が同じ段階は1回だけ計算する）
+
+    - HSV への変換は全プリセットで1回
+    - 彩度調整は saturation が同じプリセットで共有
+    - 平滑化は (saturation, smooth_strength, edge_strength) が同じプリセットで共有
+    - ポスタリゼーション・線画・重ね合わせは全パラメータが同じプリセットで共有
+
+    :param cv_image: 入力画像
+    :param presets: {プリセット名: {"saturation", "level", "smooth_strength", "edge_strength"}}
+    :param should_cancel: 各段階の間で呼ばれ、Trueを返すと RenderCancelled を送出する関数
+    :param quality: 平滑化の精度（"exact" / "balanced" / "preview"）
+    :param quantizer: 色の量子化の方式（"uniform" / "kmeans"。kmeans のパレットは彩度と level が同じプリセットで共有）
+    :param channel_order: 入出力のチャンネルの並び（"BGR" / "RGB"）
+    :return: {プリセット名: 変換後の画像（入力と同じ並び）}（パラメータが同じプリセットは同じ配列を共有する）
+    """
+    check_channel_order(channel_order)
+    def check(stage):
+        if should_cancel is not None and should_cancel():
+            raise RenderCancelled(stage)
+
+    # saturation -> (smooth_strength, edge_strength) -> level -> [プリセット名]
+    tree = {}
+    for name, params in presets.items():
+        smooth_key = (params["smooth_strength"], params["edge_strength"])
+        tree.setdefault(params["saturation"], {}).setdefault(smooth_key, {}) \
+            .setdefault(params["level"], []).append(name)
+
+    results = {}
+    check("saturate")
+    hsv = cv2.cvtColor(cv_image, _TO_HSV[channel_order])
+    for saturation, smooth_groups in tree.items():
+        check("saturate")
+        saturated = saturate_hsv(hsv, saturation, channel_order=channel_order)
+        palettes = {}  # level -> Palette（kmeans のみ）
+        for (smooth_strength, edge_strength), level_groups in smooth_groups.items():
+            check("smooth")
+            smoothed = smooth(saturated, smooth_strength, edge_strength, quality)
+            for level, names in level_groups.items():
+                check("posterize")
+                if quantizer == "kmeans" and level not in palettes:
+                    palettes[level] = Palette.from_image(saturated, level, channel_order)
+                poster = quantize(smoothed, level, quantizer, palettes.get(level), channel_order)
+                check("edges")
+                result = overlay(poster, extract_edges(poster, channel_order))
+                for name in names:
+                    results[name] = result
+            del smoothed
+        del saturated
+    # 呼び出し側の順序に合わせる
+    return {name: results[name] for name in presets}
+
+
+def render_presets(image: Image.Image, presets: dict, should_cancel=None, quality: str = DEFAULT_QUALITY,
+                   quantizer: str = DEFAULT_QUANTIZER) -> dict:
+    """
+    複数のプリセットをまとめて変換する（共通の段階は1回だけ計算する）
+    :param image: 入力画像（PIL Image）
+    :param presets: {プリセット名: パラメータの辞書}
+    :param should_cancel: 各段階の間で呼ばれ、Trueを返すと RenderCancelled を送出する関数
+    :param quality: 平滑化の精度（"exact" / "balanced" / "preview"）
+    :param quantizer: 色の量子化の方式（"uniform" / "kmeans"）
+    :return: {プリセット名: 変換後の画像（PIL Image）}
+    """
+    # RGB のまま処理する（BGR への入れ替えのコピーを作らない）
+    rgb = np.asarray(image if image.mode == "RGB" else image.convert("RGB"))
+    arrays = render_presets_array(rgb, presets, should_cancel, quality, quantizer, channel_order="RGB")
+    converted = {}  # 同じ配列は1回だけ変換する
+    results = {}
+    for name, array in arrays.items():
+        if id(array) not in converted:
+            converted[id(array)] = Image.fromarray(array)
+        results[name] = converted[id(array)]
+    return results
+
+
+# ---- キャッシュ付きパイプライン ----
+
+class RenderCancelled(Exception):
+    """should_cancel により途中で打ち切られたレンダリング"""
+
+
+class PostarizationPipeline:
+    """
+    段階ごとの出力をキャッシュするポスタリゼーションパイプライン
+
+    各段階の結果は上流のパラメータをキーにして保持するため、
+    例えば level だけを変えた場合は edgePreservingFilter の結果を再利用し、
+    ポスタリゼーション・Canny・重ね合わせだけを再計算する。
+
+    入力は set_image（PIL Image、RGB のまま処理する）か set_array（numpy 配列、並びを指定）で設定し、
+    render_array は入力と同じチャンネルの並び（channel_order）で結果を返す。
+    """
+
+    def __init__(self, image: Image.Image = None, recorder=None, name: str = None):
+        """
+        :param image: 入力画像（PIL Image）
+        :param recorder: 段階ごとの処理時間を記録する profiling.StageRecorder（省略時は計測しない）
+        :param name: 計測時に段階名の前に付ける名前（例: "proxy" -> "proxy.smooth"）
+        """
+        self._lock = threading.Lock()
+        self._source = None
+        self.channel_order = "RGB"
+        # 段階名 -> (キー, 出力)
+        self._cache = {}
+        # (saturation, level) -> Palette（kmeans のパレット。スライダーを戻したときにも再利用する）
+        self._palettes = OrderedDict()
+        self.recorder = recorder
+        self.name = name
+        if image is not None:
+            self.set_image(image)
+
+    def set_image(self, image: Image.Image):
+        """
+        入力画像を設定し、キャッシュを破棄する
+        :param image: 入力画像（PIL Image）
+        """
+        # RGB のまま配列にする（BGR への入れ替えのコピーを作らない）
+        self.set_array(np.asarray(image if image.mode == "RGB" else image.convert("RGB")), "RGB")
+
+    def set_array(self, array: np.ndarray, channel_order: str = "RGB"):
+        """
+        入力画像を numpy 配列で設定し、キャッシュを破棄する（配列はコピーせずに参照する）
+        :param array: 入力画像（uint8, shape=(高さ, 幅, 3)）。設定している間は書き換えないこと
+        :param channel_order: array のチャンネルの並び（"RGB" / "BGR"）。render_array の結果も同じ並びになる
+        """
+        check_image_array(array)
+        check_channel_order(channel_order)
+        array = np.ascontiguousarray(array)
+        with self._lock:
+            self._source = array
+            self.channel_order = channel_order
+            self._cache.clear()
+            self._palettes.clear()
+
+    def clear(self):
+        """キャッシュと入力画像を解放する"""
+        with self._lock:
+            self._source = None
+            self._cache.clear()
+            self._palettes.clear()
+
+    def resident_bytes(self) -> int:
+        """入力画像と段階ごとのキャッシュが使っているバイト数"""
+        source = self._source
+        total = source.nbytes if source is not None else 0
+        total += sum(palette.nbytes for palette in list(self._palettes.values()))
+        return total + sum(value.nbytes for _, value in list(self._cache.values()))
+
+    def _palette(self, saturation, level, saturated: np.ndarray) -> Palette:
+        """彩度調整後の画像から kmeans のパレットを作る（画像ごとにキャッシュする）"""
+        key = (saturation, level)
+        palette = self._palettes.get(key)
+        if palette is not None:
+            self._palettes.move_to_end(key)
+            return palette
+        start = time.perf_counter()
+        palette = Palette.from_image(saturated, level, self.channel_order)
+        if self.recorder is not None:
+            label = f"{self.name}.palette" if self.name else "palette"
+            self.recorder.record(label, time.perf_counter() - start, palette.nbytes)
+        self._palettes[key] = palette
+        while len(self._palettes) > PALETTE_CACHE_SIZE:
+            self._palettes.popitem(last=False)
+        return palette
+
+    def _stage(self, name: str, key: tuple, compute):
+        recorder = self.recorder
+        label = f"{self.name}.{name}" if self.name else name
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == key:
+            if recorder is not None:
+                recorder.record(label, 0.0, cached[1].nbytes, cached=True)
+            return cached[1]
+        start = time.perf_counter()
+        value = compute()
+        if recorder is not None:
+            recorder.record(label, time.perf_counter() - start, value.nbytes)
+        self._cache[name] = (key, value)
+        return value
+
+    def render_array(self, saturation=2, level=8, smooth_strength=50, edge_strength=0.4,
+                     should_cancel=None, quality: str = DEFAULT_QUALITY,
+                     quantizer: str = DEFAULT_QUANTIZER, out: np.ndarray = None) -> np.ndarray:
+        """
+        パイプラインを実行して配列を返す（チャンネルの並びは self.channel_order）
+        out を省略した場合、戻り値はキャッシュと共有しているため書き換えないこと
+        :param should_cancel: 各段階の間で呼ばれ、Trueを返すと RenderCancelled を送出する関数
+        :param quality: 平滑化の精度（"exact" / "balanced" / "preview"）
+        :param quantizer: 色の量子化の方式（"uniform" / "kmeans"）
+        :param out: 結果をコピーする配列（入力と同じ shape の uint8。呼び出し側が自由に書き換えられる）
+        :return: 変換後の画像（out を渡した場合は out）
+        """
+        check_quantizer(quantizer)
+        def stage(name, key, compute):
+            if should_cancel is not None and should_cancel():
+                raise RenderCancelled(name)
+            return self._stage(name, key, compute)
+
+        with self._lock:
+            if self._source is None:
+                raise ValueError("No image has been set")
+            source = self._source
+            order = self.channel_order
+
+            sat_key = (saturation,)
+            smooth_key = sat_key + (smooth_strength, edge_strength, quality)
+            poster_key = smooth_key + (level, quantizer)
+
+            saturated = stage("saturate", sat_key, lambda: saturate(source, saturation, order))
+            palette = self._palette(saturation, level, saturated) if quantizer == "kmeans" else None
+            smoothed = stage("smooth", smooth_key, lambda: smooth(saturated, smooth_strength, edge_strength, quality))
+            poster = stage("posterize", poster_key, lambda: quantize(smoothed, level, quantizer, palette, order))
+            # 線画と重ね合わせはポスタリゼーション結果だけに依存する
+            edges_inv = stage("edges", poster_key, lambda: extract_edges(poster, order))
+            result = stage("overlay", poster_key, lambda: overlay(poster, edges_inv))
+            if out is None:
+                return result
+            check_output(out, result.shape)
+            np.copyto(out, result)
+            return out
+
+    def render(self, saturation=2, level=8, smooth_strength=50, edge_strength=0.4,
+               should_cancel=None, quality: str = DEFAULT_QUALITY,
+               quantizer: str = DEFAULT_QUANTIZER) -> Image.Image:
+        """
+        パイプラインを実行してPIL Imageを返す
+        :param saturation: 彩度の倍率
+        :param level: ポスタリゼーションの色レベル
+        :param smooth_strength: 平滑化の強さ（0-100）
+        :param edge_strength: エッジ保持の強さ（0.0-1.0）
+        :param should_cancel: 各段階の間で呼ばれ、Trueを返すと RenderCancelled を送出する関数
+        :param quality: 平滑化の精度（"exact" / "balanced" / "preview"）
+        :param quantizer: 色の量子化の方式（"uniform" / "kmeans"）
+        :return: 変換後のアニメ調画像（PIL Image）
+        """
+        anime_image = self.render_array(saturation, level, smooth_strength, edge_strength, should_cancel, quality,
+                                        quantizer)
+        if self.channel_order == "BGR":
+            anime_image = cv2.cvtColor(anime_image, cv2.COLOR_BGR2RGB)
+        return Image.fromarray(anime_image)
+
+
+def postarization(image: Image.Image, saturation=2, level=8, smooth_strength=50, edge_strength=0.4,
+                  quality: str = DEFAULT_QUALITY, quantizer: str = DEFAULT_QUANTIZER) -> Image.Image:
+    """
+    画像をアニメ風に変換する関数
+    :param image: 入力画像（PIL Image）
+    :param saturation: 彩度の倍率
+    :param level: ポスタリゼーションの色レベル
+    :param smooth_strength: 平滑化の強さ（0-100）
+    :param edge_strength: エッジ保持の強さ（0.0-1.0）
+    :param quality: 平滑化の精度（"exact" / "balanced" / "preview"）
+    :param quantizer: 色の量子化の方式（"uniform" / "kmeans"）
+    :return: 変換後のアニメ調画像（PIL Image）
+    """
+    # postarization_array の薄いラッパー（1回だけの変換なので段階ごとのキャッシュは作らない）
+    rgb = np.asarray(image if image.mode == "RGB" else image.convert("RGB"))
+    return Image.fromarray(postarization_array(rgb, saturation, level, smooth_strength, edge_strength, "RGB",
+                                               quality=quality, quantizer=quantizer))
@@ -0,0 +1,16 @@
+# パラメータのプリセット（テンプレート）
+PARAMETER_SETS = {
+    "default":    {"saturation": 2,   "level": 8,  "smooth_strength": 50, "edge_strength": 0.4},
+    "realistic":  {"saturation": 1.5, "level": 12, "smooth_strength": 70, "edge_strength": 0.3},
+    "anime_style":{"saturation": 2.5, "level": 6,  "smooth_strength": 40, "edge_strength": 0.5},
+    "monochrome": {"saturation": 0, "level": 4,  "smooth_strength": 80, "edge_strength": 0.2},
+    "novel_game": {"saturation": 1.6, "level": 8, "smooth_strength": 68, "edge_strength": 0.8},
+}
+
+# GUIで入力できるパラメータの範囲 (最小値, 最大値)
+PARAMETER_RANGES = {
+    "saturation": (0.0, 3.0),
+    "level": (2, 20),
+    "smooth_strength": (0, 1000),
+    "edge_strength": (0.0, 10.0),
+}
@@ -0,0 +1,268 @@
+"""
+段階ごとの処理時間・バイト数の計測（オプトイン）
+
+環境変数で有効にする:
+    POSTARIZATION_METRICS_LOG=1      描画ごとに [METRICS] {...} の JSON 行を出力
+    POSTARIZATION_METRICS_PORT=9091  Prometheus 形式のテキストを http://0.0.0.0:9091/metrics で公開
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 処理時間のヒストグラムのバケット（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Prometheus の histogram と同じ形式（累積バケット + 合計 + 件数）で集計する"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "buckets": dict(zip(self.buckets, self.counts)),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+class StageRecorder:
+    """
+    1セッション分の計測値を集計する
+
+    - record / measure で段階ごとの時間とバイト数を記録する
+    - render() の中で記録したものは1回の描画としてまとめ、log=True なら JSON 行で出力する
+    """
+
+    def __init__(self, session: str = None, log: bool = False, buckets=DEFAULT_BUCKETS):
+        self.session = session
+        self.log = log
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._durations = {}  # 段階名 -> Histogram
+        self._bytes = {}  # 段階名 -> 合計バイト数
+        self._cache_hits = {}  # 段階名 -> キャッシュヒット数
+        self._render_durations = Histogram(buckets)
+        self._local = threading.local()
+
+    def record(self, stage: str, seconds: float, nbytes: int = 0, cached: bool = False):
+        """
+        段階の計測値を記録する
+        :param stage: 段階名（例: "smooth", "encode"）
+        :param seconds: 処理時間（秒）
+        :param nbytes: 出力のバイト数
+        :param cached: キャッシュから返した場合はTrue（時間は集計しない）
+        """
+        with self._lock:
+            if cached:
+                self._cache_hits[stage] = self._cache_hits.get(stage, 0) + 1
+            else:
+                self._durations.setdefault(stage, Histogram(self._buckets)).observe(seconds)
+                self._bytes[stage] = self._bytes.get(stage, 0) + nbytes
+
+        current = getattr(self._local, "render", None)
+        if current is not None:
+            current[stage] = {"ms": round(seconds * 1000, 3), "bytes": nbytes, "cached": cached}
+
+    @contextmanager
+    def measure(self, stage: str):
+        """
+        with ブロックの処理時間を記録する。バイト数は yield した辞書の "bytes" に設定する
+
+            with recorder.measure("encode") as m:
+                data = encode(image)
+                m["bytes"] = len(data)
+        """
+        info = {"bytes": 0}
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.record(stage, time.perf_counter() - start, info["bytes"])
+
+    @contextmanager
+    def render(self, **fields):
+        """
+        1回の描画をまとめる。ブロック内で記録した段階は終了時に1行のログになる
+        yield した辞書にキーを追加すると、そのままログに含まれる
+        :param fields: ログに含める追加の情報（世代番号など）
+        """
+        entry = dict(fields, session=self.session, stages={})
+        self._local.render = entry["stages"]
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            self._local.render = None
+            total = time.perf_counter() - start
+            with self._lock:
+                self._render_durations.observe(total)
+            if self.log:
+                entry["total_ms"] = round(total * 1000, 3)
+                print(f"[METRICS] {json.dumps(entry, ensure_ascii=False)}")
+
+    def snapshot(self) -> dict:
+        """集計値を辞書で返す"""
+        with self._lock:
+            return {
+                "session": self.session,
+                "renders": self._render_durations.snapshot(),
+                "stages": {
+                    stage: dict(hist.snapshot(), bytes=self._bytes.get(stage, 0))
+                    for stage, hist in self._durations.items()
+                },
+                "cache_hits": dict(self._cache_hits),
+            }
+
+    def prometheus_lines(self, prefix: str = "postarization") -> dict:
+        """
+        Prometheus のテキスト形式の行を指標名ごとに返す
+        :return: {指標名: [行, ...]}
+        """
+        session = _escape(self.session or "")
+        lines = {
+            f"{prefix}_stage_seconds": [],
+            f"{prefix}_stage_bytes_total": [],
+            f"{prefix}_stage_cache_hits_total": [],
+            f"{prefix}_render_seconds": [],
+        }
+        with self._lock:
+            for stage, hist in self._durations.items():
+                labels = f'session="{session}",stage="{_escape(stage)}"'
+                lines[f"{prefix}_stage_seconds"] += _histogram_lines(f"{prefix}_stage_seconds", labels, hist)
+                lines[f"{prefix}_stage_bytes_total"].append(
+                    f"{prefix}_stage_bytes_total{{{labels}}} {self._bytes.get(stage, 0)}")
+            for stage, hits in self._cache_hits.items():
+                labels = f'session="{session}",stage="{_escape(stage)}"'
+                lines[f"{prefix}_stage_cache_hits_total"].append(f"{prefix}_stage_cache_hits_total{{{labels}}} {hits}")
+            lines[f"{prefix}_render_seconds"] += _histogram_lines(
+                f"{prefix}_render_seconds", f'session="{session}"', self._render_durations)
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram_lines(name: str, labels: str, hist: Histogram) -> list:
+    lines = [f'{name}_bucket{{{labels},le="{bound}"}} {count}' for bound, count in zip(hist.buckets, hist.counts)]
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {hist.count}')
+    lines.append(f"{name}_sum{{{labels}}} {hist.sum}")
+    lines.append(f"{name}_count{{{labels}}} {hist.count}")
+    return lines
+
+
+# ---- セッションごとの登録と公開 ----
+
+_HELP = {
+    "stage_seconds": ("histogram", "Time spent in each filter / transport stage"),
+    "stage_bytes_total": ("counter", "Bytes produced by each stage"),
+    "stage_cache_hits_total": ("counter", "Stages served from the pipeline cache"),
+    "render_seconds": ("histogram", "Time spent per render"),
+}
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+# prometheus_text に行を追加する関数（collect(prefix) -> 行のリスト）
+_collectors = []
+_server = None
+
+
+def enabled() -> bool:
+    """環境変数で計測が有効になっているか"""
+    return bool(os.getenv("POSTARIZATION_METRICS_LOG") or os.getenv("POSTARIZATION_METRICS_PORT"))
+
+
+def session_recorder(session: str) -> StageRecorder:
+    """セッション用の StageRecorder を作成して登録する（公開用のサーバーも必要なら起動）"""
+    recorder = StageRecorder(session, log=bool(os.getenv("POSTARIZATION_METRICS_LOG")))
+    with _recorders_lock:
+        _recorders[session] = recorder
+    port = os.getenv("POSTARIZATION_METRICS_PORT")
+    if port:
+        start_metrics_server(int(port))
+    return recorder
+
+
+def release_session(session: str):
+    """セッション終了時に登録を解除する"""
+    with _recorders_lock:
+        _recorders.pop(session, None)
+
+
+def register_collector(collect):
+    """
+    公開する指標を追加する（同じ関数は1回だけ登録される）
+    :param collect: prefix を受け取り、Prometheus のテキスト形式の行（HELP / TYPE を含む）のリストを返す関数
+    """
+    with _recorders_lock:
+        if collect not in _collectors:
+            _collectors.append(collect)
+
+
+def prometheus_text(prefix: str = "postarization") -> str:
+    """登録されている全セッションの集計値を Prometheus のテキスト形式で返す"""
+    with _recorders_lock:
+        recorders = list(_recorders.values())
+        collectors = list(_collectors)
+
+    merged = {}
+    for recorder in recorders:
+        for name, lines in recorder.prometheus_lines(prefix).items():
+            merged.setdefault(name, []).extend(lines)
+
+    out = []
+    for suffix, (metric_type, help_text) in _HELP.items():
+        name = f"{prefix}_{suffix}"
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {metric_type}")
+        out.extend(merged.get(name, []))
+    out.append(f"# HELP {prefix}_sessions Sessions with an active recorder")
+    out.append(f"# TYPE {prefix}_sessions gauge")
+    out.append(f"{prefix}_sessions {len(recorders)}")
+    for collect in collectors:
+        out.extend(collect(prefix))
+    return "\n".join(out) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0"):
+    """/metrics を返すHTTPサーバーをデーモンスレッドで起動する（起動済みなら何もしない）"""
+    global _server
+    with _recorders_lock:
+        if _server is not None:
+            return _server
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"[INFO] Metrics endpoint: http://{host}:{port}/metrics")
+    return _server
@@ -0,0 +1,141 @@
+"""
+色の量子化（ポスタリゼーション）のバックエンド
+
+quantizer で方式を選ぶ:
+    "uniform"  チャンネルごとに等間隔で値を落とす（従来と同じ結果。level 段階 × 3チャンネル）
+    "kmeans"   画像に合わせたパレットを Lab 色空間の k-means で求め、最も近いパレットの色に置き換える
+
+k-means のパレットは縮小した画像（長辺 PALETTE_SAMPLE_SIDE）から求めるため速く、
+平滑化の前の画像（彩度調整後）から作るので、平滑化やエッジのスライダーを動かしても作り直さない。
+各画素の置き換えは、色空間を 32x32x32 に区切った 3D LUT（区画ごとに最も近いパレットの色）を
+引くだけなので、画素ごとに距離を計算しない。
+
+パレットと LUT は入力と同じチャンネルの並び（channel_order: "BGR" / "RGB"）で持つ。
+"""
+import cv2
+import numpy as np
+
+QUANTIZERS = ("uniform", "kmeans")
+DEFAULT_QUANTIZER = "uniform"
+
+# パレットを求める縮小画像の長辺
+PALETTE_SAMPLE_SIDE = 128
+# パレットの色数 = level × この値（上限 MAX_PALETTE_SIZE）
+PALETTE_COLORS_PER_LEVEL = 3
+MAX_PALETTE_SIZE = 64
+# 3D LUT の1チャンネルあたりのビット数（5 -> 32 区画）
+LUT_BITS = 5
+# k-means の反復
+KMEANS_ITERATIONS = 20
+KMEANS_SEED = 12345
+
+# チャンネルの並び -> Lab との変換
+_TO_LAB = {"BGR": cv2.COLOR_BGR2LAB, "RGB": cv2.COLOR_RGB2LAB}
+_FROM_LAB = {"BGR": cv2.COLOR_LAB2BGR, "RGB": cv2.COLOR_LAB2RGB}
+
+
+def check_quantizer(quantizer: str):
+    if quantizer not in QUANTIZERS:
+        raise ValueError(f"Unknown quantizer: {quantizer!r} (expected one of {', '.join(QUANTIZERS)})")
+
+
+def palette_size(level) -> int:
+    """色レベルに対応するパレットの色数"""
+    return max(2, min(MAX_PALETTE_SIZE, int(level) * PALETTE_COLORS_PER_LEVEL))
+
+
+def sample_image(image: np.ndarray, side: int = PALETTE_SAMPLE_SIDE) -> np.ndarray:
+    """パレットを求めるための縮小画像（長辺が side 以下ならそのまま）"""
+    height, width = image.shape[:2]
+    scale = side / max(height, width)
+    if scale >= 1.0:
+        return image
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def build_palette(sample: np.ndarray, level, channel_order: str = "BGR") -> np.ndarray:
+    """
+    k-means（Lab 色空間）でパレットを求める
+    :param sample: 縮小した画像（uint8）
+    :param level: ポスタリゼーションの色レベル
+    :param channel_order: sample のチャンネルの並び（"BGR" / "RGB"）
+    :return: パレット（shape=(色数, 3), sample と同じ並び, uint8）
+    """
+    lab = cv2.cvtColor(sample, _TO_LAB[channel_order]).reshape(-1, 3).astype(np.float32)
+    k = min(palette_size(level), len(lab))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, KMEANS_ITERATIONS, 0.5)
+    # 同じ画像からは毎回同じパレットになるようにする
+    cv2.setRNGSeed(KMEANS_SEED)
+    _, _, centers = cv2.kmeans(lab, k, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+    centers = np.clip(np.rint(centers), 0, 255).astype(np.uint8).reshape(-1, 1, 3)
+    return cv2.cvtColor(centers, _FROM_LAB[channel_order]).reshape(-1, 3)
+
+
+def palette_lut(palette: np.ndarray, channel_order: str = "BGR") -> np.ndarray:
+    """
+    3D LUT を作る（色空間の区画ごとに、中心の色に最も近いパレットの色を Lab の距離で選ぶ）
+    :param palette: パレット（uint8）
+    :param channel_order: パレットのチャンネルの並び（"BGR" / "RGB"）
+    :return: shape=(2**(3*LUT_BITS),) のテーブル（3チャンネルをまとめた uint32。apply_palette で使う）
+    """
+    bins = 1 << LUT_BITS
+    step = 256 // bins
+    centers = np.arange(bins, dtype=np.uint8) * step + step // 2
+    # 区画の並びは入力のチャンネルの並びに合わせる（apply_palette で1番目のチャンネルが上位ビット）
+    c0, c1, c2 = np.meshgrid(centers, centers, centers, indexing="ij")
+    grid = np.stack([c0, c1, c2], axis=-1).reshape(-1, 1, 3)
+    to_lab = _TO_LAB[channel_order]
+    grid_lab = cv2.cvtColor(grid, to_lab).reshape(-1, 3).astype(np.float32)
+    palette_lab = cv2.cvtColor(palette.reshape(-1, 1, 3), to_lab).reshape(-1, 3).astype(np.float32)
+
+    # |x - p|^2 = |x|^2 - 2 x.p + |p|^2（|x|^2 は最小値の位置に影響しないので省く）
+    distances = (palette_lab * palette_lab).sum(axis=1) - 2.0 * grid_lab @ palette_lab.T
+    colors = palette[np.argmin(distances, axis=1)]
+    # 1画素を1回で引けるよう、3チャンネルを uint32 にまとめておく（メモリ上は入力と同じ並びの後に 0）
+    colors = colors.astype("<u4")  # バイト順を固定（リトルエンディアン）
+    lut = colors[:, 0] | colors[:, 1] << 8 | colors[:, 2] << 16
+    lut.flags.writeable = False
+    return lut
+
+
+def apply_palette(image: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """
+    3D LUT で各画素をパレットの色に置き換える
+    :param image: 入力画像（uint8。チャンネルの並びは lut を作ったパレットと同じ）
+    :param lut: palette_lut で作ったテーブル
+    :return: 量子化後の画像（入力と同じ並び）
+    """
+    shift = 8 - LUT_BITS
+    c0, c1, c2 = cv2.split(image)
+    index = (c0 >> shift).astype(np.int32) << (2 * LUT_BITS)
+    index |= (c1 >> shift).astype(np.int32) << LUT_BITS
+    index |= c2 >> shift
+    packed = np.take(lut, index)
+    # 4番目（0）のチャンネルを落とすだけ（並びは入れ替えない）
+    return cv2.cvtColor(packed.view(np.uint8).reshape(index.shape + (4,)), cv2.COLOR_BGRA2BGR)
+
+
+class Palette:
+    """パレットとその 3D LUT"""
+
+    def __init__(self, colors: np.ndarray, channel_order: str = "BGR"):
+        self.colors = colors
+        self.channel_order = channel_order
+        self.lut = palette_lut(colors, channel_order)
+
+    @classmethod
+    def from_image(cls, image: np.ndarray, level, channel_order: str = "BGR") -> "Palette":
+        """
+        画像からパレットを作る（内部で縮小してから k-means を行う）
+        :param image: 彩度調整後の画像
+        :param channel_order: image のチャンネルの並び（"BGR" / "RGB"）
+        """
+        return cls(build_palette(sample_image(image), level, channel_order), channel_order)
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        return apply_palette(image, self.lut)
+
+    @property
+    def nbytes(self) -> int:
+        return self.colors.nbytes + self.lut.nbytes
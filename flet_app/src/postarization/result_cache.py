@@ -0,0 +1,250 @@
+"""
+変換結果のキャッシュ（内容アドレス方式）
+
+キーは (入力画像の内容のハッシュ, 正規化したパラメータ, フィルタのバージョン) から作るため、
+別のセッションで同じ画像・同じテンプレートを選んだ場合も同じ結果を再利用できる。
+
+- メモリ層: バイト数で上限を決めた LRU（PIL Image をそのまま保持）
+- ディスク層: PNG で保存し、合計サイズと保存期間の上限を超えたら最終利用が古いものから削除
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from . import __version__
+
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_BYTES = 256 * 1024 * 1024
+DEFAULT_DISK_MAX_AGE = 7 * 24 * 3600
+
+
+def image_digest(image: Image.Image) -> str:
+    """画像の内容（モード・サイズ・画素）のSHA-256"""
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.width}x{image.height}:".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def normalize_params(params: dict) -> dict:
+    """スライダーの浮動小数点の揺れでキーが変わらないようにパラメータを正規化する"""
+    normalized = {}
+    for name, value in sorted(params.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            normalized[name] = value
+        elif float(value).is_integer():
+            normalized[name] = int(value)
+        else:
+            normalized[name] = round(float(value), 4)
+    return normalized
+
+
+def cache_key(digest: str, params: dict) -> str:
+    """画像のハッシュとパラメータからキャッシュキーを作る"""
+    payload = json.dumps(
+        {"image": digest, "params": normalize_params(params), "version": __version__},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _image_bytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+class ResultCache:
+    """メモリ（LRU）とディスクの2層のキャッシュ"""
+
+    def __init__(self, memory_bytes: int = DEFAULT_MEMORY_BYTES, disk_dir: str = None,
+                 disk_bytes: int = DEFAULT_DISK_BYTES, disk_max_age: float = DEFAULT_DISK_MAX_AGE):
+        """
+        :param memory_bytes: メモリ層に保持する画像の合計バイト数の上限
+        :param disk_dir: ディスク層のディレクトリ（Noneならメモリ層のみ）
+        :param disk_bytes: ディスク層の合計ファイルサイズの上限
+        :param disk_max_age: ディスク層で最後に使われてからこの秒数を過ぎたものは削除する
+        """
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.disk_max_age = disk_max_age
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> PIL Image
+        self._memory_used = 0
+        self._disk_used = 0
+        # PNG の保存はバックグラウンドで1本ずつ行う
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache") if disk_dir else None
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.evictions_memory = 0
+        self.evictions_disk = 0
+
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_used = sum(entry.stat().st_size for entry in self._scan_disk())
+            self._writer.submit(self._evict_disk)
+
+    # ---- 参照 ----
+
+    def get(self, digest: str, params: dict):
+        """
+        キャッシュされた結果を返す
+        :return: PIL Image（なければ None）
+        """
+        key = cache_key(digest, params)
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return image
+
+        image = self._load_disk(key)
+        if image is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits_disk += 1
+        self._put_memory(key, image)
+        return image
+
+    def put(self, digest: str, params: dict, image: Image.Image):
+        """結果をメモリ層に保存し、ディスク層にはバックグラウンドで書き込む"""
+        key = cache_key(digest, params)
+        self._put_memory(key, image)
+        if self._writer is not None:
+            self._writer.submit(self._store_disk, key, image)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "disk_bytes": self._disk_used,
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "evictions_memory": self.evictions_memory,
+                "evictions_disk": self.evictions_disk,
+            }
+
+    # ---- メモリ層 ----
+
+    def _put_memory(self, key: str, image: Image.Image):
+        size = _image_bytes(image)
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_used -= _image_bytes(old)
+            self._memory[key] = image
+            self._memory_used += size
+            while self._memory_used > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= _image_bytes(evicted)
+                self.evictions_memory += 1
+
+    # ---- ディスク層 ----
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.png")
+
+    def _scan_disk(self):
+        try:
+            with os.scandir(self.disk_dir) as entries:
+                return [entry for entry in entries if entry.is_file() and entry.name.endswith(".png")]
+        except OSError:
+            return []
+
+    def _load_disk(self, key: str):
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with Image.open(path) as image:
+                image.load()
+                loaded = image.copy()
+            # 最終利用時刻として更新（LRU の判定に使う）
+            os.utime(path)
+            return loaded
+        except (OSError, ValueError):
+            return None
+
+    def _store_disk(self, key: str, image: Image.Image):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            image.save(tmp_path, format="PNG")
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_used += os.path.getsize(path)
+        except OSError as ex:
+            print(f"[WARNING] Result cache write failed: {ex}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict_disk()
+
+    def _evict_disk(self):
+        """期限切れのファイルと、上限を超えた分を最終利用が古い順に削除"""
+        files = []  # (最終利用時刻, サイズ, パス)
+        for entry in self._scan_disk():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue  # 走査の間に他のプロセスや掃除で削除された
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        now = time.time()
+        total = sum(size for _, size, _ in files)
+        for mtime, size, path in files:
+            expired = now - mtime > self.disk_max_age
+            if not expired and total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                total -= size  # 既に削除されていた（数えない）
+                continue
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions_disk += 1
+        with self._lock:
+            self._disk_used = total
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_cache(disk_dir: str = None) -> ResultCache:
+    """
+    プロセス全体で共有するキャッシュ（最初の呼び出しで作成）
+    上限は環境変数 POSTARIZATION_CACHE_MEMORY_MB / POSTARIZATION_CACHE_DISK_MB で変更できる
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            memory_mb = float(os.getenv("POSTARIZATION_CACHE_MEMORY_MB", DEFAULT_MEMORY_BYTES / 2**20))
+            disk_mb = float(os.getenv("POSTARIZATION_CACHE_DISK_MB", DEFAULT_DISK_BYTES / 2**20))
+            _shared = ResultCache(
+                memory_bytes=int(memory_mb * 2**20),
+                disk_dir=disk_dir,
+                disk_bytes=int(disk_mb * 2**20),
+            )
+        return _shared
@@ -0,0 +1,503 @@
+"""
+HTTP サーバーモード（GUI なしで他のサービスから変換を呼び出す）
+
+使い方（flet_app/src で実行）:
+    python -m postarization serve --port 8080 --workers 2 --queue-size 16
+
+エンドポイント:
+    POST /render   画像を変換する
+        - 本文が画像そのもの（Content-Type: image/*）の場合は、変換後の画像を返す
+        - multipart/form-data の場合は、image フィールドの全ファイルを変換し、
+          1件終わるごとに NDJSON（1行1件、画像は base64）でストリーム返却する
+        パラメータ（クエリ文字列またはフォームのフィールド）:
+            preset=anime_style        プリセット名（カンマ区切りで複数指定すると全プリセットを返す）
+            saturation, level, smooth_strength, edge_strength  個別に上書き
+            smooth_quality=exact      平滑化の精度（exact / balanced / preview）
+            quantizer=uniform         色の量子化の方式（uniform / kmeans）
+            format=png                出力形式（png / jpeg / webp）、quality=90  JPEG / WebP の画質
+    GET /stats     キューの長さ・処理中の件数・スループットなど
+    GET /presets   プリセットの一覧
+    GET /healthz   死活監視
+
+ジョブはプロセスプールで実行し、待ち行列の上限を超えた場合は 503 を返す（Retry-After 付き）。
+ワーカーが異常終了してプロセスプールが壊れた場合は、次の投入時にプールを作り直す。
+"""
+import argparse
+import base64
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+from . import __version__
+from .pipeline import render_presets
+from .presets import PARAMETER_RANGES, PARAMETER_SETS
+from .quantize import DEFAULT_QUANTIZER, QUANTIZERS
+from .smoothing import QUALITY_FACTORS
+
+DEFAULT_PORT = 8080
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_MAX_BODY_MB = 64
+# バッチの各画像がキューに空きができるのを待つ最大時間（秒）
+BATCH_WAIT_TIMEOUT = 60
+# スループットを計算する期間（秒）
+THROUGHPUT_WINDOW = 60
+
+_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+
+class RequestError(Exception):
+    """クライアントの入力の誤り（HTTP のステータスコード付き）"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+# ---- ワーカープロセスで実行する処理 ----
+
+def render_job(data: bytes, presets: dict, output_format: str = "png", quality: int = 90,
+               smooth_quality: str = "exact", quantizer: str = DEFAULT_QUANTIZER) -> list:
+    """
+    1枚の画像を全プリセットで変換してエンコードする（デコードもワーカー側で行う）
+    :param data: 入力画像のファイルの内容
+    :param presets: {プリセット名: パラメータ}
+    :return: [(プリセット名, エンコード済みの画像), ...]
+    """
+    with Image.open(BytesIO(data)) as image:
+        image.load()
+        image = image.convert("RGB")
+    results = render_presets(image, presets, quality=smooth_quality, quantizer=quantizer)
+
+    pil_format = _FORMATS[output_format][0]
+    encoded = []
+    for name, result in results.items():
+        buf = BytesIO()
+        if output_format == "png":
+            result.save(buf, format=pil_format)
+        else:
+            result.save(buf, format=pil_format, quality=quality)
+        encoded.append((name, buf.getvalue()))
+    return encoded
+
+
+# ---- パラメータの解釈 ----
+
+def parse_options(fields: dict) -> dict:
+    """
+    クエリ文字列・フォームのフィールドから変換の設定を作る
+    :param fields: {名前: 値の文字列}
+    :return: {"presets": {名前: パラメータ}, "format", "quality", "smooth_quality", "quantizer"}
+    """
+    names = [name.strip() for name in fields.get("preset", "default").split(",") if name.strip()]
+    for name in names:
+        if name not in PARAMETER_SETS:
+            raise RequestError(f"Unknown preset: {name}")
+
+    overrides = {}
+    for param, (low, high) in PARAMETER_RANGES.items():
+        if param not in fields:
+            continue
+        try:
+            value = int(fields[param]) if param == "level" else float(fields[param])
+        except ValueError:
+            raise RequestError(f"Invalid value for {param}: {fields[param]!r}")
+        if not low <= value <= high:
+            raise RequestError(f"{param} must be between {low} and {high}")
+        overrides[param] = value
+
+    output_format = fields.get("format", "png").lower()
+    if output_format == "jpg":
+        output_format = "jpeg"
+    if output_format not in _FORMATS:
+        raise RequestError(f"Unsupported format: {output_format}")
+    try:
+        quality = int(fields.get("quality", 90))
+    except ValueError:
+        raise RequestError(f"Invalid quality: {fields['quality']!r}")
+    if not 1 <= quality <= 100:
+        raise RequestError("quality must be between 1 and 100")
+    smooth_quality = fields.get("smooth_quality", "exact")
+    if smooth_quality not in QUALITY_FACTORS:
+        raise RequestError(f"Unknown smooth_quality: {smooth_quality}")
+    quantizer = fields.get("quantizer", DEFAULT_QUANTIZER)
+    if quantizer not in QUANTIZERS:
+        raise RequestError(f"Unknown quantizer: {quantizer}")
+
+    return {
+        "presets": {name: dict(PARAMETER_SETS[name], **overrides) for name in names},
+        "format": output_format,
+        "quality": quality,
+        "smooth_quality": smooth_quality,
+        "quantizer": quantizer,
+    }
+
+
+def parse_multipart(content_type: str, body: bytes):
+    """
+    multipart/form-data を解釈する
+    :return: ({フィールド名: 値}, [(ファイル名, 内容), ...])  画像は image フィールドのファイル
+    """
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body)
+    if not message.is_multipart():
+        raise RequestError("Malformed multipart body")
+
+    fields = {}
+    files = []
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        filename = part.get_filename()
+        payload = part.get_payload(decode=True) or b""
+        if filename is not None or name == "image":
+            if name == "image":
+                files.append((filename or f"image{len(files)}", payload))
+        elif name:
+            fields[name] = payload.decode("utf-8", errors="replace")
+    return fields, files
+
+
+# ---- ジョブの管理 ----
+
+class JobQueue:
+    """
+    上限付きの待ち行列を持つプロセスプール
+
+    実行中 + 待ち の件数が workers + queue_size を超える投入は受け付けない（または空くまで待つ）。
+    """
+
+    def __init__(self, workers: int = None, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.capacity = self.workers + queue_size
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._outstanding = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._restarts = 0
+        self._total_latency = 0.0
+        self._finished_at = deque()  # 直近の完了時刻（スループットの計算用）
+
+    def submit(self, fn, *args, count_rejection: bool = True):
+        """
+        ジョブを投入する（待ち行列に空きがなければ待たずに None を返す）
+        :param count_rejection: 空きがなかったときに rejected として数えるか（後で再試行する場合は False）
+        :return: Future（空きがなければ None）
+        """
+        if not self._slots.acquire(blocking=False):
+            if count_rejection:
+                with self._lock:
+                    self._rejected += 1
+            return None
+        submitted = time.perf_counter()
+        with self._lock:
+            self._outstanding += 1
+        try:
+            future = self._submit_executor(fn, *args)
+        except Exception:
+            self._release(submitted, failed=True)
+            raise
+        future.add_done_callback(lambda f: self._release(submitted, failed=f.cancelled() or f.exception() is not None))
+        return future
+
+    def _submit_executor(self, fn, *args):
+        """プロセスプールに投入する（プールが壊れていれば作り直して1回だけ再試行する）"""
+        with self._lock:
+            executor = self._executor
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            with self._lock:
+                broken = executor is self._executor
+                if broken:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    self._restarts += 1
+                executor = self._executor
+        if broken:
+            print("[WARNING] Worker pool was broken, restarted it")
+        return executor.submit(fn, *args)
+
+    def record_rejection(self):
+        """再試行しても投入できなかったジョブを rejected として数える"""
+        with self._lock:
+            self._rejected += 1
+
+    def _release(self, submitted: float, failed: bool):
+        now = time.time()
+        with self._lock:
+            self._outstanding -= 1
+            if failed:
+                self._failed += 1
+            else:
+                self._completed += 1
+                self._total_latency += time.perf_counter() - submitted
+                self._finished_at.append(now)
+            self._trim(now)
+        self._slots.release()
+
+    def _trim(self, now: float):
+        while self._finished_at and now - self._finished_at[0] > THROUGHPUT_WINDOW:
+            self._finished_at.popleft()
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            self._trim(now)
+            window = min(THROUGHPUT_WINDOW, max(1e-9, now - self._started))
+            return {
+                "workers": self.workers,
+                "capacity": self.capacity,
+                "running": min(self._outstanding, self.workers),
+                "queue_length": max(0, self._outstanding - self.workers),
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "pool_restarts": self._restarts,
+                "throughput_per_sec": len(self._finished_at) / window,
+                "avg_latency_ms": self._total_latency / self._completed * 1000 if self._completed else 0.0,
+                "uptime_sec": now - self._started,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ---- HTTP ----
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    server_version = f"postarization/{__version__}"
+
+    @property
+    def jobs(self) -> JobQueue:
+        return self.server.jobs
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            print(f"[INFO] {self.address_string()} {format % args}")
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error_json(self, status: int, message: str, headers: dict = None):
+        self._send_json(status, {"error": message}, headers)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/stats":
+            self._send_json(200, self.jobs.stats())
+        elif path == "/presets":
+            self._send_json(200, {"presets": PARAMETER_SETS, "ranges": PARAMETER_RANGES})
+        elif path == "/healthz":
+            self._send_json(200, {"status": "ok", "version": __version__})
+        else:
+            self._send_error_json(404, "Not found")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/render":
+            self._send_error_json(404, "Not found")
+            return
+        try:
+            body = self._read_body()
+            fields = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            content_type = self.headers.get("Content-Type", "")
+            if content_type.startswith("multipart/form-data"):
+                form_fields, files = parse_multipart(content_type, body)
+                fields.update(form_fields)
+                if not files:
+                    raise RequestError("No files in the 'image' field")
+                self._render_batch(parse_options(fields), files)
+            else:
+                if not body:
+                    raise RequestError("Empty body")
+                self._render_single(parse_options(fields), body)
+        except RequestError as ex:
+            self._send_error_json(ex.status, str(ex))
+
+    def _read_body(self) -> bytes:
+        length = self.headers.get("Content-Length")
+        if length is None:
+            raise RequestError("Content-Length is required", status=411)
+        try:
+            length = int(length)
+        except ValueError:
+            raise RequestError("Invalid Content-Length")
+        if length < 0:
+            raise RequestError("Invalid Content-Length")
+        if length > self.server.max_body_bytes:
+            raise RequestError("Request body too large", status=413)
+        return self.rfile.read(length)
+
+    def _render_single(self, options: dict, data: bytes):
+        try:
+            future = self.jobs.submit(render_job, data, options["presets"], options["format"], options["quality"],
+                                      options["smooth_quality"], options["quantizer"])
+        except BrokenProcessPool:
+            self._send_error_json(503, "Worker pool unavailable", {"Retry-After": "1"})
+            return
+        if future is None:
+            self._send_error_json(503, "Queue is full", {"Retry-After": "1"})
+            return
+        try:
+            results = future.result()
+        except BrokenProcessPool:
+            # 変換中にワーカーが異常終了した（入力の誤りではない）
+            self._send_error_json(503, "Worker pool unavailable", {"Retry-After": "1"})
+            return
+        except Exception as ex:
+            self._send_error_json(422, f"Failed to process image: {ex}")
+            return
+
+        if len(results) == 1:
+            name, image_bytes = results[0]
+            self.send_response(200)
+            self.send_header("Content-Type", _FORMATS[options["format"]][1])
+            self.send_header("Content-Length", str(len(image_bytes)))
+            self.send_header("X-Preset", name)
+            self.end_headers()
+            self.wfile.write(image_bytes)
+        else:
+            # 複数プリセットの場合は JSON でまとめて返す
+            self._send_json(200, {"results": [
+                _result_entry(0, None, name, options["format"], image_bytes) for name, image_bytes in results
+            ]})
+
+    def _render_batch(self, options: dict, files: list):
+        """
+        各画像をジョブとして投入し、終わったものから NDJSON で返す
+        待ち行列が埋まっている間は、終わったジョブの結果を書き出しながら空きを待つ
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        def write_line(entry: dict):
+            self.wfile.write(json.dumps(entry, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+        pending = {}  # future -> (番号, ファイル名)
+
+        def flush(done):
+            for future in done:
+                index, filename = pending.pop(future)
+                # ワーカーの例外（壊れた画像の UnidentifiedImageError など OSError を含む）はそのファイルのエラーとして返す
+                # write_line の OSError（クライアントの切断）だけが外へ伝わる
+                try:
+                    results = future.result()
+                except Exception as ex:
+                    write_line({"index": index, "filename": filename, "error": f"Failed to process image: {ex}"})
+                    continue
+                for name, image_bytes in results:
+                    write_line(_result_entry(index, filename, name, options["format"], image_bytes))
+
+        try:
+            for index, (filename, data) in enumerate(files):
+                deadline = time.monotonic() + BATCH_WAIT_TIMEOUT
+                unavailable = False
+                while True:
+                    try:
+                        future = self.jobs.submit(render_job, data, options["presets"], options["format"],
+                                                  options["quality"], options["smooth_quality"], options["quantizer"],
+                                                  count_rejection=False)
+                    except BrokenProcessPool:
+                        future, unavailable = None, True
+                        break
+                    if future is not None or time.monotonic() >= deadline:
+                        break
+                    if pending:
+                        done, _ = wait(list(pending), timeout=0.5, return_when=FIRST_COMPLETED)
+                        flush(done)
+                    else:
+                        time.sleep(0.05)  # 他のリクエストのジョブが空くのを待つ
+                if unavailable:
+                    write_line({"index": index, "filename": filename, "error": "Worker pool unavailable"})
+                    continue
+                if future is None:
+                    self.jobs.record_rejection()
+                    write_line({"index": index, "filename": filename, "error": "Queue is full"})
+                    continue
+                pending[future] = (index, filename)
+                flush([f for f in list(pending) if f.done()])
+
+            for future in as_completed(list(pending)):
+                flush([future])
+        except OSError:
+            # クライアントが切断した場合は、まだ始まっていないジョブを取り消す
+            for future in pending:
+                future.cancel()
+
+
+def _result_entry(index: int, filename: str, preset: str, output_format: str, image_bytes: bytes) -> dict:
+    return {
+        "index": index,
+        "filename": filename,
+        "preset": preset,
+        "content_type": _FORMATS[output_format][1],
+        "data": base64.b64encode(image_bytes).decode("ascii"),
+    }
+
+
+class RenderServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, jobs: JobQueue, max_body_bytes: int = DEFAULT_MAX_BODY_MB * 2**20,
+                 verbose: bool = False):
+        super().__init__(address, RenderRequestHandler)
+        self.jobs = jobs
+        self.max_body_bytes = max_body_bytes
+        self.verbose = verbose
+
+
+def serve(host: str = "0.0.0.0", port: int = DEFAULT_PORT, workers: int = None,
+          queue_size: int = DEFAULT_QUEUE_SIZE, max_body_mb: float = DEFAULT_MAX_BODY_MB, verbose: bool = False):
+    """サーバーを起動して、終了（Ctrl+C）まで処理を続ける"""
+    jobs = JobQueue(workers, queue_size)
+    server = RenderServer((host, port), jobs, int(max_body_mb * 2**20), verbose)
+    print(f"[INFO] Serving on http://{host}:{port} ({jobs.workers} workers, queue size {queue_size})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        jobs.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m postarization serve", description="postarization の HTTP サーバー")
+    parser.add_argument("--host", default="0.0.0.0", help="待ち受けるアドレス（デフォルト: 0.0.0.0）")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"ポート番号（デフォルト: {DEFAULT_PORT}）")
+    parser.add_argument("--workers", type=int, default=None, help="ワーカープロセス数（デフォルト: CPUコア数）")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help=f"実行待ちにできるジョブ数。超えると 503 を返す（デフォルト: {DEFAULT_QUEUE_SIZE}）")
+    parser.add_argument("--max-body-mb", type=float, default=DEFAULT_MAX_BODY_MB,
+                        help=f"リクエスト本文の上限（MB、デフォルト: {DEFAULT_MAX_BODY_MB}）")
+    parser.add_argument("--verbose", action="store_true", help="リクエストごとにログを出力する")
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.workers, args.queue_size, args.max_body_mb, args.verbose)
@@ -0,0 +1,291 @@
+"""
+巨大な画像をタイル処理に渡すための入力
+
+PILTileSource は最初の読み込みで画像全体をデコードするため、数GBのスキャン画像では
+ワーカーのメモリが足りなくなる。ここでは画像全体をメモリに載せずに読み込む入力を用意する。
+
+- RawTileSource: 無圧縮の TIFF（ストリップ）・PPM・BMP などを np.memmap で参照し、
+  読み込む範囲の画素だけをファイルから取り出す
+- PNGStreamSource: PNG の圧縮データを上から順に展開し、必要な行の周辺だけを保持する
+  （行のフィルタの復元は、展開した行を小さな無圧縮の PNG にまとめて Pillow に任せる）
+
+どちらも width, height 属性と read(x0, y0, x1, y1) -> RGB配列 を持ち、tiling の render_tiled_rows などにそのまま渡せる。
+open_tile_source() は入力に合わせてどちらかを選び、使えない形式（JPEG、圧縮 TIFF など）は従来どおり PILTileSource で読み込む。
+"""
+import struct
+import zlib
+from bisect import bisect_right
+from contextlib import contextmanager
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from .tiling import PILTileSource
+
+# 無圧縮の画素の並び（Pillow の rawmode） -> 1画素のバイト数
+RAW_MODES = {
+    "RGB": 3,
+    "BGR": 3,
+    "RGBX": 4,
+    "RGBA": 4,
+    "L": 1,
+}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG のカラータイプ -> 1画素のチャンネル数（ビット深度 8 のみ対応）
+PNG_CHANNELS = {
+    0: 1,  # グレースケール
+    2: 3,  # RGB
+    3: 1,  # パレット
+    4: 2,  # グレースケール + アルファ
+    6: 4,  # RGBA
+}
+# PNGStreamSource が一度に展開する行数
+PNG_BAND_ROWS = 256
+
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+
+class RawTileSource:
+    """無圧縮の画像ファイルを np.memmap で参照し、必要な範囲だけを読み込む"""
+
+    def __init__(self, path: str, width: int, height: int, strips: list):
+        """
+        :param strips: [(y0, y1, offset, rawmode, stride, orientation), ...]（幅いっぱいのストリップ、y0 の昇順）
+        """
+        self.path = path
+        self.width = width
+        self.height = height
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        self._starts = []
+        self._strips = []  # (y0, y1, 画素の配列 shape=(行数, width, バイト数), rawmode)
+        for y0, y1, offset, rawmode, stride, orientation in strips:
+            bpp = RAW_MODES[rawmode]
+            rows = y1 - y0
+            end = offset + rows * stride
+            if end > len(self._map):
+                raise ValueError(f"Truncated image data: {path}")
+            pixels = self._map[offset:end].reshape(rows, stride)[:, :width * bpp].reshape(rows, width, bpp)
+            if orientation < 0:
+                pixels = pixels[::-1]  # 下の行から格納されている（BMP）
+            self._starts.append(y0)
+            self._strips.append((y0, y1, pixels, rawmode))
+
+    @classmethod
+    def open(cls, path: str):
+        """
+        無圧縮で、幅いっぱいのストリップに分かれた画像なら RawTileSource を返す
+        :return: RawTileSource（対応していない形式なら None）
+        """
+        with Image.open(path) as image:
+            width, height = image.size
+            tiles = list(image.tile)
+        strips = []
+        for tile in tiles:
+            codec, extents, offset, args = tile[0], tile[1], tile[2], tile[3]
+            if codec != "raw":
+                return None
+            if isinstance(args, str):
+                args = (args,)
+            rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+            if rawmode not in RAW_MODES:
+                return None
+            x0, y0, x1, y1 = extents
+            if x0 != 0 or x1 != width:
+                return None
+            stride = stride or width * RAW_MODES[rawmode]
+            if stride < width * RAW_MODES[rawmode]:
+                return None
+            strips.append((y0, min(y1, height), offset, rawmode, stride, orientation or 1))
+        if not strips:
+            return None
+        strips.sort()
+        return cls(path, width, height, strips)
+
+    def read(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        out = np.empty((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+        index = max(0, bisect_right(self._starts, y0) - 1)
+        for strip_y0, strip_y1, pixels, rawmode in self._strips[index:]:
+            if strip_y0 >= y1:
+                break
+            top, bottom = max(y0, strip_y0), min(y1, strip_y1)
+            if top >= bottom:
+                continue
+            region = pixels[top - strip_y0:bottom - strip_y0, x0:x1]
+            target = out[top - y0:bottom - y0]
+            if rawmode == "BGR":
+                target[...] = region[..., ::-1]
+            elif rawmode == "L":
+                target[...] = region  # 1チャンネルを RGB に複製
+            else:
+                target[...] = region[..., :3]
+        return out
+
+    def close(self):
+        self._strips = []
+        self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class PNGStreamSource:
+    """
+    PNG を上から順に展開して読み込む（保持するのは読み込み中の範囲の行だけ）
+    タイル処理のように上から下へ読む場合に向く。上に戻る読み込みは先頭から展開し直す
+    """
+
+    def __init__(self, path: str, width: int, height: int, header: bytes, palette: bytes, idat: list):
+        """
+        :param header: IHDR チャンクの内容
+        :param palette: PLTE チャンクの内容（なければ None）
+        :param idat: [(ファイル内の位置, 長さ), ...]（IDAT チャンクの内容）
+        """
+        self.path = path
+        self.width = width
+        self.height = height
+        self._header = header
+        self._palette = palette
+        self._idat = idat
+        channels = PNG_CHANNELS[header[9]]
+        self._row_bytes = 1 + width * channels  # 先頭はフィルタの種類
+        self._file = open(path, "rb")
+        self._restart()
+
+    @classmethod
+    def open(cls, path: str):
+        """
+        ビット深度 8・インターレースなしの PNG なら PNGStreamSource を返す
+        :return: PNGStreamSource（対応していない形式なら None）
+        """
+        with open(path, "rb") as f:
+            if f.read(8) != PNG_SIGNATURE:
+                return None
+            header = palette = None
+            idat = []
+            while True:
+                head = f.read(8)
+                if len(head) < 8:
+                    return None
+                length, tag = struct.unpack(">I4s", head)
+                if tag == b"IHDR":
+                    header = f.read(length)
+                elif tag == b"PLTE":
+                    palette = f.read(length)
+                elif tag == b"IDAT":
+                    idat.append((f.tell(), length))
+                    f.seek(length, 1)
+                elif tag == b"IEND":
+                    break
+                else:
+                    f.seek(length, 1)
+                f.seek(4, 1)  # CRC
+        if header is None or not idat:
+            return None
+        width, height, depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", header)
+        if depth != 8 or interlace != 0 or color_type not in PNG_CHANNELS:
+            return None
+        if color_type == 3 and palette is None:
+            return None
+        return cls(path, width, height, header, palette, idat)
+
+    def _restart(self):
+        self._inflater = zlib.decompressobj()
+        self._chunk_index = 0
+        self._previous_row = None  # 直前に展開した行（フィルタを戻した後の生のバイト列）
+        self._next_row = 0
+        self._window = np.empty((0, self.width, 3), dtype=np.uint8)
+        self._window_y0 = 0
+
+    def _filtered_bytes(self, size: int) -> bytes:
+        """フィルタのかかった行のデータを size バイト展開する"""
+        parts = []
+        while size > 0:
+            if self._inflater.unconsumed_tail:
+                data = self._inflater.decompress(self._inflater.unconsumed_tail, size)
+            elif self._chunk_index < len(self._idat):
+                offset, length = self._idat[self._chunk_index]
+                self._chunk_index += 1
+                self._file.seek(offset)
+                data = self._inflater.decompress(self._file.read(length), size)
+            else:
+                raise ValueError(f"Truncated PNG data: {self.path}")
+            parts.append(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def _decode_rows(self, count: int) -> np.ndarray:
+        """
+        次の count 行を展開して RGB の配列を返す
+        直前の行をフィルタなしの1行目として付けた無圧縮の PNG を作り、行のフィルタの復元は Pillow に任せる
+        """
+        data = self._filtered_bytes(count * self._row_bytes)
+        rows = count
+        if self._previous_row is not None:
+            data = b"\x00" + self._previous_row + data
+            rows += 1
+        header = struct.pack(">I", self.width) + struct.pack(">I", rows) + self._header[8:]
+        png = [PNG_SIGNATURE, _png_chunk(b"IHDR", header)]
+        if self._palette is not None:
+            png.append(_png_chunk(b"PLTE", self._palette))
+        png += [_png_chunk(b"IDAT", zlib.compress(data, 0)), _png_chunk(b"IEND", b"")]
+
+        with Image.open(BytesIO(b"".join(png))) as band:
+            band.load()
+            self._previous_row = band.crop((0, rows - 1, self.width, rows)).tobytes()
+            pixels = np.asarray(band if band.mode == "RGB" else band.convert("RGB"))
+        self._next_row += count
+        return pixels[rows - count:]
+
+    def read(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        if y0 < self._window_y0:
+            self._restart()
+        # 保持している行のうち、もう読まれない上の行を捨てる
+        self._window = self._window[max(0, y0 - self._window_y0):]
+        self._window_y0 = max(self._window_y0, y0)
+        # PNG_BAND_ROWS 行ずつ展開し（一度に展開する量を抑える）、足りない行を足す
+        bands = [self._window]
+        while self._next_row < y1:
+            band_y0 = self._next_row
+            rows = self._decode_rows(min(PNG_BAND_ROWS, self.height - self._next_row))
+            if band_y0 + len(rows) <= y0:
+                continue  # 読み飛ばす行
+            if band_y0 < y0:
+                rows = rows[y0 - band_y0:]
+            bands.append(rows)
+        if len(bands) > 1:
+            self._window = np.concatenate(bands)
+            self._window_y0 = self._next_row - len(self._window)
+        return np.ascontiguousarray(self._window[y0 - self._window_y0:y1 - self._window_y0, x0:x1])
+
+    def close(self):
+        self._file.close()
+        self._window = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+@contextmanager
+def open_tile_source(path: str):
+    """
+    画像全体をメモリに載せずに読み込める入力を開く
+    無圧縮の画像は RawTileSource、PNG は PNGStreamSource、それ以外は画像全体をデコードする PILTileSource を使う
+    """
+    source = RawTileSource.open(path) or PNGStreamSource.open(path)
+    if source is not None:
+        with source:
+            yield source
+        return
+    with Image.open(path) as image:
+        print(f"[INFO] {path}: not an uncompressed or PNG input, decoding the whole image")
+        yield PILTileSource(image)
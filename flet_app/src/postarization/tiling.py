@@ -0,0 +1,262 @@
+"""
+巨大な画像をタイルごとに処理する
+
+各タイルは周囲に「のりしろ（halo）」を付けて切り出してからフィルタをかけ、
+中央部分だけを出力に書き込む。出力は行の順にPNGへストリーム書き込みするため、
+処理中のメモリは画像全体の大きさではなくタイルの大きさ（と画像の幅）で決まる。
+"""
+import math
+import struct
+import zlib
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from .pipeline import RenderCancelled, render_stages, saturate
+from .quantize import DEFAULT_QUANTIZER, PALETTE_SAMPLE_SIDE, Palette, check_quantizer
+
+# Canny（3x3 Sobel + 非極大値抑制）のための余白
+CANNY_HALO = 8
+
+DEFAULT_TILE_SIZE = 1024
+
+
+def tile_halo(smooth_strength) -> int:
+    """
+    タイルの周囲に付けるのりしろの幅
+    edgePreservingFilter（再帰フィルタ）の影響は sigma_s の 1.5 倍程度で
+    画素値の丸め誤差以下になるため、余裕を見て 2 倍を取る
+    :param smooth_strength: 平滑化の強さ（sigma_s）
+    :return: のりしろの幅（ピクセル）
+    """
+    return int(math.ceil(2 * max(0, smooth_strength))) + CANNY_HALO
+
+
+def iter_tiles(width: int, height: int, tile_size: int, halo: int):
+    """
+    タイルの範囲を行優先で列挙する
+    :return: (出力範囲 (x0, y0, x1, y1), のりしろ込みの読み込み範囲 (x0, y0, x1, y1)) のジェネレータ
+    """
+    for y0 in range(0, height, tile_size):
+        y1 = min(height, y0 + tile_size)
+        for x0 in range(0, width, tile_size):
+            x1 = min(width, x0 + tile_size)
+            padded = (max(0, x0 - halo), max(0, y0 - halo), min(width, x1 + halo), min(height, y1 + halo))
+            yield (x0, y0, x1, y1), padded
+
+
+# ---- 入力 ----
+
+class ArrayTileSource:
+    """RGBのnumpy配列（np.memmap を含む）からタイルを読み込む"""
+
+    def __init__(self, array: np.ndarray):
+        self.array = array
+        self.height, self.width = array.shape[:2]
+
+    def read(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        return np.ascontiguousarray(self.array[y0:y1, x0:x1])
+
+
+class PILTileSource:
+    """PIL Image からタイルを切り出して読み込む（numpy配列への全体コピーを作らない）"""
+
+    def __init__(self, image: Image.Image):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        self.image = image
+        self.width, self.height = image.size
+
+    def read(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        return np.asarray(self.image.crop((x0, y0, x1, y1)))
+
+
+# ---- 出力 ----
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+
+class PNGStreamWriter:
+    """
+    8bit RGB のPNGを行単位でストリーム書き込みする
+    各行は Sub フィルタ（左隣の画素との差分）をかけてから zlib で圧縮する
+    """
+
+    # この大きさを超えたら IDAT チャンクとして書き出す
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, path: str, width: int, height: int, compress_level: int = 6):
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._file = open(path, "wb")
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = []
+        self._pending_size = 0
+
+        self._file.write(b"\x89PNG\r\n\x1a\n")
+        # 幅, 高さ, ビット深度 8, カラータイプ 2 (RGB), 圧縮 0, フィルタ 0, インターレースなし
+        self._file.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+
+    def write_rows(self, rows: np.ndarray):
+        """
+        上から順に行を書き込む
+        :param rows: RGBの配列（shape=(行数, width, 3), uint8）
+        """
+        if rows.shape[1:] != (self.width, 3):
+            raise ValueError(f"Expected rows of shape (n, {self.width}, 3), got {rows.shape}")
+        if self.rows_written + rows.shape[0] > self.height:
+            raise ValueError("Too many rows written")
+
+        flat = rows.reshape(rows.shape[0], -1)
+        filtered = np.empty((rows.shape[0], flat.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 1  # Sub フィルタ
+        filtered[:, 1:4] = flat[:, :3]
+        np.subtract(flat[:, 3:], flat[:, :-3], out=filtered[:, 4:])  # uint8 の差分は mod 256
+
+        self._emit(self._compressor.compress(filtered.tobytes()))
+        self.rows_written += rows.shape[0]
+
+    def _emit(self, data: bytes, flush: bool = False):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+        if self._pending_size >= self.CHUNK_SIZE or (flush and self._pending_size):
+            self._file.write(_png_chunk(b"IDAT", b"".join(self._pending)))
+            self._pending = []
+            self._pending_size = 0
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+            self._emit(self._compressor.flush(), flush=True)
+            self._file.write(_png_chunk(b"IEND", b""))
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+
+# ---- タイル処理 ----
+
+def source_overview(source, side: int = PALETTE_SAMPLE_SIDE, band_height: int = DEFAULT_TILE_SIZE) -> np.ndarray:
+    """
+    入力全体を長辺 side 以下に縮小した画像（RGB）を作る
+    band_height 行ずつ読み込んで縮小するため、画像全体を一度に読み込まない
+    """
+    scale = min(1.0, side / max(source.width, source.height))
+    width = max(1, round(source.width * scale))
+    bands = []
+    for y0 in range(0, source.height, band_height):
+        y1 = min(source.height, y0 + band_height)
+        rows = max(1, round((y1 - y0) * scale))
+        band = source.read(0, y0, source.width, y1)
+        bands.append(cv2.resize(band, (width, rows), interpolation=cv2.INTER_AREA))
+    return np.concatenate(bands)
+
+
+def source_palette(source, saturation=2, level=8) -> Palette:
+    """
+    画像全体から kmeans のパレットを作る
+    タイルごとにパレットを作るとタイルの間で色がずれるため、全タイルで同じパレットを使う
+    """
+    return Palette.from_image(saturate(source_overview(source), saturation, "RGB"), level, "RGB")
+
+
+def tile_count(width: int, height: int, tile_size: int) -> int:
+    """iter_tiles が列挙するタイルの数"""
+    return math.ceil(width / tile_size) * math.ceil(height / tile_size)
+
+
+def render_tiled_rows(source, saturation=2, level=8, smooth_strength=50, edge_strength=0.4,
+                      tile_size: int = DEFAULT_TILE_SIZE, on_progress=None, should_cancel=None,
+                      quantizer: str = DEFAULT_QUANTIZER):
+    """
+    タイルごとにフィルタをかけ、1段分（tile_size 行）ずつ出力する
+    :param source: width, height 属性と read(x0, y0, x1, y1) -> RGB配列 を持つ入力
+    :param on_progress: タイルを1枚処理するごとに on_progress(処理済みの数, 全体の数) が呼ばれる
+    :param should_cancel: タイルの間で呼ばれ、Trueを返すと RenderCancelled を送出する関数
+    :param quantizer: 色の量子化の方式（"uniform" / "kmeans"。kmeans のパレットは画像全体から1つ作る）
+    :return: RGBの行ブロック（shape=(行数, width, 3)）のジェネレータ
+    """
+    check_quantizer(quantizer)
+    palette = source_palette(source, saturation, level) if quantizer == "kmeans" else None
+    halo = tile_halo(smooth_strength)
+    total = tile_count(source.width, source.height, tile_size)
+    band = None
+    band_y0 = None
+    tiles = iter_tiles(source.width, source.height, tile_size, halo)
+    for done, ((x0, y0, x1, y1), (px0, py0, px1, py1)) in enumerate(tiles, start=1):
+        if should_cancel is not None and should_cancel():
+            raise RenderCancelled("tile")
+        if band_y0 != y0:
+            if band is not None:
+                yield band
+            band = np.empty((y1 - y0, source.width, 3), dtype=np.uint8)
+            band_y0 = y0
+
+        # RGB のまま処理し、のりしろを除いた中央部分だけを書き込む
+        result = render_stages(source.read(px0, py0, px1, py1), saturation, level, smooth_strength, edge_strength,
+                               quantizer=quantizer, palette=palette, channel_order="RGB")
+        band[:, x0:x1] = result[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+        if on_progress is not None:
+            on_progress(done, total)
+
+    if band is not None:
+        yield band
+
+
+def render_tiled_to_png(source, output_path: str, saturation=2, level=8, smooth_strength=50, edge_strength=0.4,
+                        tile_size: int = DEFAULT_TILE_SIZE, compress_level: int = 6, on_progress=None,
+                        should_cancel=None, quantizer: str = DEFAULT_QUANTIZER):
+    """
+    タイルごとにフィルタをかけて、結果をPNGへストリーム書き込みする
+    :param source: width, height 属性と read(x0, y0, x1, y1) -> RGB配列 を持つ入力
+    :param output_path: 出力するPNGのパス
+    :param on_progress: render_tiled_rows を参照
+    :param should_cancel: render_tiled_rows を参照
+    :param quantizer: render_tiled_rows を参照
+    """
+    with PNGStreamWriter(output_path, source.width, source.height, compress_level) as writer:
+        for rows in render_tiled_rows(source, saturation, level, smooth_strength, edge_strength, tile_size,
+                                      on_progress, should_cancel, quantizer):
+            writer.write_rows(rows)
+
+
+def verify_tiling(image: np.ndarray, saturation=2, level=8, smooth_strength=50, edge_strength=0.4,
+                  tile_size: int = DEFAULT_TILE_SIZE) -> dict:
+    """
+    タイル処理の結果をタイルなしの結果と比較する
+    :param image: 入力画像（RGB）
+    :return: 最大差分、差分のある画素の割合、タイル境界付近に差分が集中しているか
+    """
+    whole = render_stages(image, saturation, level, smooth_strength, edge_strength, channel_order="RGB")
+    tiled = np.concatenate(list(render_tiled_rows(
+        ArrayTileSource(image), saturation, level, smooth_strength, edge_strength, tile_size)))
+
+    diff = np.any(whole != tiled, axis=2)
+    # タイル境界から 2px 以内の画素
+    seam = np.zeros(diff.shape, dtype=bool)
+    for y in range(tile_size, image.shape[0], tile_size):
+        seam[max(0, y - 2):y + 2, :] = True
+    for x in range(tile_size, image.shape[1], tile_size):
+        seam[:, max(0, x - 2):x + 2] = True
+
+    return {
+        "max_abs_diff": int(np.abs(whole.astype(np.int16) - tiled).max()),
+        "mismatch_fraction": float(diff.mean()),
+        "seam_mismatch_fraction": float(diff[seam].mean()) if seam.any() else 0.0,
+        "interior_mismatch_fraction": float(diff[~seam].mean()) if (~seam).any() else 0.0,
+    }
@@ -0,0 +1,236 @@
+"""
+プレビュー画像の送信
+
+Web版では、エンコードした画像を Flet の assets ディレクトリ（previews/）にファイルとして書き出し、
+WebSocket ではその URL だけを送る。画像は Flet の静的ファイル配信（ETag / Last-Modified 付き）で
+ブラウザが直接取得するため、base64 による約33%の膨張と WebSocket への大きなメッセージがなくなる。
+ファイル名は内容のハッシュなので、同じ結果に戻ったときはブラウザのキャッシュが効く。
+
+画質はフレームごとのバイト数が帯域の予算に収まるように自動で調整する。
+
+環境変数:
+    POSTARIZATION_PREVIEW_KBPS=4000    プレビューに使う帯域の目安（kbit/s）
+    POSTARIZATION_PREVIEW_FORMAT=jpeg  プレビューの形式（jpeg / webp。webp は小さいがエンコードが遅い）
+"""
+import base64
+import hashlib
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from io import BytesIO
+
+from PIL import Image, features
+
+PREVIEW_DIRNAME = "previews"
+DEFAULT_BANDWIDTH_KBPS = 4000
+
+# 画質の調整範囲と初期値
+MIN_QUALITY = 40
+MAX_QUALITY = 90
+DEFAULT_QUALITY = 80
+
+# 予算の計算に使うフレーム間隔の範囲（秒）
+MIN_INTERVAL = 0.1
+MAX_INTERVAL = 1.0
+
+_FORMATS = {
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "webp": ("WEBP", "webp", "image/webp"),
+}
+
+
+def assets_dir() -> str:
+    """Flet の assets ディレクトリ（ft.app の既定値と同じく、このファイルの隣の assets）"""
+    return os.getenv("FLET_ASSETS_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+
+
+def preview_format() -> str:
+    fmt = os.getenv("POSTARIZATION_PREVIEW_FORMAT", "jpeg").lower()
+    if fmt == "webp" and not features.check("webp"):
+        print("[WARNING] WebP is not supported by Pillow, falling back to JPEG previews")
+        return "jpeg"
+    return fmt if fmt in _FORMATS else "jpeg"
+
+
+class AdaptiveEncoder:
+    """
+    フレームのバイト数が帯域の予算に収まるよう画質を調整しながらエンコードする
+
+    1フレームの予算 = 帯域 × 前のフレームからの間隔（MIN_INTERVAL〜MAX_INTERVAL に制限）
+    予算を超えたら次のフレームから画質を下げ、十分小さければ上げる（エンコードは1回だけ）
+    """
+
+    def __init__(self, bandwidth_kbps: float = None, fmt: str = None, quality: int = DEFAULT_QUALITY):
+        """
+        :param bandwidth_kbps: プレビューに使う帯域（kbit/s）
+        :param fmt: 形式（jpeg / webp）
+        :param quality: 画質の初期値
+        """
+        if bandwidth_kbps is None:
+            bandwidth_kbps = float(os.getenv("POSTARIZATION_PREVIEW_KBPS", DEFAULT_BANDWIDTH_KBPS))
+        self.bandwidth = bandwidth_kbps * 1000 / 8  # bytes/s
+        self.format = fmt or preview_format()
+        self.quality = quality
+        self._last_time = None
+
+    @property
+    def extension(self) -> str:
+        return _FORMATS[self.format][1]
+
+    @property
+    def mime_type(self) -> str:
+        return _FORMATS[self.format][2]
+
+    def target_bytes(self, now: float = None) -> int:
+        """次のフレームの予算（バイト）"""
+        now = time.monotonic() if now is None else now
+        interval = MAX_INTERVAL if self._last_time is None else now - self._last_time
+        return int(self.bandwidth * min(max(interval, MIN_INTERVAL), MAX_INTERVAL))
+
+    def encode(self, img: Image.Image) -> bytes:
+        now = time.monotonic()
+        target = self.target_bytes(now)
+        self._last_time = now
+
+        buf = BytesIO()
+        pil_format = _FORMATS[self.format][0]
+        if pil_format == "WEBP":
+            # 速度優先（method=0）
+            img.save(buf, format=pil_format, quality=self.quality, method=0)
+        else:
+            img.save(buf, format=pil_format, quality=self.quality)
+        data = buf.getvalue()
+
+        # 次のフレームの画質を調整（サイズは画質に対して単調に増えると見なす）
+        ratio = len(data) / max(1, target)
+        if ratio > 2.0:
+            self.quality = max(MIN_QUALITY, self.quality - 10)
+        elif ratio > 1.0:
+            self.quality = max(MIN_QUALITY, self.quality - 5)
+        elif ratio < 0.5:
+            self.quality = min(MAX_QUALITY, self.quality + 5)
+        return data
+
+
+class PreviewTransport:
+    """
+    1セッション分のプレビュー画像の送信
+
+    directory を指定した場合（Web版）はファイルに書き出して URL を返し、
+    指定しない場合（デスクトップ版）は従来どおり base64 文字列を返す。
+    """
+
+    def __init__(self, directory: str = None, keep: int = 4, bandwidth_kbps: float = None, fmt: str = None):
+        """
+        :param directory: 書き出し先（assets ディレクトリ内の previews/。Noneなら base64）
+        :param keep: チャンネルごとに残しておく直近のフレーム数（取得中のものを消さないため）
+        """
+        self.directory = directory
+        self.keep = max(1, keep)
+        self._bandwidth_kbps = bandwidth_kbps
+        self._format = fmt
+        # 推測されないよう、ファイル名の先頭にセッションごとのランダムな値を付ける
+        self._token = secrets.token_hex(8)
+        self._encoders = {}  # チャンネル名（縮小プレビュー / フル解像度） -> AdaptiveEncoder
+        self._recent = {}  # チャンネル名 -> 書き出したフレームのパス（古い順）
+        self._exports = []
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.bytes_sent = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def uses_files(self) -> bool:
+        return self.directory is not None
+
+    def encoder(self, channel: str = "full") -> AdaptiveEncoder:
+        """チャンネルごとのエンコーダー（縮小プレビューとフル解像度は頻度が違うため別々に調整する）"""
+        with self._lock:
+            encoder = self._encoders.get(channel)
+            if encoder is None:
+                encoder = AdaptiveEncoder(self._bandwidth_kbps, self._format)
+                self._encoders[channel] = encoder
+            return encoder
+
+    def encode(self, img: Image.Image, channel: str = "full") -> bytes:
+        return self.encoder(channel).encode(img)
+
+    def publish(self, data: bytes, channel: str = "full", keep: int = None) -> str:
+        """
+        エンコード済みの画像を送れる形にする
+        :param keep: このチャンネルに残すフレーム数（省略時はコンストラクタの値）
+        :return: Web版は画像の URL（例: /previews/xxx.jpg）、それ以外は base64 文字列
+        """
+        with self._lock:
+            self.frames += 1
+            self.bytes_sent += len(data)
+        if not self.uses_files:
+            return base64.b64encode(data).decode("utf-8")
+
+        name = f"{self._token}_{hashlib.sha1(data).hexdigest()[:20]}.{self.encoder(channel).extension}"
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            _write_atomic(path, data)
+
+        with self._lock:
+            recent = self._recent.setdefault(channel, deque())
+            if path in recent:
+                recent.remove(path)
+            recent.append(path)
+            stale = []
+            while len(recent) > max(1, keep or self.keep):
+                stale.append(recent.popleft())
+            # 他のチャンネルでまだ使っているファイルは消さない
+            in_use = {p for other in self._recent.values() for p in other}
+        for old in stale:
+            if old not in in_use:
+                _remove(old)
+        return f"/{PREVIEW_DIRNAME}/{name}"
+
+    def reserve_export(self, filename: str) -> tuple:
+        """
+        エクスポート用のファイルのパスと URL を確保する（Web版のみ。セッション終了時に削除される）
+        大きな画像を直接ファイルへ書き出す場合に使う。書き出しは一時ファイルに行ってから置き換えること
+        :param filename: ファイル名の末尾（例: filtered_image_xxx.png）
+        :return: (書き出し先のパス, 画像の URL)
+        """
+        name = f"{self._token}_{secrets.token_hex(4)}_{filename}"
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            self._exports.append(path)
+        return path, f"/{PREVIEW_DIRNAME}/{name}"
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "frames": self.frames,
+                "bytes_sent": self.bytes_sent,
+                "quality": {channel: encoder.quality for channel, encoder in self._encoders.items()},
+            }
+
+    def close(self):
+        """セッション終了時に書き出したファイルを削除する"""
+        with self._lock:
+            paths = [path for recent in self._recent.values() for path in recent] + self._exports
+            self._recent.clear()
+            self._exports = []
+        for path in paths:
+            _remove(path)
+
+
+def _write_atomic(path: str, data: bytes):
+    # 書きかけのファイルが配信されないよう、一時ファイルに書いてから置き換える
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
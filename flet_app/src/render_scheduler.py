@@ -0,0 +1,205 @@
+import threading
+import time
+from contextlib import nullcontext
+
+from postarization import RenderCancelled
+
+
+class RenderScheduler:
+    """
+    セッションごとに1本のワーカースレッドで描画を行うスケジューラ
+
+    - 未処理のパラメータは常に最新の1件だけを保持する（latest wins）
+    - 追い越されたジョブは実行せずに破棄し、実行中のものは段階の間で打ち切る
+    - 結果には世代番号を付け、最新の世代の結果だけを on_result に渡す
+    - 最新の世代が結果を出せずに終わった場合（失敗・打ち切り、on_result の例外）は on_failure に知らせる
+    """
+
+    def __init__(self, render, on_result, debounce: float = 0.3, recorder=None, on_failure=None):
+        """
+        :param render: render(params, generation, should_cancel) -> result を行う関数（ワーカースレッドで実行）
+        :param on_result: on_result(generation, result) を受け取る関数（最新の世代のみ呼ばれる）
+        :param debounce: 最後の submit からこの秒数だけ待ってから描画を始める
+        :param recorder: 1ジョブ（描画 + on_result）を1回の描画として記録する profiling.StageRecorder
+        :param on_failure: on_failure(generation, error) を受け取る関数（最新の世代が結果を出せなかった場合のみ呼ばれる）
+        """
+        self._render = render
+        self._on_result = on_result
+        self._on_failure = on_failure
+        self._debounce = debounce
+        self._recorder = recorder
+
+        self._cond = threading.Condition()
+        self._pending = None  # (generation, params, 投入時刻, 実行可能になる時刻)
+        self._generation = 0
+        self._running = False
+        self._closed = False
+        self._thread = None
+
+        # 統計情報
+        self._submitted = 0
+        self._rendered = 0
+        self._superseded = 0
+        self._cancelled = 0
+        self._failed = 0
+        self._last_latency = 0.0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def is_stale(self, generation: int) -> bool:
+        """より新しいジョブが投入されていればTrue"""
+        return generation != self._generation
+
+    def wait_superseded(self, generation: int, timeout: float) -> bool:
+        """
+        指定した世代が追い越されるまで最大 timeout 秒待つ
+        :return: 追い越された（またはシャットダウンされた）場合はTrue
+        """
+        deadline = time.perf_counter() + timeout
+        with self._cond:
+            while not self.is_stale(generation):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def submit(self, params: dict, immediate: bool = False) -> int:
+        """
+        描画ジョブを投入する。未処理のジョブがあれば置き換える
+        :param params: render に渡すパラメータ
+        :param immediate: Trueの場合はデバウンスせずにすぐ描画する
+        :return: このジョブの世代番号
+        """
+        with self._cond:
+            if self._closed:
+                return self._generation
+            if self._pending is not None:
+                self._superseded += 1
+            self._generation += 1
+            now = time.perf_counter()
+            ready_at = now if immediate else now + self._debounce
+            self._pending = (self._generation, params, now, ready_at)
+            self._submitted += 1
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="render-scheduler", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return self._generation
+
+    def shutdown(self):
+        """ワーカースレッドを停止する（未処理のジョブは破棄）"""
+        with self._cond:
+            self._closed = True
+            self._pending = None
+            # 実行中の描画も打ち切らせる
+            self._generation += 1
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """キューの深さや描画レイテンシなどの統計情報"""
+        with self._cond:
+            return {
+                "generation": self._generation,
+                "queue_depth": (1 if self._pending is not None else 0) + (1 if self._running else 0),
+                "running": self._running,
+                "submitted": self._submitted,
+                "rendered": self._rendered,
+                "superseded": self._superseded,
+                "cancelled": self._cancelled,
+                "failed": self._failed,
+                "last_latency_ms": self._last_latency * 1000,
+                "avg_latency_ms": (self._total_latency / self._rendered * 1000) if self._rendered else 0.0,
+                "max_latency_ms": self._max_latency * 1000,
+            }
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                if self._pending is None:
+                    self._cond.wait()
+                    continue
+                # デバウンス: 新しい submit があれば待ち時間を延長する
+                remaining = self._pending[3] - time.perf_counter()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                job = self._pending
+                self._pending = None
+                self._running = True
+                return job
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            generation, params, submitted_at, _ = job
+
+            def should_cancel():
+                return self.is_stale(generation)
+
+            if self._recorder is not None:
+                context = self._recorder.render(generation=generation)
+            else:
+                context = nullcontext({})
+            with context as entry:
+                entry["outcome"] = self._run(generation, params, submitted_at, should_cancel)
+
+    def _run(self, generation, params, submitted_at, should_cancel) -> str:
+        """1つのジョブを実行し、結果（rendered / superseded / cancelled / failed）を返す"""
+        try:
+            result = self._render(params, generation, should_cancel)
+        except RenderCancelled as ex:
+            with self._cond:
+                self._cancelled += 1
+                self._running = False
+            self._notify_failure(generation, ex)
+            return "cancelled"
+        except Exception as ex:
+            print(f"[ERROR] Render failed (generation {generation}): {ex}")
+            with self._cond:
+                self._failed += 1
+                self._running = False
+            self._notify_failure(generation, ex)
+            return "failed"
+
+        with self._cond:
+            self._running = False
+            if self.is_stale(generation):
+                self._superseded += 1
+                return "superseded"
+            latency = time.perf_counter() - submitted_at
+
+        # 表示で例外が出てもワーカーは止めない（止まると以降の描画が行われなくなる）
+        try:
+            self._on_result(generation, result)
+        except Exception as ex:
+            print(f"[ERROR] Displaying render result failed (generation {generation}): {ex}")
+            with self._cond:
+                self._failed += 1
+            self._notify_failure(generation, ex)
+            return "failed"
+
+        with self._cond:
+            self._rendered += 1
+            self._last_latency = latency
+            self._total_latency += latency
+            self._max_latency = max(self._max_latency, latency)
+        return "rendered"
+
+    def _notify_failure(self, generation: int, error: Exception):
+        """最新の世代が結果を出せなかったことを on_failure に知らせる（追い越された世代は新しい世代が結果を出す）"""
+        if self._on_failure is None or self.is_stale(generation):
+            return
+        try:
+            self._on_failure(generation, error)
+        except Exception as ex:
+            print(f"[ERROR] Render failure handler failed (generation {generation}): {ex}")
@@ -0,0 +1,225 @@
+"""
+セッションごとのメモリ使用量の管理（Web版の複数ユーザー向け）
+
+各セッションは元画像・変換結果・パイプラインの段階ごとのキャッシュを保持するため、
+1セッションあたり画像数枚分のメモリを使う。全セッションの合計に上限（予算）を設け、
+
+- 超えそうになったら、しばらく操作されていないセッションから順に（LRU）画像をディスクへ退避する
+- 退避しても収まらない場合は、新しい画像の読み込みを断る（アドミッション制御）
+- 退避したセッションは、次に操作されたときにディスクから読み戻す
+
+環境変数:
+    POSTARIZATION_MEMORY_BUDGET_MB=512  全セッションの合計の上限
+    POSTARIZATION_SPILL_IDLE_SEC=30     退避の対象にする、最後の操作からの経過秒数
+"""
+import os
+import threading
+import time
+
+DEFAULT_BUDGET_MB = 512
+DEFAULT_SPILL_IDLE_SEC = 30
+
+# 1画素あたりのおおよそのバイト数
+# 元画像・変換結果・パイプラインの入力と各段階（彩度・平滑化・ポスタリゼーション・重ね合わせ: 各3、線画: 1）
+BYTES_PER_PIXEL = 22
+
+
+def estimate_session_bytes(width: int, height: int) -> int:
+    """この大きさの画像を読み込んだセッションが使うメモリの見積もり"""
+    return width * height * BYTES_PER_PIXEL
+
+
+class SessionMemory:
+    """
+    1セッション分のメモリの管理情報
+
+    lock は描画中・読み込み中に保持する。保持されている間は退避の対象にならない。
+    """
+
+    def __init__(self, manager, session_id: str, resident, spill):
+        """
+        :param resident: 現在メモリに保持しているバイト数を返す関数
+        :param spill: 画像をディスクへ退避してメモリを解放し、解放したバイト数を返す関数
+        """
+        self.manager = manager
+        self.session_id = session_id
+        self.lock = threading.RLock()
+        self.last_used = time.monotonic()
+        self.spilled = False
+        self._resident = resident
+        self._spill = spill
+
+    def touch(self):
+        """操作があったことを記録する（LRU の順序を更新）"""
+        self.last_used = time.monotonic()
+
+    def resident_bytes(self) -> int:
+        return 0 if self.spilled else self._resident()
+
+    def idle_seconds(self) -> float:
+        return time.monotonic() - self.last_used
+
+    def try_spill(self) -> int:
+        """
+        使用中でなければ画像を退避する
+        :return: 解放したバイト数（退避しなかった場合は 0）
+        """
+        if not self.lock.acquire(blocking=False):
+            return 0
+        try:
+            if self.spilled:
+                return 0
+            freed = self._spill()
+            if freed:
+                self.spilled = True
+                self.manager.count("spills")
+            return freed
+        finally:
+            self.lock.release()
+
+    def mark_restored(self):
+        """ディスクから読み戻したことを記録する（呼び出し側が lock を保持していること）"""
+        self.spilled = False
+        self.manager.count("restores")
+        self.touch()
+
+
+class MemoryManager:
+    """全セッションで共有するメモリの予算"""
+
+    def __init__(self, budget_bytes: int, spill_dir: str, spill_idle: float = DEFAULT_SPILL_IDLE_SEC):
+        """
+        :param budget_bytes: 全セッションの合計の上限
+        :param spill_dir: 退避した画像を置くディレクトリ
+        :param spill_idle: 最後の操作からこの秒数が経ったセッションを退避の対象にする
+        """
+        self.budget_bytes = budget_bytes
+        self.spill_dir = spill_dir
+        self.spill_idle = spill_idle
+        self._sessions = {}
+        self._lock = threading.Lock()
+        # 累計（セッションが終了しても減らない）
+        self.spills = 0
+        self.restores = 0
+        self.rejections = 0
+        os.makedirs(spill_dir, exist_ok=True)
+
+    def register(self, session_id: str, resident, spill) -> SessionMemory:
+        session = SessionMemory(self, session_id, resident, spill)
+        with self._lock:
+            self._sessions[session_id] = session
+        return session
+
+    def count(self, counter: str):
+        """累計のカウンタ（spills / restores / rejections）を1つ増やす"""
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def unregister(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def spill_path(self, session_id: str, name: str) -> str:
+        """退避したファイルのパス"""
+        safe_id = "".join(c for c in session_id if c.isalnum() or c in "-_")
+        return os.path.join(self.spill_dir, f"{safe_id}_{name}.png")
+
+    def _sessions_snapshot(self) -> list:
+        with self._lock:
+            return list(self._sessions.values())
+
+    def resident_bytes(self, exclude: SessionMemory = None) -> int:
+        return sum(s.resident_bytes() for s in self._sessions_snapshot() if s is not exclude)
+
+    def _free(self, needed: int, exclude: SessionMemory = None) -> int:
+        """
+        最後の操作が古いセッションから順に退避して、needed バイトを空ける
+        :return: 空けたバイト数
+        """
+        freed = 0
+        candidates = [
+            s for s in self._sessions_snapshot()
+            if s is not exclude and not s.spilled and s.idle_seconds() >= self.spill_idle
+        ]
+        for session in sorted(candidates, key=lambda s: s.last_used):
+            if freed >= needed:
+                break
+            released = session.try_spill()
+            if released:
+                freed += released
+                print(f"[INFO] Spilled idle session {session.session_id} to disk ({released / 2**20:.1f} MB)")
+        return freed
+
+    def admit(self, session: SessionMemory, nbytes: int) -> bool:
+        """
+        セッションが nbytes を使ってよいか判定する（必要なら他のセッションを退避する）
+        セッションが今持っている分は置き換えられるものとして数えない
+        :return: 受け入れられる場合はTrue
+        """
+        overflow = self.resident_bytes(exclude=session) + nbytes - self.budget_bytes
+        if nbytes > self.budget_bytes or (overflow > 0 and self._free(overflow, exclude=session) < overflow):
+            self.count("rejections")
+            return False
+        return True
+
+    def rebalance(self, active: SessionMemory = None):
+        """予算を超えていれば、使われていないセッションを退避する"""
+        overflow = self.resident_bytes() - self.budget_bytes
+        if overflow > 0:
+            self._free(overflow, exclude=active)
+
+    def snapshot(self) -> dict:
+        sessions = self._sessions_snapshot()
+        return {
+            "budget_bytes": self.budget_bytes,
+            "resident_bytes": sum(s.resident_bytes() for s in sessions),
+            "sessions": len(sessions),
+            "spilled_sessions": sum(1 for s in sessions if s.spilled),
+            "spills": self.spills,
+            "restores": self.restores,
+            "rejections": self.rejections,
+            "per_session": {s.session_id: s.resident_bytes() for s in sessions},
+        }
+
+    def prometheus_lines(self, prefix: str = "postarization") -> list:
+        """Prometheus のテキスト形式の行（HELP / TYPE を含む）"""
+        sessions = self._sessions_snapshot()
+        lines = [
+            f"# HELP {prefix}_session_resident_bytes Image bytes held in memory per session",
+            f"# TYPE {prefix}_session_resident_bytes gauge",
+        ]
+        for s in sessions:
+            lines.append(f'{prefix}_session_resident_bytes{{session="{s.session_id}"}} {s.resident_bytes()}')
+        lines += [
+            f"# HELP {prefix}_memory_budget_bytes Memory budget shared by all sessions",
+            f"# TYPE {prefix}_memory_budget_bytes gauge",
+            f"{prefix}_memory_budget_bytes {self.budget_bytes}",
+            f"# HELP {prefix}_spilled_sessions Sessions whose images are spilled to disk",
+            f"# TYPE {prefix}_spilled_sessions gauge",
+            f"{prefix}_spilled_sessions {sum(1 for s in sessions if s.spilled)}",
+            f"# HELP {prefix}_session_spills_total Sessions spilled to disk",
+            f"# TYPE {prefix}_session_spills_total counter",
+            f"{prefix}_session_spills_total {self.spills}",
+            f"# HELP {prefix}_session_restores_total Sessions restored from disk",
+            f"# TYPE {prefix}_session_restores_total counter",
+            f"{prefix}_session_restores_total {self.restores}",
+            f"# HELP {prefix}_admission_rejections_total Image loads refused because of the memory budget",
+            f"# TYPE {prefix}_admission_rejections_total counter",
+            f"{prefix}_admission_rejections_total {self.rejections}",
+        ]
+        return lines
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_manager(spill_dir: str) -> MemoryManager:
+    """プロセス全体で共有する MemoryManager（最初の呼び出しで作成）"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            budget_mb = float(os.getenv("POSTARIZATION_MEMORY_BUDGET_MB", DEFAULT_BUDGET_MB))
+            spill_idle = float(os.getenv("POSTARIZATION_SPILL_IDLE_SEC", DEFAULT_SPILL_IDLE_SEC))
+            _shared = MemoryManager(int(budget_mb * 2**20), spill_dir, spill_idle)
+        return _shared